@@ -0,0 +1,360 @@
+"""Reproducible benchmark of ingestion, search and /ask against the app in-process.
+
+Usage (from the backend directory):
+    python benchmark.py --chunks 10,1000,10000 --output bench.json
+    python benchmark.py --chunks 10000 --compare bench.json
+
+Each corpus size runs in a fresh process with its own DATA_DIR, so memory
+high-water marks and caches do not leak between sizes. The LLM is replaced
+by a local stub whose latency grows with the prompt size; no network access
+or API key is needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
+
+# Vocabulario bilingüe por temas: cada documento mezcla un tema principal con ruido del resto
+TOPICS = {
+    'rrhh': ("empleado vacaciones salario horario contrato nómina permiso despido formación "
+             "employee holiday salary schedule contract payroll leave dismissal training"),
+    'seguridad': ("seguridad contraseña acceso datos cifrado copia incidente auditoría riesgo "
+                  "security password access data encryption backup incident audit risk"),
+    'finanzas': ("presupuesto factura cliente proyecto coste ingreso impuesto pago balance "
+                 "budget invoice customer project cost revenue tax payment balance"),
+    'oficina': ("oficina reunión sala manual informe agenda equipo correo impresora "
+                "office meeting room handbook report agenda team email printer"),
+}
+FILLER = "el la de que y en los para con por una the and of to in for with on is".split()
+
+# Longitud de un chunk nuevo con la configuración por defecto (CHUNK_SIZE - CHUNK_OVERLAP)
+CHARS_PER_CHUNK = 800
+# Páginas de los PDF generados y archivos por petición de /ingest (acepta entre 3 y 10)
+PDF_PAGE_CHARS = 2400
+FILES_PER_INGEST = (3, 10)
+
+def _topic_words(topic: str) -> List[str]:
+    return TOPICS[topic].split()
+
+def generate_text(rng: random.Random, topic: str, n_chars: int) -> str:
+    """Text of about n_chars characters: mostly one topic's words, some filler and other topics"""
+    own = _topic_words(topic)
+    other = [word for name in TOPICS if name != topic for word in _topic_words(name)]
+    words = []
+    length = 0
+    while length < n_chars:
+        roll = rng.random()
+        word = rng.choice(own if roll < 0.55 else FILLER if roll < 0.9 else other)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def pdf_bytes(pages: List[str]) -> bytes:
+    """Minimal PDF (Helvetica, one text object per page) with the given page texts"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i, page in enumerate(pages):
+        lines = [page[start:start + 90] for start in range(0, len(page), 90)]
+        stream = "BT /F1 8 Tf 20 800 Td 10 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode()
+        )
+        encoded = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(encoded) + encoded + b"\nendstream")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+def generate_corpus(n_chunks: int, file_format: str, seed: int) -> List[Tuple[str, bytes, str]]:
+    """(filename, content, media type) files totalling about n_chunks chunks"""
+    rng = random.Random(seed)
+    n_files = min(max(FILES_PER_INGEST[0], -(-n_chunks // 2000)), FILES_PER_INGEST[1])
+    per_file = max(1, n_chunks // n_files)
+    topics = list(TOPICS)
+    files = []
+    for i in range(n_files):
+        topic = topics[i % len(topics)]
+        chunks = per_file + (n_chunks - per_file * n_files if i == n_files - 1 else 0)
+        is_pdf = file_format == 'pdf' or (file_format == 'mixed' and i % 2)
+        if is_pdf:
+            n_pages = max(1, -(-chunks * CHARS_PER_CHUNK // PDF_PAGE_CHARS))
+            pages = [generate_text(rng, topic, PDF_PAGE_CHARS - 200) for _ in range(n_pages)]
+            files.append((f"bench_{i}_{topic}.pdf", pdf_bytes(pages), "application/pdf"))
+        else:
+            content = generate_text(rng, topic, chunks * CHARS_PER_CHUNK - 200)
+            files.append((f"bench_{i}_{topic}.txt", content.encode('utf-8'), "text/plain"))
+    return files
+
+def generate_queries(n: int, seed: int) -> List[str]:
+    """Two- or three-word queries on one topic, mixing languages"""
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(n):
+        words = _topic_words(rng.choice(list(TOPICS)))
+        queries.append(" ".join(rng.sample(words, rng.choice((2, 3)))))
+    return queries
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubModel:
+    """Stand-in for genai.GenerativeModel answering after a fixed delay plus a per-token cost"""
+    latency_seconds = 0.0
+    seconds_per_1k_tokens = 0.0
+    # Tokens estimados de cada prompt recibido
+    prompt_tokens: List[int] = []
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def _delay(self, prompt: str) -> float:
+        from gemini_service import estimate_tokens
+        tokens = estimate_tokens(prompt)
+        StubModel.prompt_tokens.append(tokens)
+        return self.latency_seconds + tokens / 1000 * self.seconds_per_1k_tokens
+
+    def generate_content(self, prompt: str, **kwargs) -> StubResponse:
+        time.sleep(self._delay(prompt))
+        return StubResponse("Respuesta de prueba [Fuente: benchmark.txt]")
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        import asyncio
+        await asyncio.sleep(self._delay(prompt))
+
+        async def chunks():
+            for part in ("Respuesta ", "de prueba ", "[Fuente: benchmark.txt]"):
+                yield StubResponse(part)
+        return chunks()
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p99/mean of latencies in seconds, in milliseconds"""
+    if not samples:
+        return {"p50_ms": 0.0, "p99_ms": 0.0, "mean_ms": 0.0}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+    return {"p50_ms": round(at(0.5), 3), "p99_ms": round(at(0.99), 3), "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3)}
+
+def _directory_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def run_one(args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark one corpus size; must run in a process whose DATA_DIR is empty"""
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    from fastapi.testclient import TestClient
+    import main
+    import gemini_service
+    from config import CHUNK_SIZE, CHUNK_OVERLAP, INDEX_FEATURES, SESSION_DIR
+    from session_manager import clear_session_cache, get_session
+    from search_engine import measure_dense_recall
+    from worker_pool import get_process_pool
+    from config import INGEST_WORKERS
+
+    StubModel.latency_seconds = args.llm_latency_ms / 1000
+    StubModel.seconds_per_1k_tokens = args.llm_ms_per_1k_tokens / 1000
+    gemini_service.set_model_factory(StubModel)
+    files = generate_corpus(args.chunks, args.format, args.seed)
+    queries = generate_queries(args.queries, args.seed)
+    result: Dict[str, Any] = {"chunks_requested": args.chunks, "format": args.format, "engine": args.engine}
+
+    with TestClient(main.app) as client:
+        # Arranque del pool de ingesta (forkserver e importaciones de los workers), medido
+        # aparte para que no cuente en la ingesta: una tarea breve por worker los crea todos
+        start = time.perf_counter()
+        list(get_process_pool().map(time.sleep, [0.1] * INGEST_WORKERS))
+        pool_start_seconds = max(0.0, time.perf_counter() - start - 0.1)
+
+        # Ingesta: desde la subida hasta que el trabajo termina
+        start = time.perf_counter()
+        response = client.post(
+            "/ingest", params={"engine": args.engine},
+            files=[("files", (name, content, media_type)) for name, content, media_type in files]
+        )
+        response.raise_for_status()
+        job_id, session_id = response.json()["job_id"], response.json()["session_id"]
+        while True:
+            job = client.get(f"/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.02)
+        ingest_seconds = time.perf_counter() - start
+        if job["status"] != "succeeded":
+            raise RuntimeError(f"La ingesta terminó con estado {job['status']}: {job.get('error')}")
+        n_chunks = sum(item["chunks_count"] for item in job["result"]["processed_files"])
+        n_bytes = sum(len(content) for _, content, _ in files)
+        result["chunks"] = n_chunks
+        result["ingest"] = {
+            "files": len(files),
+            "bytes": n_bytes,
+            "seconds": round(ingest_seconds, 4),
+            "chunks_per_second": round(n_chunks / ingest_seconds, 1),
+            "mb_per_second": round(n_bytes / ingest_seconds / 2 ** 20, 3),
+            "pool_start_seconds": round(pool_start_seconds, 3)
+        }
+
+        # Sesión en disco y carga en frío (sin la copia residente)
+        clear_session_cache()
+        start = time.perf_counter()
+        db = get_session(session_id)
+        load_seconds = time.perf_counter() - start
+        result["session"] = {
+            "disk_bytes": _directory_bytes(os.path.join(SESSION_DIR, session_id)),
+            "load_ms": round(load_seconds * 1000, 3)
+        }
+
+        # Búsqueda: latencia HTTP de consultas secuenciales (la caché de resultados solo acierta en repeticiones)
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            client.get("/search", params={"q": query, "session_id": session_id}).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        result["search"] = {"queries": len(queries), "distinct_queries": len(set(queries)), **percentiles(latencies)}
+        if args.engine == 'lsa':
+            result["search"]["recall_at_5"] = round(measure_dense_recall(queries[:100], db, 5), 4)
+
+        # /ask concurrente con el modelo simulado; cada pregunta es distinta para no acertar en la caché de respuestas
+        def ask(i: int) -> float:
+            started = time.perf_counter()
+            client.post("/ask", json={"question": f"{queries[i % len(queries)]} #{i}", "session_id": session_id}).raise_for_status()
+            return time.perf_counter() - started
+        packing_before = client.get("/status").json()["context_packing"]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.ask_concurrency) as pool:
+            ask_latencies = list(pool.map(ask, range(args.asks)))
+        ask_seconds = time.perf_counter() - start
+        packing = client.get("/status").json()["context_packing"]
+        packed_requests = max(1, packing["requests"] - packing_before["requests"])
+        prompt_tokens = StubModel.prompt_tokens
+        result["ask"] = {
+            "requests": args.asks,
+            "concurrency": args.ask_concurrency,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_ms_per_1k_tokens": args.llm_ms_per_1k_tokens,
+            "requests_per_second": round(args.asks / ask_seconds, 2),
+            **percentiles(ask_latencies),
+            # Tamaño estimado del prompt, tokens que la fusión de fragmentos ahorra por petición
+            # y fragmentos que el presupuesto de tokens deja fuera
+            "prompt_tokens_mean": round(sum(prompt_tokens) / len(prompt_tokens), 1) if prompt_tokens else 0,
+            "tokens_saved_per_request": round((packing["merge_saved_tokens"] - packing_before["merge_saved_tokens"]) / packed_requests, 1),
+            "dropped_fragments_per_request": round((packing["dropped_fragments"] - packing_before["dropped_fragments"]) / packed_requests, 2)
+        }
+
+    result["memory"] = {
+        # ru_maxrss está en KiB en Linux; los hijos son los procesos del pool de ingesta
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children_max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    }
+    result["config"] = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "index_features": INDEX_FEATURES}
+    return result
+
+# Métricas comparadas con --compare: (sección, campo, True si más alto es mejor)
+COMPARED = (
+    ("ingest", "chunks_per_second", True),
+    ("search", "p50_ms", False),
+    ("search", "p99_ms", False),
+    ("session", "load_ms", False),
+    ("session", "disk_bytes", False),
+    ("ask", "requests_per_second", True),
+    ("ask", "p50_ms", False),
+    ("ask", "prompt_tokens_mean", False),
+    ("memory", "max_rss_mb", False),
+)
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[str]:
+    """Report each compared metric against a baseline run; returns the regressions"""
+    regressions = []
+    previous = {(run["chunks_requested"], run["format"], run["engine"]): run for run in baseline["runs"]}
+    for run in current["runs"]:
+        key = (run["chunks_requested"], run["format"], run["engine"])
+        if key not in previous:
+            continue
+        for section, field, higher_is_better in COMPARED:
+            # Las métricas añadidas después de la referencia no se comparan
+            before, after = previous[key][section].get(field), run[section].get(field)
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "REGRESIÓN" if worse > tolerance else ""
+            print(f"{key[0]:>7} chunks {section}.{field}: {before} -> {after} ({change:+.1%}) {flag}")
+            if flag:
+                regressions.append(f"{key} {section}.{field}")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", default="10,1000,10000", help="Tamaños del corpus en chunks, separados por comas (10 a 100000)")
+    parser.add_argument("--format", choices=("txt", "pdf", "mixed"), default="mixed")
+    parser.add_argument("--engine", choices=("tfidf", "bm25", "lsa"), default="tfidf")
+    parser.add_argument("--queries", type=int, default=200, help="Consultas de /search por tamaño")
+    parser.add_argument("--asks", type=int, default=64, help="Peticiones /ask por tamaño")
+    parser.add_argument("--ask-concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="Latencia fija del modelo simulado")
+    parser.add_argument("--llm-ms-per-1k-tokens", type=float, default=20.0, help="Latencia añadida por cada 1000 tokens del prompt")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Archivo JSON con los resultados")
+    parser.add_argument("--compare", help="Resultados JSON de referencia con los que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Empeoramiento relativo que cuenta como regresión")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        args.chunks = int(args.chunks)
+        print(json.dumps(run_one(args)))
+        return
+
+    runs = []
+    for size in [int(value) for value in args.chunks.split(",")]:
+        command = [sys.executable, os.path.abspath(__file__), "--run-one", "--chunks", str(size)] + [
+            option for name in ("format", "engine", "queries", "asks", "ask_concurrency", "llm_latency_ms", "llm_ms_per_1k_tokens", "seed")
+            for option in (f"--{name.replace('_', '-')}", str(getattr(args, name)))
+        ]
+        with tempfile.TemporaryDirectory(prefix="rag-bench-") as data_dir:
+            env = {**os.environ, "DATA_DIR": data_dir, "SERVER_TIMING": "0"}
+            print(f"Benchmark con {size} chunks ({args.format}, {args.engine})...", file=sys.stderr)
+            completed = subprocess.run(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            sys.exit(completed.returncode)
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        runs.append(run)
+        print(json.dumps(run, indent=2), file=sys.stderr)
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "runs": runs
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultados guardados en {args.output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"Regresiones: {len(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,112 @@
+import os
+import time
+import hashlib
+import tempfile
+from typing import Tuple, Optional, Set
+from fastapi import UploadFile
+from config import BLOB_DIR, UPLOAD_CHUNK_SIZE, BLOB_GRACE_SECONDS
+from metrics import timed, inc
+
+def blob_path(content_hash: str) -> str:
+    """Get the on-disk path of a blob"""
+    return os.path.join(BLOB_DIR, content_hash[:2], content_hash)
+
+def blob_exists(content_hash: str) -> bool:
+    """Check whether a blob is stored"""
+    return os.path.exists(blob_path(content_hash))
+
+def _publish(tmp_path: str, content_hash: str) -> str:
+    """Move a fully written temp file to its content address"""
+    path = blob_path(content_hash)
+    if os.path.exists(path):
+        # Mismo contenido ya almacenado: se descarta la copia temporal y se renueva
+        # la fecha del blob para que la limpieza no lo borre antes de indexarlo
+        os.remove(tmp_path)
+        os.utime(path)
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return path
+
+async def store_upload(file: UploadFile) -> Tuple[str, int]:
+    """Stream an upload to the blob store, returning its SHA-256 and size"""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix='.part')
+    try:
+        with timed('upload_read'), os.fdopen(fd, 'wb') as out:
+            while True:
+                data = await file.read(UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                out.write(data)
+                size += len(data)
+        inc('rag_upload_bytes_total', size)
+        content_hash = digest.hexdigest()
+        _publish(tmp_path, content_hash)
+        return content_hash, size
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def store_bytes(content: bytes) -> str:
+    """Store in-memory content in the blob store, returning its SHA-256"""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    content_hash = hashlib.sha256(content).hexdigest()
+    if blob_exists(content_hash):
+        return content_hash
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        out.write(content)
+    _publish(tmp_path, content_hash)
+    return content_hash
+
+def sweep_unreferenced_blobs(referenced: Set[str]) -> int:
+    """Delete blobs not in referenced and untouched for BLOB_GRACE_SECONDS.
+
+    The grace period covers uploads whose ingestion has not published a
+    session yet, as well as leftover '.part' files of interrupted uploads.
+    """
+    if not os.path.isdir(BLOB_DIR):
+        return 0
+    now = time.time()
+    removed = 0
+    for root, _, names in os.walk(BLOB_DIR):
+        for name in names:
+            if name in referenced:
+                continue
+            path = os.path.join(root, name)
+            try:
+                if now - os.path.getmtime(path) < BLOB_GRACE_SECONDS:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+    if removed:
+        print(f"Archivos subidos sin referencias eliminados: {removed}")
+    return removed
+
+def parse_byte_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single 'bytes=start-end' range into inclusive offsets (None if unsatisfiable)"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # Rango de sufijo: los últimos N bytes
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
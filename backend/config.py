@@ -7,8 +7,29 @@ try:
 except ImportError:
     pass  # python-dotenv not installed, continue without it
 
+# Directory holding the database, sessions, blobs and document cache
+DATA_DIR = os.getenv("DATA_DIR", os.path.dirname(__file__))
+
 # Database configuration
-DB_PATH = os.path.join(os.path.dirname(__file__), 'app.db')
+DB_PATH = os.path.join(DATA_DIR, 'app.db')
+# SQLite connection pool (WAL mode) and page size limit for chat/message listings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_KIB = 16 * 1024
+MAX_PAGE_SIZE = 500
+
+# Write-behind message logging: queued inserts are committed together every
+# MESSAGE_FLUSH_INTERVAL_MS. Durability: "full" waits for the commit and fsyncs
+# it, "normal" waits for the commit (WAL, fsync at checkpoints), "async" returns
+# before the commit
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "normal")
+if MESSAGE_DURABILITY not in ("full", "normal", "async"):
+    raise ValueError(f"MESSAGE_DURABILITY inválido: {MESSAGE_DURABILITY}")
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", 10))
+MAX_MESSAGE_BATCH = 100
+
+# Session index storage (one directory per session, memory-mapped on load)
+SESSION_DIR = os.path.join(DATA_DIR, 'sessions')
 
 # API configuration
 def get_google_api_key():
@@ -46,3 +67,96 @@ CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 TOP_K_RESULTS = 5
 SIMILARITY_THRESHOLD = 0.1
+CITATION_SNIPPET_CHARS = 200
+MAX_BATCH_QUERIES = 256
+QUERY_CACHE_SIZE = 2048
+
+# TF-IDF feature space: "vocabulary" (fitted term dictionary, float64) or
+# "hashed" (fixed number of hashed columns per space, float32, no vocabulary
+# to build, store or load). Hashed features present in fewer than
+# HASHED_MIN_DF chunks are dropped (1 keeps them all)
+INDEX_FEATURES = os.getenv("INDEX_FEATURES", "vocabulary")
+if INDEX_FEATURES not in ("vocabulary", "hashed"):
+    raise ValueError(f"INDEX_FEATURES inválido: {INDEX_FEATURES}")
+HASHED_FEATURES = {'word': 2 ** 19, 'char': 2 ** 19}
+HASHED_MIN_DF = int(os.getenv("HASHED_MIN_DF", 1))
+
+# Retrieval engine of new sessions unless /ingest picks one: "tfidf" (hybrid
+# word+char cosine), "bm25" (inverted index with block-max pruning; scores are
+# not bounded by 1, so thresholds compare against BM25 scores) or "lsa" (dense
+# approximate candidates re-ranked with the tfidf score)
+DEFAULT_SEARCH_ENGINE = os.getenv("SEARCH_ENGINE", "tfidf")
+if DEFAULT_SEARCH_ENGINE not in ("tfidf", "bm25", "lsa"):
+    raise ValueError(f"SEARCH_ENGINE inválido: {DEFAULT_SEARCH_ENGINE}")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Chunks per block of the BM25 index; each block keeps the maximum weight of
+# every term so whole blocks can be skipped
+BM25_BLOCK_SIZE = 512
+
+# Dense "lsa" engine: TruncatedSVD of the weighted TF-IDF rows (restricted to
+# the most frequent columns of each space, fitted on a sample of rows) stored
+# as float32 vectors in an IVF index of ~LSA_LIST_SIZE chunks per list. A query
+# probes LSA_NPROBE lists and re-ranks LSA_CANDIDATES chunks lexically
+LSA_COMPONENTS = 128
+LSA_FEATURES_PER_SPACE = 8192
+LSA_FIT_SAMPLE = 20000
+LSA_LIST_SIZE = 1024
+LSA_NPROBE = int(os.getenv("LSA_NPROBE", 16))
+LSA_CANDIDATES = int(os.getenv("LSA_CANDIDATES", 512))
+
+# LLM answers are cached per model, prompt template, retrieved fragments and question
+GEMINI_MODEL = 'gemini-2.5-flash'
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", 24 * 3600))
+# Characters per token used to estimate prompt sizes
+CHARS_PER_TOKEN = 4
+# Prompt context: overlapping or adjacent fragments of the same page are merged
+# and fragments are added by score until this many estimated tokens (0 = no
+# limit); the default fits TOP_K_RESULTS full chunks, so only merging shrinks it
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", TOP_K_RESULTS * CHUNK_SIZE // CHARS_PER_TOKEN))
+# Maximum number of /ask/stream responses generated at the same time
+ASK_STREAM_CONCURRENCY = int(os.getenv("ASK_STREAM_CONCURRENCY", 16))
+
+# Incremental indexing: refresh IDF once the chunks added/removed since the last
+# refresh exceed this fraction of the session
+IDF_REFRESH_RATIO = 0.2
+
+# Ingestion pipeline: worker processes for extraction/chunking/fitting and the
+# number of PDF pages handled by each extraction task (0 = one task per file)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = 50
+# Pages being extracted or waiting to be written at any time, across all the
+# documents being ingested (bounds ingestion memory regardless of length or uploads)
+INGEST_WINDOW_PAGES = int(os.getenv("INGEST_WINDOW_PAGES", 400))
+
+# Ingestion jobs: jobs running at once, running jobs per tenant (X-Tenant-Id
+# header, else client address) and queued+running jobs accepted before 429
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", 2))
+INGEST_JOBS_PER_TENANT = int(os.getenv("INGEST_JOBS_PER_TENANT", 1))
+INGEST_QUEUE_LIMIT = int(os.getenv("INGEST_QUEUE_LIMIT", 32))
+# Minimum time between job progress updates (and cancellation checks) in the database
+JOB_PROGRESS_INTERVAL_SECONDS = 1.0
+
+# Content-addressed storage for uploaded files (blobs named by SHA-256)
+BLOB_DIR = os.path.join(DATA_DIR, 'blobs')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Blobs no session references are deleted once untouched for this long
+BLOB_GRACE_SECONDS = 3600
+
+# Cross-session cache of extracted pages and chunk offsets, keyed by file hash
+# and chunking config; unreferenced entries are kept for a grace period
+DOC_CACHE_DIR = os.path.join(DATA_DIR, 'doc_cache')
+DOC_CACHE_GRACE_SECONDS = 3600
+
+# Per-stage latency metrics are served from /metrics; SERVER_TIMING=1 also
+# reports the stages of each request in a Server-Timing response header
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+# Session cache: memory budget for resident sessions (LRU eviction) and idle
+# time after which a session is deleted from disk (0 disables the sweeper)
+SESSION_CACHE_BYTES = int(os.getenv("SESSION_CACHE_BYTES", 1024 * 1024 * 1024))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 30 * 24 * 3600))
+SESSION_SWEEP_INTERVAL_SECONDS = 3600
+# Sessions preloaded in the background at startup, most recently used chats
+# first (0 disables it; scikit-learn and the Gemini client are preloaded anyway)
+SESSION_WARMUP_COUNT = int(os.getenv("SESSION_WARMUP_COUNT", 8))
@@ -1,80 +1,457 @@
+import json
+import time
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Any, List
-from config import DB_PATH
+from typing import Dict, Any, List, Optional, Iterator, Tuple, Callable
+from config import DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_CACHE_KIB, MESSAGE_DURABILITY, MESSAGE_FLUSH_INTERVAL_MS
+from metrics import timed
 
-def db_connect():
-    conn = sqlite3.connect(DB_PATH)
+# Conexiones reutilizables; se crean bajo demanda hasta DB_POOL_SIZE
+_POOL: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL permite lecturas concurrentes con una escritura; NORMAL solo hace fsync en los checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL" if MESSAGE_DURABILITY == "full" else "PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+@contextmanager
+def db_connect() -> Iterator[sqlite3.Connection]:
+    """Borrow a pooled connection; commits on success and rolls back on error"""
+    try:
+        conn = _POOL.get_nowait()
+    except queue.Empty:
+        conn = _open_connection()
+    try:
+        with timed('sqlite'):
+            yield conn
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            _POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_pool():
+    """Close every idle pooled connection"""
+    while True:
+        try:
+            _POOL.get_nowait().close()
+        except queue.Empty:
+            return
+
+# Migraciones del esquema, en orden; PRAGMA user_version guarda cuántas se han aplicado
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            session_id TEXT NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            text TEXT NOT NULL,
+            payload_json TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        );
+        """
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            cache_key TEXT PRIMARY KEY,
+            answer TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_answer_cache_expires ON answer_cache(expires_at)"
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_session_id ON chats(session_id)"
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS document_refs (
+            document_key TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            PRIMARY KEY (document_key, session_id)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_document_refs_session ON document_refs(session_id)"
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            tenant TEXT NOT NULL,
+            session_id TEXT,
+            status TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            progress_json TEXT,
+            result_json TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            worker_pid INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)"
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        """
+    ],
+]
+
 def initialize_database():
-    """Initialize database tables"""
+    """Initialize database tables, applying pending schema migrations"""
     with db_connect() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                session_id TEXT NOT NULL
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                sender TEXT NOT NULL,
-                text TEXT NOT NULL,
-                payload_json TEXT,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE
-            );
-            """
-        )
-        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={number}")
+            print(f"Migración de base de datos {number} aplicada.")
 
 def row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
     return {k: row[k] for k in row.keys()}
 
 # Chat operations
-def list_chats() -> List[Dict[str, Any]]:
+def list_chats(limit: Optional[int] = None, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Chats newest first; with limit, one keyset page of chats older than before_id"""
+    sql = "SELECT id, title, created_at, session_id FROM chats"
+    params: list = []
+    if before_id is not None:
+        sql += " WHERE id<?"
+        params.append(before_id)
+    sql += " ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
     with db_connect() as conn:
-        rows = conn.execute("SELECT id, title, created_at, session_id FROM chats ORDER BY id DESC").fetchall()
+        rows = conn.execute(sql, params).fetchall()
         return [row_to_dict(r) for r in rows]
 
+def recent_session_ids(limit: int) -> List[str]:
+    """Sessions of the most recently active chats (last message, else creation)"""
+    with db_connect() as conn:
+        rows = conn.execute(
+            """
+            SELECT session_id, MAX(COALESCE(
+                (SELECT created_at FROM messages WHERE chat_id=chats.id ORDER BY id DESC LIMIT 1), created_at
+            )) AS last_active
+            FROM chats GROUP BY session_id ORDER BY last_active DESC LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+        return [row["session_id"] for row in rows]
+
 def create_chat(title: str, session_id: str) -> Dict[str, Any]:
     created_at = datetime.utcnow().isoformat()
     with db_connect() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO chats(title, created_at, session_id) VALUES(?,?,?)", (title, created_at, session_id))
         chat_id = cur.lastrowid
-        conn.commit()
         return {"id": chat_id, "title": title, "created_at": created_at, "session_id": session_id}
 
 def delete_chat(chat_id: int) -> Dict[str, str]:
     with db_connect() as conn:
         conn.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
         conn.execute("DELETE FROM chats WHERE id=?", (chat_id,))
-        conn.commit()
     return {"status": "deleted"}
 
 # Message operations
-def list_messages(chat_id: int) -> List[Dict[str, Any]]:
+def _message_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    message = row_to_dict(row)
+    if message["payload_json"] is not None:
+        message["payload_json"] = json.loads(message["payload_json"])
+    return message
+
+def list_messages(chat_id: int, limit: Optional[int] = None, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """A chat's messages in order; with limit, only the latest ones before before_id.
+
+    Pages are selected by id (keyset) so each one is an index range scan on
+    messages(chat_id, id), however long the chat is.
+    """
+    sql = "SELECT id, chat_id, sender, text, payload_json, created_at FROM messages WHERE chat_id=?"
+    params: list = [chat_id]
+    if before_id is not None:
+        sql += " AND id<?"
+        params.append(before_id)
+    if limit is None:
+        sql += " ORDER BY id ASC"
+    else:
+        sql = f"SELECT * FROM ({sql} ORDER BY id DESC LIMIT ?) ORDER BY id ASC"
+        params.append(limit)
+    if MESSAGE_DURABILITY == "async":
+        # Leer lo propio: los mensajes encolados se escriben antes de listar
+        flush_messages()
     with db_connect() as conn:
-        rows = conn.execute("SELECT id, chat_id, sender, text, payload_json, created_at FROM messages WHERE chat_id=? ORDER BY id ASC", (chat_id,)).fetchall()
-        return [row_to_dict(r) for r in rows]
+        rows = conn.execute(sql, params).fetchall()
+        return [_message_to_dict(r) for r in rows]
 
-def add_message(chat_id: int, sender: str, text: str, payload_json: Dict[str, Any] = None) -> Dict[str, Any]:
-    import json
+# Escritura diferida de mensajes: un hilo agrupa las inserciones pendientes en
+# una sola transacción cada MESSAGE_FLUSH_INTERVAL_MS, de modo que el coste del
+# commit (fsync) se reparte entre todos los mensajes del grupo
+_MESSAGE_QUEUE: "queue.Queue[Tuple[Optional[int], List[Dict[str, Any]], Future]]" = queue.Queue()
+_WRITER_LOCK = threading.Lock()
+_WRITER: Optional[threading.Thread] = None
+_WRITER_STATS = {"messages": 0, "transactions": 0}
+
+def _insert_messages(conn: sqlite3.Connection, chat_id: int, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    saved = []
+    for msg in messages:
+        payload_str = json.dumps(msg["payload_json"]) if msg["payload_json"] is not None else None
+        cur = conn.execute(
+            "INSERT INTO messages(chat_id, sender, text, payload_json, created_at) VALUES(?,?,?,?,?)",
+            (chat_id, msg["sender"], msg["text"], payload_str, msg["created_at"])
+        )
+        saved.append({"id": cur.lastrowid, "chat_id": chat_id, **msg})
+    return saved
+
+def _write_group(group: List[Tuple[Optional[int], List[Dict[str, Any]], Future]]):
+    """Insert a group of queued batches in one transaction"""
+    batches = [item for item in group if item[0] is not None]
+    if batches:
+        try:
+            with db_connect() as conn:
+                results = [_insert_messages(conn, chat_id, messages) for chat_id, messages, _ in batches]
+            _WRITER_STATS["transactions"] += 1
+            for (_, messages, future), saved in zip(batches, results):
+                _WRITER_STATS["messages"] += len(messages)
+                future.set_result(saved)
+        except Exception:
+            # Un lote inválido (p. ej. chat inexistente) no debe hacer fallar a los demás
+            for chat_id, messages, future in batches:
+                try:
+                    with db_connect() as conn:
+                        saved = _insert_messages(conn, chat_id, messages)
+                    _WRITER_STATS["transactions"] += 1
+                    _WRITER_STATS["messages"] += len(messages)
+                    future.set_result(saved)
+                except Exception as e:
+                    print(f"Error guardando mensajes del chat {chat_id}: {e}")
+                    future.set_exception(e)
+    # Marcadores de flush_messages(): todo lo encolado antes ya está escrito
+    for chat_id, _, future in group:
+        if chat_id is None:
+            future.set_result([])
+
+def _run_writer():
+    interval = MESSAGE_FLUSH_INTERVAL_MS / 1000
+    while True:
+        group = [_MESSAGE_QUEUE.get()]
+        deadline = time.monotonic() + interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(_MESSAGE_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_group(group)
+
+def _enqueue(chat_id: Optional[int], messages: List[Dict[str, Any]]) -> Future:
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = threading.Thread(target=_run_writer, name="message-writer", daemon=True)
+            _WRITER.start()
+    future: Future = Future()
+    _MESSAGE_QUEUE.put((chat_id, messages, future))
+    return future
+
+def flush_messages(timeout: Optional[float] = None):
+    """Block until every message queued so far has been written"""
+    if _WRITER is None:
+        return
+    _enqueue(None, []).result(timeout)
+
+def message_writer_stats() -> Dict[str, Any]:
+    """Write-behind counters for /status"""
+    return {**_WRITER_STATS, "pending": _MESSAGE_QUEUE.qsize(), "durability": MESSAGE_DURABILITY}
+
+def add_messages(chat_id: int, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Queue several messages for one chat, written together in a single transaction.
+
+    With MESSAGE_DURABILITY "full" or "normal" this returns once the group
+    holding them is committed; with "async" it returns at once and ids are
+    not known yet.
+    """
     created_at = datetime.utcnow().isoformat()
-    payload_str = json.dumps(payload_json) if payload_json is not None else None
+    rows = [{
+        "sender": msg["sender"],
+        "text": msg["text"],
+        "payload_json": msg.get("payload_json"),
+        "created_at": created_at
+    } for msg in messages]
+    future = _enqueue(chat_id, rows)
+    if MESSAGE_DURABILITY == "async":
+        return [{"id": None, "chat_id": chat_id, **row} for row in rows]
+    return future.result()
+
+def add_message(chat_id: int, sender: str, text: str, payload_json: Dict[str, Any] = None) -> Dict[str, Any]:
+    return add_messages(chat_id, [{"sender": sender, "text": text, "payload_json": payload_json}])[0]
+
+# Answer cache operations
+def get_cached_answer(cache_key: str) -> Optional[str]:
     with db_connect() as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO messages(chat_id, sender, text, payload_json, created_at) VALUES(?,?,?,?,?)", (chat_id, sender, text, payload_str, created_at))
-        msg_id = cur.lastrowid
-        conn.commit()
-        return {"id": msg_id, "chat_id": chat_id, "sender": sender, "text": text, "payload_json": payload_json, "created_at": created_at}
+        row = conn.execute("SELECT answer FROM answer_cache WHERE cache_key=? AND expires_at>?", (cache_key, time.time())).fetchone()
+        return row["answer"] if row else None
+
+def put_cached_answer(cache_key: str, answer: str, ttl_seconds: int):
+    now = time.time()
+    with db_connect() as conn:
+        conn.execute("DELETE FROM answer_cache WHERE expires_at<=?", (now,))
+        conn.execute(
+            "INSERT OR REPLACE INTO answer_cache(cache_key, answer, created_at, expires_at) VALUES(?,?,?,?)",
+            (cache_key, answer, datetime.utcnow().isoformat(), now + ttl_seconds)
+        )
+
+# Document cache references (one row per session using a cached document)
+def _unreferenced(conn: sqlite3.Connection, keys: List[str]) -> List[str]:
+    return [key for key in keys if conn.execute("SELECT 1 FROM document_refs WHERE document_key=? LIMIT 1", (key,)).fetchone() is None]
+
+def set_session_documents(session_id: str, document_keys: List[str]) -> List[str]:
+    """Replace a session's document references, returning released keys no session uses anymore"""
+    with db_connect() as conn:
+        current = {row["document_key"] for row in conn.execute("SELECT document_key FROM document_refs WHERE session_id=?", (session_id,))}
+        wanted = set(document_keys)
+        released = list(current - wanted)
+        conn.executemany("DELETE FROM document_refs WHERE document_key=? AND session_id=?", [(key, session_id) for key in released])
+        conn.executemany("INSERT OR IGNORE INTO document_refs(document_key, session_id) VALUES(?,?)", [(key, session_id) for key in wanted - current])
+        return _unreferenced(conn, released)
+
+def release_session_documents(session_id: str) -> List[str]:
+    """Drop every reference held by a session, returning keys no session uses anymore"""
+    return set_session_documents(session_id, [])
+
+def referenced_document_keys() -> set:
+    with db_connect() as conn:
+        return {row["document_key"] for row in conn.execute("SELECT DISTINCT document_key FROM document_refs")}
+
+# Ingestion jobs
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+def _job_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    job = row_to_dict(row)
+    job["progress"] = json.loads(job.pop("progress_json") or "{}")
+    job["result"] = json.loads(job.pop("result_json") or "null")
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+def create_job(job_id: str, kind: str, tenant: str, session_id: Optional[str], worker_pid: int) -> Dict[str, Any]:
+    now = datetime.utcnow().isoformat()
+    with db_connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs(id, kind, tenant, session_id, status, stage, worker_pid, created_at, updated_at) VALUES(?,?,?,?,?,?,?,?,?)",
+            (job_id, kind, tenant, session_id, "queued", "queued", worker_pid, now, now)
+        )
+    return get_job(job_id)
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with db_connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return _job_to_dict(row) if row else None
+
+def update_job(job_id: str, status: Optional[str] = None, stage: Optional[str] = None, progress: Optional[Dict[str, Any]] = None,
+               result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+    fields = {"status": status, "stage": stage, "error": error,
+              "progress_json": json.dumps(progress) if progress is not None else None,
+              "result_json": json.dumps(result) if result is not None else None}
+    fields = {k: v for k, v in fields.items() if v is not None}
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    with db_connect() as conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?", (*fields.values(), job_id))
+
+def request_job_cancel(job_id: str) -> bool:
+    """Flag an active job for cancellation; False if it already finished"""
+    with db_connect() as conn:
+        cur = conn.execute(
+            f"UPDATE jobs SET cancel_requested=1, updated_at=? WHERE id=? AND status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))})",
+            (datetime.utcnow().isoformat(), job_id, *JOB_ACTIVE_STATUSES)
+        )
+        return cur.rowcount > 0
+
+def is_job_cancel_requested(job_id: str) -> bool:
+    with db_connect() as conn:
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+def count_active_jobs(tenant: Optional[str] = None) -> int:
+    sql = f"SELECT COUNT(*) FROM jobs WHERE status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))})"
+    params: list = list(JOB_ACTIVE_STATUSES)
+    if tenant is not None:
+        sql += " AND tenant=?"
+        params.append(tenant)
+    with db_connect() as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+def list_active_jobs() -> List[Dict[str, Any]]:
+    with db_connect() as conn:
+        rows = conn.execute(f"SELECT * FROM jobs WHERE status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))})", JOB_ACTIVE_STATUSES).fetchall()
+        return [_job_to_dict(r) for r in rows]
+
+# Session registry (published version of each session, shared by every worker)
+def get_session_version(session_id: str) -> Optional[int]:
+    """Published version of a session, or None if it is not registered"""
+    with db_connect() as conn:
+        row = conn.execute("SELECT version FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+        return row["version"] if row else None
+
+def publish_session_version(session_id: str, expected_version: Optional[int], install: Callable[[int], None]) -> Optional[int]:
+    """Register the next version of a session, returning it (None if it no longer is expected_version).
+
+    install(version) puts the new files in place; it runs while the registry
+    row is locked, so concurrent publishers are serialized and the new
+    version becomes visible only once its files exist.
+    """
+    with db_connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT version FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+        current = row["version"] if row else 0
+        if expected_version is not None and current != expected_version:
+            return None
+        version = current + 1
+        install(version)
+        conn.execute(
+            "INSERT INTO sessions(session_id, version, updated_at) VALUES(?,?,?) "
+            "ON CONFLICT(session_id) DO UPDATE SET version=excluded.version, updated_at=excluded.updated_at",
+            (session_id, version, datetime.utcnow().isoformat())
+        )
+        return version
+
+def delete_session_version(session_id: str):
+    with db_connect() as conn:
+        conn.execute("DELETE FROM sessions WHERE session_id=?", (session_id,))
@@ -0,0 +1,133 @@
+import numpy as np
+import scipy.sparse as sp
+from typing import Dict, Any, List
+from config import LSA_COMPONENTS, LSA_FEATURES_PER_SPACE, LSA_FIT_SAMPLE, LSA_LIST_SIZE, LSA_NPROBE
+
+# scikit-learn se importa en las funciones que lo usan (arranque rápido de la app)
+
+# Campos del índice denso de una sesión:
+# - lsa_<espacio>_columns: columnas TF-IDF (las más frecuentes) que entran en la proyección
+# - lsa_components: base LSA (componentes x columnas seleccionadas), float32
+# - lsa_vectors: vector LSA normalizado de cada chunk, agrupados por lista IVF
+# - lsa_list_rows: fila del índice de cada vector
+# - lsa_centroids / lsa_list_offsets: centroide e inicio de cada lista IVF
+DENSE_ARRAYS = ('lsa_components', 'lsa_vectors', 'lsa_list_rows', 'lsa_centroids', 'lsa_list_offsets')
+
+# Filas proyectadas o asignadas a la vez (acota la memoria temporal)
+_BATCH_ROWS = 65536
+
+def dense_fields(spaces: List[str]) -> List[str]:
+    """Every dense index field of a session with the given TF-IDF spaces"""
+    return [f'lsa_{space}_columns' for space in spaces] + list(DENSE_ARRAYS)
+
+def _select(db: Dict[str, Any], matrices: Dict[str, sp.csr_matrix]) -> sp.csr_matrix:
+    """Keep the projected columns of each space's (already weighted) rows, side by side"""
+    parts = []
+    for space, matrix in matrices.items():
+        # Las columnas añadidas después del ajuste (vocabulario que crece) quedan fuera
+        parts.append(matrix[:, db[f'lsa_{space}_columns']])
+    return sp.hstack(parts, format='csr')
+
+def _project(db: Dict[str, Any], matrices: Dict[str, sp.csr_matrix]) -> np.ndarray:
+    """Normalized float32 LSA vectors of the rows of matrices"""
+    from sklearn.preprocessing import normalize
+    components = db['lsa_components']
+    n_rows = next(iter(matrices.values())).shape[0]
+    vectors = np.empty((n_rows, components.shape[0]), dtype=np.float32)
+    for start in range(0, n_rows, _BATCH_ROWS):
+        batch = _select(db, {space: matrix[start:start + _BATCH_ROWS] for space, matrix in matrices.items()})
+        vectors[start:start + batch.shape[0]] = batch @ components.T
+    return normalize(vectors, copy=False)
+
+def _assign(db: Dict[str, Any], vectors: np.ndarray) -> np.ndarray:
+    """Nearest IVF list of each vector"""
+    centroids = db['lsa_centroids']
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _BATCH_ROWS):
+        lists[start:start + _BATCH_ROWS] = np.argmax(vectors[start:start + _BATCH_ROWS] @ centroids.T, axis=1)
+    return lists
+
+def _store_lists(db: Dict[str, Any], vectors: np.ndarray, rows: np.ndarray, lists: np.ndarray):
+    """Lay the vectors out list by list, so probing a list reads one contiguous slice"""
+    order = np.argsort(lists, kind='stable')
+    db['lsa_vectors'] = vectors[order]
+    db['lsa_list_rows'] = rows[order].astype(np.int32)
+    db['lsa_list_offsets'] = np.zeros(len(db['lsa_centroids']) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lists, minlength=len(db['lsa_centroids'])), out=db['lsa_list_offsets'][1:])
+
+def _position_lists(db: Dict[str, Any]) -> np.ndarray:
+    offsets = db['lsa_list_offsets']
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+
+def build_dense_index(db: Dict[str, Any], matrices: Dict[str, sp.csr_matrix]):
+    """Fit the LSA projection of the weighted TF-IDF rows and build the IVF lists.
+
+    The SVD is fitted on the LSA_FEATURES_PER_SPACE most frequent columns of
+    each space and on a sample of at most LSA_FIT_SAMPLE rows, so both the
+    stored basis and the fitting cost stay bounded as the session grows.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.preprocessing import normalize
+    n_rows = next(iter(matrices.values())).shape[0]
+    rng = np.random.default_rng(0)
+    for space, matrix in matrices.items():
+        df = np.bincount(matrix.indices, minlength=matrix.shape[1])
+        top = np.argsort(-df, kind='stable')[:LSA_FEATURES_PER_SPACE]
+        db[f'lsa_{space}_columns'] = np.sort(top[df[top] > 0]).astype(np.int32)
+    sample = np.sort(rng.choice(n_rows, LSA_FIT_SAMPLE, replace=False)) if n_rows > LSA_FIT_SAMPLE else slice(None)
+    selected = _select(db, {space: matrix[sample] for space, matrix in matrices.items()})
+    n_components = max(1, min(LSA_COMPONENTS, selected.shape[0] - 1, selected.shape[1] - 1))
+    svd = TruncatedSVD(n_components=n_components, algorithm='randomized', random_state=0)
+    svd.fit(selected)
+    db['lsa_components'] = svd.components_.astype(np.float32)
+    vectors = _project(db, matrices)
+
+    # IVF: listas de ~LSA_LIST_SIZE chunks; k-means sobre una muestra y asignación de todas las filas
+    n_lists = max(1, -(-n_rows // LSA_LIST_SIZE))
+    if n_lists == 1:
+        db['lsa_centroids'] = normalize(vectors.mean(axis=0, keepdims=True))
+    else:
+        train = vectors[rng.choice(n_rows, min(n_rows, 64 * n_lists), replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=max(1024, 4 * n_lists), n_init=1, random_state=0)
+        db['lsa_centroids'] = normalize(kmeans.fit(train).cluster_centers_.astype(np.float32))
+    _store_lists(db, vectors, np.arange(n_rows), _assign(db, vectors))
+
+def extend_dense_index(db: Dict[str, Any], matrices: Dict[str, sp.csr_matrix], first_row: int):
+    """Project appended rows with the current basis and add them to their nearest lists"""
+    vectors = _project(db, matrices)
+    rows = np.arange(first_row, first_row + len(vectors))
+    _store_lists(
+        db,
+        np.concatenate([db['lsa_vectors'], vectors]),
+        np.concatenate([db['lsa_list_rows'], rows]),
+        np.concatenate([_position_lists(db), _assign(db, vectors)])
+    )
+
+def drop_dense_rows(db: Dict[str, Any], start: int, stop: int):
+    """Remove index rows [start, stop) and shift the following ones (list order is kept)"""
+    rows = db['lsa_list_rows']
+    keep = (rows < start) | (rows >= stop)
+    lists = _position_lists(db)[keep]
+    rows = rows[keep]
+    db['lsa_vectors'] = db['lsa_vectors'][keep]
+    db['lsa_list_rows'] = np.where(rows >= stop, rows - (stop - start), rows).astype(np.int32)
+    db['lsa_list_offsets'] = np.zeros(len(db['lsa_centroids']) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lists, minlength=len(db['lsa_centroids'])), out=db['lsa_list_offsets'][1:])
+
+def dense_candidates(db: Dict[str, Any], matrices: Dict[str, sp.csr_matrix], n: int) -> np.ndarray:
+    """Index rows of the n chunks nearest to one query in LSA space, probing LSA_NPROBE lists"""
+    query = _project(db, matrices)[0]
+    centroids = db['lsa_centroids']
+    offsets = db['lsa_list_offsets']
+    probe = np.argsort(-(centroids @ query))[:LSA_NPROBE]
+    positions = [np.arange(offsets[l], offsets[l + 1]) for l in probe]
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    if not len(positions):
+        return positions
+    # Las listas sondeadas son tramos contiguos; se puntúan tramo a tramo
+    scores = np.concatenate([db['lsa_vectors'][offsets[l]:offsets[l + 1]] @ query for l in probe])
+    if len(scores) > n:
+        best = np.argpartition(scores, -n)[-n:]
+        positions = positions[best]
+    return np.asarray(db['lsa_list_rows'])[positions].astype(np.int64)
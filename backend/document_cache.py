@@ -0,0 +1,276 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from array import array
+from collections.abc import Sequence
+from typing import Dict, Any, List, Tuple, Iterable, Iterator, Optional
+from config import DOC_CACHE_DIR, DOC_CACHE_GRACE_SECONDS, CHUNK_SIZE, CHUNK_OVERLAP
+from database import set_session_documents, release_session_documents, referenced_document_keys
+
+# Se incrementa cuando cambia la extracción o el chunking, invalidando las entradas anteriores
+EXTRACTION_VERSION = 1
+ENTRY_FILE = 'entry.json'
+
+def document_key(content_hash: str, filename: str) -> str:
+    """Cache key of a document: file bytes, file type and chunking config"""
+    kind = os.path.splitext(filename)[1].lower()
+    return hashlib.sha256(f"{content_hash}|{kind}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{EXTRACTION_VERSION}".encode('utf-8')).hexdigest()
+
+def entry_path(key: str) -> str:
+    """Get the directory holding a cached document"""
+    return os.path.join(DOC_CACHE_DIR, key[:2], key)
+
+def chunk_offsets(length: int, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """(start, end) of each chunk of a page: windows of chunk_size characters, each starting chunk_size - overlap after the previous one"""
+    return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size - overlap)]
+
+def _map_bytes(path: str):
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CachedDocument:
+    """A cached document: page texts in one UTF-8 blob plus chunk offsets into them.
+
+    Chunk text is never stored; it is sliced out of its page when accessed.
+    """
+
+    def __init__(self, key: str, directory: str):
+        with open(os.path.join(directory, ENTRY_FILE), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.key = key
+        self._directory = directory
+        self.has_text = meta['has_text']
+        self._pages = _map_bytes(os.path.join(directory, 'pages.bin'))
+        self._page_offsets = np.load(os.path.join(directory, 'page_offsets.npy'), mmap_mode='r')
+        self.page_numbers = np.load(os.path.join(directory, 'page_numbers.npy'), mmap_mode='r')
+        self.chunk_page = np.load(os.path.join(directory, 'chunk_page.npy'), mmap_mode='r')
+        self.chunk_start = np.load(os.path.join(directory, 'chunk_start.npy'), mmap_mode='r')
+        self.chunk_end = np.load(os.path.join(directory, 'chunk_end.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.chunk_start)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._pages) + self._page_offsets.nbytes + 12 * len(self)
+
+    def page_text(self, page: int) -> str:
+        return self._pages[int(self._page_offsets[page]):int(self._page_offsets[page + 1])].decode('utf-8')
+
+    def chunk_text(self, i: int) -> str:
+        return self.page_text(int(self.chunk_page[i]))[int(self.chunk_start[i]):int(self.chunk_end[i])]
+
+    def iter_texts(self) -> Iterator[str]:
+        """All chunk texts in order, decoding each page once"""
+        page, page_text = -1, ''
+        for chunk_page, start, end in zip(self.chunk_page.tolist(), self.chunk_start.tolist(), self.chunk_end.tolist()):
+            if chunk_page != page:
+                page, page_text = chunk_page, self.page_text(chunk_page)
+            yield page_text[start:end]
+
+    def __reduce__(self):
+        # Al pasar a otro proceso solo viaja la ruta; el worker vuelve a mapear los archivos
+        return (CachedDocument, (self.key, self._directory))
+
+    def chunks(self, document_name: str) -> "DocumentChunks":
+        return DocumentChunks(self, document_name)
+
+class CachedTexts(Sequence):
+    """Chunk texts of several cached documents, back to back, produced on access"""
+
+    def __init__(self, documents: List[CachedDocument]):
+        self.documents = list(documents)
+        self._starts = np.zeros(len(self.documents) + 1, dtype=np.int64)
+        np.cumsum([len(doc) for doc in self.documents], out=self._starts[1:])
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(doc.nbytes for doc in self.documents)
+
+    def span_nbytes(self, start: int, stop: int) -> int:
+        first, last = np.searchsorted(self._starts, [start, stop], side='right') - 1
+        return sum(doc.nbytes for doc in self.documents[first:last + 1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        position = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self.documents[position].chunk_text(i - int(self._starts[position]))
+
+    def __iter__(self) -> Iterator[str]:
+        for doc in self.documents:
+            yield from doc.iter_texts()
+
+    def __add__(self, other: "CachedTexts") -> "CachedTexts":
+        return CachedTexts(self.documents + other.documents)
+
+    def without(self, position: int) -> "CachedTexts":
+        """The same texts minus one document's chunks"""
+        return CachedTexts(self.documents[:position] + self.documents[position + 1:])
+
+class DocumentChunks(Sequence):
+    """A cached document's chunks under a session's file name, built as dicts on access"""
+
+    def __init__(self, document: CachedDocument, document_name: str):
+        self.document = document
+        self._document_name = document_name
+
+    def __len__(self) -> int:
+        return len(self.document)
+
+    @property
+    def nbytes(self) -> int:
+        return self.document.nbytes
+
+    def page_numbers(self) -> np.ndarray:
+        return np.asarray(self.document.page_numbers)[self.document.chunk_page]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        document = self.document
+        return {
+            'text': document.chunk_text(i),
+            'document_name': self._document_name,
+            'page_number': int(document.page_numbers[document.chunk_page[i]]),
+            'start_pos': int(document.chunk_start[i]),
+            'end_pos': int(document.chunk_end[i])
+        }
+
+def open_document(key: str) -> Optional[CachedDocument]:
+    """Open a cached document, or None if it has not been extracted yet"""
+    directory = entry_path(key)
+    if not os.path.exists(os.path.join(directory, ENTRY_FILE)):
+        return None
+    try:
+        # Un acierto renueva la entrada para que la limpieza no la borre mientras se usa
+        os.utime(directory)
+    except OSError:
+        pass
+    return CachedDocument(key, directory)
+
+class DocumentWriter:
+    """Write a cache entry page by page, so only the pages being added are in memory"""
+
+    def __init__(self, key: str, content_hash: str):
+        self.key = key
+        self.content_hash = content_hash
+        self._directory = entry_path(key)
+        os.makedirs(os.path.dirname(self._directory), exist_ok=True)
+        self._tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(self._directory), prefix='.tmp-')
+        self._blob = open(os.path.join(self._tmp_dir, 'pages.bin'), 'wb')
+        self._page_numbers: List[int] = []
+        self._page_sizes: List[int] = []
+        # (página, inicio, fin) de cada chunk, aplanado en un array compacto de int32
+        self._chunk_rows = array('i')
+        self._has_text = False
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_numbers)
+
+    def add_pages(self, pages: Iterable[Tuple[int, str]]):
+        for page_number, text in pages:
+            page = len(self._page_numbers)
+            encoded = text.encode('utf-8')
+            self._blob.write(encoded)
+            self._page_numbers.append(page_number)
+            self._page_sizes.append(len(encoded))
+            for start, end in chunk_offsets(len(text)):
+                self._chunk_rows.extend((page, start, end))
+            self._has_text = self._has_text or bool(text.strip())
+
+    def commit(self) -> CachedDocument:
+        """Publish the entry and open it"""
+        tmp_dir = self._tmp_dir
+        try:
+            self._blob.close()
+            page_offsets = np.zeros(len(self._page_sizes) + 1, dtype=np.int64)
+            np.cumsum(self._page_sizes, out=page_offsets[1:])
+            chunks = np.frombuffer(self._chunk_rows, dtype=np.int32).reshape(-1, 3)
+            np.save(os.path.join(tmp_dir, 'page_offsets.npy'), page_offsets)
+            np.save(os.path.join(tmp_dir, 'page_numbers.npy'), np.array(self._page_numbers, dtype=np.int32))
+            np.save(os.path.join(tmp_dir, 'chunk_page.npy'), chunks[:, 0].copy())
+            np.save(os.path.join(tmp_dir, 'chunk_start.npy'), chunks[:, 1].copy())
+            np.save(os.path.join(tmp_dir, 'chunk_end.npy'), chunks[:, 2].copy())
+            with open(os.path.join(tmp_dir, ENTRY_FILE), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'content_hash': self.content_hash,
+                    'chunk_size': CHUNK_SIZE,
+                    'chunk_overlap': CHUNK_OVERLAP,
+                    'extraction_version': EXTRACTION_VERSION,
+                    'pages': len(self._page_numbers),
+                    'chunks': len(chunks),
+                    'has_text': self._has_text
+                }, f)
+            try:
+                os.replace(tmp_dir, self._directory)
+            except OSError:
+                # Otra ingesta del mismo archivo ya la publicó
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception:
+            self.abort()
+            raise
+        return open_document(self.key)
+
+    def abort(self):
+        self._blob.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+def _delete_unreferenced(directories: Iterable[str]) -> int:
+    """Delete cache entries no session references, sparing recently used ones"""
+    now = time.time()
+    removed = 0
+    for directory in directories:
+        try:
+            if now - os.path.getmtime(directory) < DOC_CACHE_GRACE_SECONDS:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        removed += 1
+    return removed
+
+def retain_documents(session_id: str, documents: List[Dict[str, Any]]):
+    """Record which cached documents a session uses, releasing the ones it dropped"""
+    released = set_session_documents(session_id, [doc['document_key'] for doc in documents if doc.get('document_key')])
+    _delete_unreferenced(entry_path(key) for key in released)
+
+def release_documents(session_id: str):
+    """Drop a deleted session's references, deleting entries nobody else uses"""
+    _delete_unreferenced(entry_path(key) for key in release_session_documents(session_id))
+
+def sweep_unreferenced_documents() -> int:
+    """Delete cache entries left without references (e.g. by interrupted ingestions)"""
+    if not os.path.isdir(DOC_CACHE_DIR):
+        return 0
+    referenced = referenced_document_keys()
+    directories = [
+        os.path.join(DOC_CACHE_DIR, prefix, key)
+        for prefix in os.listdir(DOC_CACHE_DIR)
+        for key in os.listdir(os.path.join(DOC_CACHE_DIR, prefix))
+        # Incluye restos '.tmp-' de escrituras interrumpidas
+        if key not in referenced
+    ]
+    removed = _delete_unreferenced(directories)
+    if removed:
+        print(f"Documentos en caché sin referencias eliminados: {removed}")
+    return removed
@@ -1,18 +1,43 @@
-import io
-import pypdf
-from typing import List, Dict, Any, Tuple
-from config import CHUNK_SIZE, CHUNK_OVERLAP
+import asyncio
+from collections import deque
+import inspect
+from typing import List, Dict, Any, Tuple, Optional, BinaryIO, Callable, Deque, Awaitable, Union
+from config import PDF_PAGES_PER_TASK, INGEST_WINDOW_PAGES
+from worker_pool import get_process_pool
+from blob_store import blob_path
+from document_cache import CachedDocument, DocumentWriter, document_key, open_document
+from metrics import timed_call, record_stage
 
-def extract_text_from_pdf(file_stream: io.BytesIO) -> Tuple[str, List[Dict[str, Any]]]:
-    """Extract text from PDF file with page information"""
+# pypdf se importa al extraer el primer PDF (normalmente en los procesos del pool)
+
+# Rangos de páginas extraídos o pendientes de escribir, compartidos por todos los documentos
+_PAGE_RANGE_SLOTS = asyncio.Semaphore(max(1, INGEST_WINDOW_PAGES // max(PDF_PAGES_PER_TASK, 1)))
+
+# progress(filename, pages_done, total_pages); puede ser asíncrona para no bloquear el bucle de eventos
+ProgressCallback = Callable[[str, int, int], Union[None, Awaitable[None]]]
+
+def log_progress(filename: str, pages_done: int, total_pages: int):
+    """Default ingestion progress report"""
+    print(f"Extrayendo {filename}: {pages_done}/{total_pages} páginas")
+
+async def _report(progress: Optional[ProgressCallback], filename: str, pages_done: int, total_pages: int):
+    """Call a sync or async progress callback"""
+    if progress:
+        result = progress(filename, pages_done, total_pages)
+        if inspect.isawaitable(result):
+            await result
+
+def extract_text_from_pdf(file_stream: BinaryIO, page_range: Optional[Tuple[int, int]] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """Extract text from PDF file with page information, optionally only pages [first, last)"""
+    import pypdf
     try:
         pdf_reader = pypdf.PdfReader(file_stream)
-        text = ""
         page_info = []
         current_pos = 0
+        first, last = page_range or (0, len(pdf_reader.pages))
         
-        for page_num, page in enumerate(pdf_reader.pages):
-            page_text = page.extract_text()
+        for page_num in range(first, min(last, len(pdf_reader.pages))):
+            page_text = pdf_reader.pages[page_num].extract_text()
             if page_text:
                 page_info.append({
                     'page_number': page_num + 1,
@@ -20,14 +45,14 @@ def extract_text_from_pdf(file_stream: io.BytesIO) -> Tuple[str, List[Dict[str,
                     'end_pos': current_pos + len(page_text),
                     'text': page_text
                 })
-                text += page_text + "\n"
                 current_pos += len(page_text) + 1  # +1 for newline
-        return text, page_info
+        # Un solo join en lugar de concatenar página a página (coste cuadrático)
+        return "\n".join(page['text'] for page in page_info) + ("\n" if page_info else ""), page_info
     except Exception as e:
         print(f"Error extrayendo texto del PDF: {e}")
         return "", []
 
-def extract_text_from_txt(file_stream: io.BytesIO) -> str:
+def extract_text_from_txt(file_stream: BinaryIO) -> str:
     """Extract text from TXT file"""
     try:
         return file_stream.read().decode('utf-8')
@@ -35,58 +60,123 @@ def extract_text_from_txt(file_stream: io.BytesIO) -> str:
         print(f"Error extrayendo texto del TXT: {e}")
         return ""
 
-def chunk_text(text: str, page_info: List[Dict[str, Any]], chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[Dict[str, Any]]:
-    """Split text into chunks with page information"""
-    if not text:
-        return []
-
-    chunks = []
-
-    for page in page_info:
-        page_text = page['text']
-        page_number = page['page_number']
-
-        start = 0
-        while start < len(page_text):
-            end = start + chunk_size
-            chunk_text = page_text[start:end]
-
-            chunks.append({
-                'text': chunk_text,
-                'start_pos': start,
-                'end_pos': min(end, len(page_text)),
-                'page_number': page_number
-            })
-
-            start += chunk_size - overlap
-
-    return chunks
+def count_pdf_pages(path: str) -> int:
+    """Count the pages of a PDF file (0 if it cannot be read)"""
+    import pypdf
+    try:
+        with open(path, 'rb') as f:
+            return len(pypdf.PdfReader(f).pages)
+    except Exception as e:
+        print(f"Error leyendo el PDF: {e}")
+        return 0
 
-def process_document(file_content_bytes: bytes, filename: str) -> Dict[str, Any]:
-    """Process a document and return its structured data"""
-    file_stream = io.BytesIO(file_content_bytes)
-    
-    if filename.lower().endswith('.pdf'):
-        text, page_info = extract_text_from_pdf(file_stream)
-    elif filename.lower().endswith('.txt'):
-        text = extract_text_from_txt(file_stream)
-        page_info = [{'page_number': 1, 'start_pos': 0, 'end_pos': len(text), 'text': text}]
-    else:
+def extract_pages(path: str, filename: str, page_range: Optional[Tuple[int, int]] = None) -> Optional[List[Tuple[int, str]]]:
+    """Extract the (page_number, text) pages of a stored document, or a page range of a PDF. None if the type is unsupported"""
+    if not filename.lower().endswith(('.pdf', '.txt')):
         return None
     
-    if not text.strip():
+    with open(path, 'rb') as file_stream:
+        if filename.lower().endswith('.pdf'):
+            _, page_info = extract_text_from_pdf(file_stream, page_range)
+            return [(page['page_number'], page['text']) for page in page_info]
+        return [(1, extract_text_from_txt(file_stream))]
+
+def build_document(content_hash: str, filename: str, cached: Optional[CachedDocument]) -> Optional[Dict[str, Any]]:
+    """Assemble the session entry for a document (None if it has no text)"""
+    if cached is None or not cached.has_text:
         return None
     
-    chunks = chunk_text(text, page_info)
-    
     return {
         "name": filename,
-        "chunks": [{
-            "text": chunk['text'], 
-            "document_name": filename, 
-            "page_number": chunk['page_number'], 
-            "start_pos": chunk['start_pos'], 
-            "end_pos": chunk['end_pos']
-        } for chunk in chunks],
-        "content": file_content_bytes.hex()
+        "chunks": cached.chunks(filename),
+        "content_hash": content_hash,
+        "document_key": cached.key
     }
+
+async def _extract_to_cache(key: str, content_hash: str, filename: str, progress: Optional[ProgressCallback]) -> CachedDocument:
+    """Extract a document on the process pool, streaming its pages into the document cache.
+
+    PDFs are split into ranges of PDF_PAGES_PER_TASK pages; at most
+    INGEST_WINDOW_PAGES pages, counted across every document being ingested,
+    are being extracted or waiting to be written at any time, and ranges are
+    written in order as they complete, off the event loop, so memory does not
+    grow with the length of the documents or the number of uploads.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    path = blob_path(content_hash)
+    ranges = [None]
+    total_pages = 1
+    if filename.lower().endswith('.pdf'):
+        total_pages = await loop.run_in_executor(None, count_pdf_pages, path)
+        if PDF_PAGES_PER_TASK > 0 and total_pages > PDF_PAGES_PER_TASK:
+            ranges = [(first, first + PDF_PAGES_PER_TASK) for first in range(0, total_pages, PDF_PAGES_PER_TASK)]
+    writer = DocumentWriter(key, content_hash)
+    pending: Deque[Tuple[asyncio.Future, int]] = deque()
+    pages_done = 0
+    
+    async def write_next():
+        nonlocal pages_done
+        future, n_pages = pending.popleft()
+        try:
+            seconds, pages = await future
+            record_stage('page_extraction', seconds)
+            # Escritura de las páginas y cálculo de los offsets de sus chunks, fuera del bucle de eventos
+            seconds, _ = await loop.run_in_executor(None, timed_call, writer.add_pages, pages)
+            record_stage('chunking', seconds)
+        finally:
+            _PAGE_RANGE_SLOTS.release()
+        pages_done += n_pages
+        await _report(progress, filename, pages_done, total_pages)
+    
+    try:
+        for page_range in ranges:
+            # Sin rangos libres se escriben primero los propios: un documento solo espera
+            # a los demás cuando no retiene ninguno, así que no pueden bloquearse entre sí
+            while pending and _PAGE_RANGE_SLOTS.locked():
+                await write_next()
+            await _PAGE_RANGE_SLOTS.acquire()
+            n_pages = min(page_range[1], total_pages) - page_range[0] if page_range else total_pages
+            # La extracción se mide en el worker; la duración vuelve con las páginas
+            pending.append((loop.run_in_executor(pool, timed_call, extract_pages, path, filename, page_range), n_pages))
+        while pending:
+            await write_next()
+    except BaseException:
+        for future, _ in pending:
+            future.cancel()
+            _PAGE_RANGE_SLOTS.release()
+        writer.abort()
+        raise
+    return await loop.run_in_executor(None, writer.commit)
+
+async def process_documents(uploads: List[Tuple[str, str]], progress: Optional[ProgressCallback] = None) -> List[Optional[Dict[str, Any]]]:
+    """Process several stored documents, given as (content_hash, filename), on the ingestion process pool.
+
+    Documents already in the shared document cache (same bytes, type and
+    chunking config) are reused without extracting them again; the rest are
+    extracted page range by page range into the cache (see _extract_to_cache).
+    Workers read the blob from disk, so no file bytes cross process boundaries.
+    progress(filename, pages_done, total_pages) is called (and awaited, if it is
+    a coroutine function) as pages are extracted.
+    """
+    loop = asyncio.get_running_loop()
+    
+    async def process(content_hash: str, filename: str) -> Optional[Dict[str, Any]]:
+        if not filename.lower().endswith(('.pdf', '.txt')):
+            return None
+        key = document_key(content_hash, filename)
+        cached = await loop.run_in_executor(None, open_document, key)
+        if cached is None:
+            cached = await _extract_to_cache(key, content_hash, filename, progress)
+        else:
+            await _report(progress, filename, len(cached.page_numbers), len(cached.page_numbers))
+        return build_document(content_hash, filename, cached)
+    
+    tasks = [asyncio.ensure_future(process(content_hash, filename)) for content_hash, filename in uploads]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        # Si un archivo falla o se cancela la ingesta, se detienen también los demás
+        for task in tasks:
+            task.cancel()
+        raise
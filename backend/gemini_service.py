@@ -1,38 +1,51 @@
-import google.generativeai as genai
-from typing import List, Dict, Any
-from models import DocumentFragment, AskQuestionResponse
-from config import get_google_api_key
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future, CancelledError
+from typing import List, Dict, Any, Callable, AsyncIterator, Tuple, Optional
+from models import DocumentFragment, AskQuestionResponse, Citation
+from config import get_google_api_key, CITATION_SNIPPET_CHARS, GEMINI_MODEL, ANSWER_CACHE_TTL_SECONDS, CONTEXT_TOKEN_BUDGET, CHARS_PER_TOKEN
 from search_engine import search_query
+from database import get_cached_answer, put_cached_answer
+from metrics import timed, record_stage
+
+# El cliente de Gemini (cerca de un segundo de importación) se carga con la
+# primera pregunta o con el precalentamiento en segundo plano
+_GEMINI_CONFIGURED = False
 
 def configure_gemini():
     """Configure Gemini API"""
+    global _GEMINI_CONFIGURED
     api_key = get_google_api_key()
     if not api_key:
         raise ValueError("La API Key de Google no está configurada. Por favor, configura GOOGLE_API_KEY en las variables de entorno o usa el endpoint /configure_api_key")
+    import google.generativeai as genai
     genai.configure(api_key=api_key)
+    _GEMINI_CONFIGURED = True
     print("✅ API Key de Google configurada exitosamente")
 
-def generate_answer(question: str, db: Dict[str, Any]) -> AskQuestionResponse:
-    """Generate answer using Gemini with RAG approach"""
-    if not get_google_api_key():
-        raise ValueError("La API Key de Google no está configurada en el servidor.")
+def _gemini_model(model_name: str):
+    """Default model factory: genai.GenerativeModel, configuring the client on first use"""
+    import google.generativeai as genai
+    if not _GEMINI_CONFIGURED:
+        configure_gemini()
+    return genai.GenerativeModel(model_name)
 
-    # 1. Recuperación (Retrieval)
-    relevant_fragments = search_query(question, db)
-    if not relevant_fragments:
-        return AskQuestionResponse(
-            answer="No encontré coincidencias significativas para tu consulta en los documentos cargados. Por favor, intenta con términos más específicos o reformula tu pregunta.",
-            citations=[]
-        )
+def preload_gemini():
+    """Import the Gemini client ahead of the first question"""
+    import google.generativeai  # noqa: F401
 
-    # 2. Aumentación (Augmentation)
-    context = "\n\n---\n\n".join([f"Fuente: {frag.document_name}\nContenido: {frag.text}" for frag in relevant_fragments])
-    
-    # 3. Generación (Generation) con Gemini
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash') # Usamos un modelo rápido y eficiente
-        
-        prompt = f"""
+def make_snippet(text: str, max_chars: int = CITATION_SNIPPET_CHARS) -> str:
+    """Shorten a fragment to a one-line snippet cut at a word boundary"""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "…"
+
+# Plantilla del prompt; su hash forma parte de la clave de la caché de respuestas
+PROMPT_TEMPLATE = """
         Eres un asistente experto en analizar documentos. Basándote EXCLUSIVAMENTE en el siguiente contexto, responde la pregunta del usuario de forma breve y concisa (3-4 líneas).
         Cita tus fuentes usando el formato [Fuente: nombre_del_documento.pdf]. Puedes usar múltiples citas si es necesario.
         También eres un asistente bilingüe, por lo que debes responder en español y en inglés, depende de la pregunta del usuario. Si la pregunta es en español, responde en español, si la pregunta es en inglés, responde en inglés.
@@ -46,27 +59,293 @@ def generate_answer(question: str, db: Dict[str, Any]) -> AskQuestionResponse:
 
         RESPUESTA:
         """
-        
-        response = model.generate_content(prompt)
-        answer = response.text
+PROMPT_TEMPLATE_HASH = hashlib.sha256(PROMPT_TEMPLATE.encode('utf-8')).hexdigest()
+
+# Fábrica del modelo; se puede sustituir (p. ej. por un modelo falso local en pruebas)
+_model_factory: Callable[[str], Any] = _gemini_model
+
+# Llamadas al modelo en curso por clave, para que peticiones idénticas compartan una sola
+_INFLIGHT: Dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+_ANSWER_CACHE_STATS = {"hits": 0, "misses": 0, "coalesced": 0}
+# Tokens estimados de los fragmentos recuperados frente a los que llegan al prompt; lo
+# ahorrado al fusionar solapes se cuenta aparte de lo descartado por el presupuesto
+_CONTEXT_STATS = {"requests": 0, "retrieved_tokens": 0, "context_tokens": 0, "merged_fragments": 0, "dropped_fragments": 0, "dropped_tokens": 0}
 
+def set_model_factory(factory: Callable[[str], Any]):
+    """Replace the factory used to build the generative model"""
+    global _model_factory
+    _model_factory = factory
+
+def answer_cache_stats() -> Dict[str, int]:
+    """Answer cache and request coalescing counters"""
+    return dict(_ANSWER_CACHE_STATS)
+
+def context_packing_stats() -> Dict[str, int]:
+    """Context packing counters: tokens saved by merging overlaps and tokens dropped by the budget"""
+    stats = dict(_CONTEXT_STATS)
+    stats["merge_saved_tokens"] = stats["retrieved_tokens"] - stats["context_tokens"] - stats["dropped_tokens"]
+    return stats
+
+def fragment_id(frag: DocumentFragment, db: Dict[str, Any]) -> str:
+    """Stable id of a retrieved fragment: document content hash plus its position"""
+    content_hash = next((doc['content_hash'] for doc in db['documents'] if doc['name'] == frag.document_name), frag.document_name)
+    position = frag.text_position or {}
+    return f"{content_hash}:{frag.page_number}:{position.get('start_pos')}-{position.get('end_pos')}"
+
+def answer_cache_key(question: str, fragments: List[DocumentFragment], db: Dict[str, Any]) -> str:
+    """Cache key from the model, the prompt template, the retrieved fragments and the question"""
+    payload = json.dumps([GEMINI_MODEL, PROMPT_TEMPLATE_HASH, sorted(fragment_id(frag, db) for frag in fragments), question.strip()])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _call_model(prompt: str) -> str:
+    try:
+        model = _model_factory(GEMINI_MODEL)
+        with timed('llm_call'):
+            response = model.generate_content(prompt)
+            return response.text
     except Exception as e:
         print(f"Error al llamar a la API de Gemini: {e}")
         raise ValueError("Error al generar la respuesta con el modelo de lenguaje.")
+
+def _join_inflight(cache_key: str) -> Tuple[bool, Future]:
+    """Register as the leader of a model call, or get the identical call already in flight"""
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(cache_key)
+        if future is None:
+            future = _INFLIGHT[cache_key] = Future()
+            return True, future
+        return False, future
+
+def _leave_inflight(cache_key: str, future: Future, abandon: bool = False):
+    """Unregister a leader's call; abandoning it makes the waiting requests retry, one as the new leader"""
+    with _INFLIGHT_LOCK:
+        if _INFLIGHT.get(cache_key) is future:
+            del _INFLIGHT[cache_key]
+    if abandon:
+        future.cancel()
+
+def _generate_coalesced(cache_key: str, prompt: str) -> str:
+    """Answer from the cache, or join an identical in-flight call, or call the model"""
+    cached = get_cached_answer(cache_key)
+    if cached is not None:
+        _ANSWER_CACHE_STATS["hits"] += 1
+        return cached
+    
+    while True:
+        is_leader, future = _join_inflight(cache_key)
+        if is_leader:
+            break
+        _ANSWER_CACHE_STATS["coalesced"] += 1
+        try:
+            return future.result()
+        except CancelledError:
+            # El líder abandonó la llamada (su cliente de streaming se desconectó)
+            continue
     
-    # Extraemos las citas para que el frontend pueda mostrarlas
+    _ANSWER_CACHE_STATS["misses"] += 1
+    try:
+        answer = _call_model(prompt)
+        put_cached_answer(cache_key, answer, ANSWER_CACHE_TTL_SECONDS)
+        future.set_result(answer)
+        return answer
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _leave_inflight(cache_key, future)
+
+NO_MATCH_ANSWER = "No encontré coincidencias significativas para tu consulta en los documentos cargados. Por favor, intenta con términos más específicos o reformula tu pregunta."
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text (CHARS_PER_TOKEN characters per token)"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def _span(frag: DocumentFragment) -> Optional[Tuple[int, int]]:
+    """(start, end) of a fragment in its page, if its text is exactly that slice"""
+    position = frag.text_position or {}
+    start, end = position.get('start_pos'), position.get('end_pos')
+    if start is None or end is None or frag.page_number is None or end - start != len(frag.text):
+        return None
+    return start, end
+
+def _stitch(pieces: List[Tuple[int, int, str]]) -> Tuple[int, int, str]:
+    """Join (start, end, text) spans of one page that overlap or touch, without repeating text"""
+    pieces = sorted(pieces)
+    start, end, text = pieces[0]
+    parts = [text]
+    for piece_start, piece_end, piece_text in pieces[1:]:
+        if piece_end > end:
+            parts.append(piece_text[end - piece_start:])
+            end = piece_end
+    return start, end, "".join(parts)
+
+def pack_context(fragments: List[DocumentFragment], budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[List[Dict[str, Any]], List[DocumentFragment]]:
+    """Merge overlapping or adjacent fragments of the same page and fill the token budget by score.
+
+    Returns the context blocks, ordered by their best score, and the original
+    fragments they contain (for citations and the answer cache key). A
+    fragment that would exceed the budget is skipped, but the best one is
+    always kept.
+    """
+    blocks: List[Dict[str, Any]] = []
+    used = 0
+    for frag in sorted(fragments, key=lambda frag: frag.score, reverse=True):
+        span = _span(frag)
+        touching = [] if span is None else [
+            block for block in blocks
+            if block['start_pos'] is not None and block['document_name'] == frag.document_name
+            and block['page_number'] == frag.page_number
+            and span[0] <= block['end_pos'] and block['start_pos'] <= span[1]
+        ]
+        if touching:
+            start, end, text = _stitch([(block['start_pos'], block['end_pos'], block['text']) for block in touching] + [(span[0], span[1], frag.text)])
+        else:
+            start, end, text = (span or (None, None)) + (frag.text,)
+        cost = estimate_tokens(text) - sum(block['tokens'] for block in touching)
+        if budget and blocks and used + cost > budget:
+            _CONTEXT_STATS["dropped_fragments"] += 1
+            _CONTEXT_STATS["dropped_tokens"] += estimate_tokens(frag.text)
+            continue
+        used += cost
+        merged = {
+            'document_name': frag.document_name, 'page_number': frag.page_number,
+            'start_pos': start, 'end_pos': end, 'text': text, 'tokens': estimate_tokens(text),
+            'fragments': [member for block in touching for member in block['fragments']] + [frag]
+        }
+        if touching:
+            # El bloque resultante ocupa el lugar del mejor bloque que absorbe
+            _CONTEXT_STATS["merged_fragments"] += 1
+            absorbed = {id(block) for block in touching[1:]}
+            blocks = [merged if block is touching[0] else block for block in blocks if id(block) not in absorbed]
+        else:
+            blocks.append(merged)
+
+    _CONTEXT_STATS["requests"] += 1
+    _CONTEXT_STATS["retrieved_tokens"] += sum(estimate_tokens(frag.text) for frag in fragments)
+    _CONTEXT_STATS["context_tokens"] += used
+    included = sorted((member for block in blocks for member in block['fragments']), key=lambda frag: frag.score, reverse=True)
+    return blocks, included
+
+def build_prompt(question: str, blocks: List[Dict[str, Any]]) -> str:
+    """Assemble the RAG prompt from the packed context blocks"""
+    context = "\n\n---\n\n".join([f"Fuente: {block['document_name']}\nContenido: {block['text']}" for block in blocks])
+    return PROMPT_TEMPLATE.format(context=context, question=question)
+
+def build_citations(fragments: List[DocumentFragment], db: Dict[str, Any]) -> List[Citation]:
+    """Lightweight citations (one per document, at most 3) for the retrieved fragments.
+
+    Only a reference is sent; the document itself is fetched from /get_document.
+    """
     citations = []
     seen_docs = set()
-    for frag in relevant_fragments:
+    for frag in fragments:
         if frag.document_name not in seen_docs:
-            doc_content = next((doc['content'] for doc in db['documents'] if doc['name'] == frag.document_name), None)
-            if doc_content:
-                citations.append({
-                    "document_name": frag.document_name, 
-                    "content_hex": doc_content,
-                    "page_number": frag.page_number,
-                    "text_position": frag.text_position
-                })
+            content_hash = next((doc['content_hash'] for doc in db['documents'] if doc['name'] == frag.document_name), None)
+            if content_hash:
+                citations.append(Citation(
+                    document_name=frag.document_name, 
+                    document_id=content_hash,
+                    page_number=frag.page_number,
+                    text_position=frag.text_position,
+                    snippet=make_snippet(frag.text)
+                ))
                 seen_docs.add(frag.document_name)
+    return citations[:3]
+
+def generate_answer(question: str, db: Dict[str, Any]) -> AskQuestionResponse:
+    """Generate answer using Gemini with RAG approach"""
+    if not get_google_api_key():
+        raise ValueError("La API Key de Google no está configurada en el servidor.")
+
+    # 1. Recuperación (Retrieval)
+    relevant_fragments = search_query(question, db)
+    if not relevant_fragments:
+        return AskQuestionResponse(answer=NO_MATCH_ANSWER, citations=[])
+
+    # 2. Aumentación (Augmentation): fragmentos fusionados dentro del presupuesto de tokens
+    with timed('context_packing'):
+        blocks, context_fragments = pack_context(relevant_fragments)
+    with timed('prompt_build'):
+        prompt = build_prompt(question, blocks)
+    
+    # 3. Generación (Generation) con Gemini, reutilizando respuestas cacheadas o en curso
+    answer = _generate_coalesced(answer_cache_key(question, context_fragments, db), prompt)
+    
+    return AskQuestionResponse(answer=answer, citations=build_citations(context_fragments, db))
+
+async def stream_answer_events(question: str, db: Dict[str, Any]) -> AsyncIterator[Tuple[str, Any]]:
+    """Yield (event, data) pairs: the citations as soon as retrieval ends, then answer tokens.
+
+    Uses the model's async streaming API, so no thread is held while waiting
+    for Gemini. Cached answers and identical in-flight calls are reused.
+    """
+    if not get_google_api_key():
+        raise ValueError("La API Key de Google no está configurada en el servidor.")
 
-    return AskQuestionResponse(answer=answer, citations=citations[:3])
+    relevant_fragments = await asyncio.to_thread(search_query, question, db)
+    if not relevant_fragments:
+        yield "citations", []
+        yield "token", {"text": NO_MATCH_ANSWER}
+        yield "done", {"answer": NO_MATCH_ANSWER}
+        return
+    with timed('context_packing'):
+        blocks, context_fragments = pack_context(relevant_fragments)
+    yield "citations", [citation.model_dump() for citation in build_citations(context_fragments, db)]
+
+    cache_key = answer_cache_key(question, context_fragments, db)
+    cached = await asyncio.to_thread(get_cached_answer, cache_key)
+    if cached is not None:
+        _ANSWER_CACHE_STATS["hits"] += 1
+        yield "token", {"text": cached}
+        yield "done", {"answer": cached}
+        return
+
+    while True:
+        is_leader, future = _join_inflight(cache_key)
+        if is_leader:
+            break
+        _ANSWER_CACHE_STATS["coalesced"] += 1
+        try:
+            # shield: si este cliente se desconecta no se cancela la llamada compartida
+            answer = await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # El líder se desconectó antes de terminar: se reintenta, quizá como nuevo líder
+            continue
+        yield "token", {"text": answer}
+        yield "done", {"answer": answer}
+        return
+
+    _ANSWER_CACHE_STATS["misses"] += 1
+    parts = []
+    try:
+        with timed('prompt_build'):
+            prompt = build_prompt(question, blocks)
+        model = _model_factory(GEMINI_MODEL)
+        start = time.perf_counter()
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                if not parts:
+                    record_stage('llm_first_token', time.perf_counter() - start)
+                parts.append(chunk.text)
+                yield "token", {"text": chunk.text}
+        record_stage('llm_call', time.perf_counter() - start)
+        answer = "".join(parts)
+        await asyncio.to_thread(put_cached_answer, cache_key, answer, ANSWER_CACHE_TTL_SECONDS)
+        future.set_result(answer)
+        yield "done", {"answer": answer}
+    except Exception as e:
+        print(f"Error en el streaming de Gemini: {e!r}")
+        if not future.done():
+            future.set_exception(ValueError("Error al generar la respuesta con el modelo de lenguaje."))
+        raise ValueError("Error al generar la respuesta con el modelo de lenguaje.")
+    except BaseException:
+        # Desconexión del cliente (GeneratorExit o cancelación): no es un error de la
+        # respuesta, así que quienes la esperaban la vuelven a pedir
+        _leave_inflight(cache_key, future, abandon=True)
+        raise
+    finally:
+        _leave_inflight(cache_key, future)
@@ -0,0 +1,347 @@
+import os
+import json
+import mmap
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+from collections.abc import Mapping, Sequence
+from typing import Dict, Any, Iterator, Optional
+from search_engine import INDEX_SPACES, BM25_FIELDS, DENSE_FIELDS, new_vectorizer, is_hashed, build_chunk_table, session_engine
+from document_cache import CachedTexts, open_document
+
+# Versión del formato en disco; se incrementa ante cualquier cambio incompatible
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+def _open_bytes(path: str):
+    """Memory-map a binary file read-only (empty files map to b'')"""
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _load_array(directory: str, name: str) -> np.ndarray:
+    return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+
+def _save_array(directory: str, name: str, array: np.ndarray):
+    np.save(os.path.join(directory, f'{name}.npy'), np.asarray(array))
+
+class MappedVocabulary(Mapping):
+    """Read-only term -> column mapping over memory-mapped, byte-sorted terms.
+
+    Lookups are a binary search over the UTF-8 term blob, so loading a
+    session does not build a Python dict of the whole vocabulary.
+    """
+
+    def __init__(self, blob, offsets: np.ndarray, columns: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+        self._columns = columns
+
+    def _term_bytes(self, position: int) -> bytes:
+        return self._blob[int(self._offsets[position]):int(self._offsets[position + 1])]
+
+    def _find(self, key: bytes) -> int:
+        low, high = 0, len(self._columns)
+        while low < high:
+            mid = (low + high) // 2
+            if self._term_bytes(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self._columns) and self._term_bytes(low) == key:
+            return low
+        return -1
+
+    def get(self, term: str, default: Optional[int] = None) -> Optional[int]:
+        position = self._find(term.encode('utf-8'))
+        return int(self._columns[position]) if position >= 0 else default
+
+    def __getitem__(self, term: str) -> int:
+        column = self.get(term)
+        if column is None:
+            raise KeyError(term)
+        return column
+
+    def __contains__(self, term: object) -> bool:
+        return isinstance(term, str) and self.get(term) is not None
+
+    def __len__(self) -> int:
+        return len(self._columns)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the mapped term blob and arrays"""
+        return len(self._blob) + self._offsets.nbytes + self._columns.nbytes
+
+    def __iter__(self) -> Iterator[str]:
+        for position in range(len(self._columns)):
+            yield self._term_bytes(position).decode('utf-8')
+
+    def items(self):
+        return ((self._term_bytes(p).decode('utf-8'), int(self._columns[p])) for p in range(len(self._columns)))
+
+class MappedTexts(Sequence):
+    """Chunk texts decoded on access from a memory-mapped UTF-8 blob"""
+
+    def __init__(self, blob, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._blob) + self._offsets.nbytes
+
+    def span_nbytes(self, start: int, stop: int) -> int:
+        return int(self._offsets[stop] - self._offsets[start])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])].decode('utf-8')
+
+class MappedChunks(Sequence):
+    """One document's chunks, materialized as dicts only when accessed"""
+
+    def __init__(self, table: Dict[str, Any], start: int, stop: int, document_name: str):
+        self._table = table
+        self._start = start
+        self._stop = stop
+        self._document_name = document_name
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate size of this document's chunk data on disk"""
+        return self._table['text'].span_nbytes(self._start, self._stop) + 16 * len(self)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = self._start + i
+        table = self._table
+        return {
+            'text': table['text'][row],
+            'document_name': self._document_name,
+            'page_number': int(table['page_number'][row]),
+            'start_pos': int(table['start_pos'][row]),
+            'end_pos': int(table['end_pos'][row])
+        }
+
+def _write_vocabulary(directory: str, space: str, vocabulary: Mapping):
+    if isinstance(vocabulary, MappedVocabulary):
+        # Ya está ordenado: se copian los arrays tal cual
+        blob, offsets, columns = bytes(vocabulary._blob), vocabulary._offsets, vocabulary._columns
+    else:
+        terms = sorted((term.encode('utf-8'), column) for term, column in vocabulary.items())
+        blob = b''.join(term for term, _ in terms)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term, _ in terms], out=offsets[1:])
+        columns = np.fromiter((column for _, column in terms), dtype=np.int32, count=len(terms))
+    with open(os.path.join(directory, f'{space}_terms.bin'), 'wb') as f:
+        f.write(blob)
+    _save_array(directory, f'{space}_term_offsets', offsets)
+    _save_array(directory, f'{space}_term_columns', columns)
+
+def _write_chunks(directory: str, table: Dict[str, Any], write_text: bool = True):
+    """Write the chunk table as one .npy per column plus a UTF-8 text blob"""
+    for column in ('page_number', 'start_pos', 'end_pos'):
+        _save_array(directory, f'chunk_{column}', table[column])
+    if not write_text:
+        return
+    texts = table['text']
+    if isinstance(texts, MappedTexts):
+        blob, text_offsets = texts._blob, texts._offsets
+    else:
+        encoded = [text.encode('utf-8') for text in texts]
+        blob = b''.join(encoded)
+        text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=text_offsets[1:])
+    with open(os.path.join(directory, 'chunk_text.bin'), 'wb') as f:
+        f.write(blob)
+    _save_array(directory, 'chunk_text_offsets', text_offsets)
+
+def stage_index(parent: str, db: Dict[str, Any]) -> str:
+    """Write a session to a new temp directory under parent and return its path.
+
+    The caller publishes it with a rename, so readers never see a
+    half-written session.
+    """
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'documents': [{
+                'name': doc['name'],
+                'content_hash': doc['content_hash'],
+                'document_key': doc.get('document_key'),
+                'chunk_count': len(doc['chunks'])
+            } for doc in db['documents']],
+            'engine': session_engine(db),
+            'spaces': {},
+            'idf_pending_chunks': db.get('idf_pending_chunks', 0),
+            'index_version': db.get('index_version')
+        }
+        table = db['chunk_table'] if db.get('chunk_table') is not None else build_chunk_table(db['documents'])
+        # Si todos los documentos están en la caché compartida, el texto no se copia en la sesión
+        manifest['shared_text'] = all(doc.get('document_key') for doc in db['documents'])
+        _write_chunks(tmp_dir, table, write_text=not manifest['shared_text'])
+        for space in INDEX_SPACES:
+            index = db.get(f'{space}_index')
+            if index is None:
+                continue
+            _save_array(tmp_dir, f'{space}_data', index.data)
+            _save_array(tmp_dir, f'{space}_indices', index.indices)
+            _save_array(tmp_dir, f'{space}_indptr', index.indptr)
+            _save_array(tmp_dir, f'{space}_df', db[f'{space}_df'])
+            _save_array(tmp_dir, f'{space}_idf', db[f'{space}_idf'])
+            manifest['spaces'][space] = {'shape': list(index.shape)}
+            if is_hashed(db[f'{space}_vectorizer']):
+                # Espacio hashed: el número de columnas basta para recrear el vectorizador
+                manifest['spaces'][space]['hashed'] = True
+            else:
+                _write_vocabulary(tmp_dir, space, db[f'{space}_vectorizer'].vocabulary_)
+        if db.get('lsa_vectors') is not None:
+            # Índice denso: base LSA, vectores float32 por lista IVF y centroides
+            for field in DENSE_FIELDS:
+                _save_array(tmp_dir, field, db[field])
+            manifest['dense'] = True
+        if db.get('bm25_postings') is not None:
+            # Índice invertido: postings por término (CSC), pesos BM25 alineados con ellos y máximos por bloque
+            postings, block_max = db['bm25_postings'], db['bm25_block_max']
+            _save_array(tmp_dir, 'bm25_postings_tf', postings.data)
+            _save_array(tmp_dir, 'bm25_postings_rows', postings.indices)
+            _save_array(tmp_dir, 'bm25_postings_indptr', postings.indptr)
+            _save_array(tmp_dir, 'bm25_impacts', db['bm25_impacts'])
+            _save_array(tmp_dir, 'bm25_lengths', db['bm25_lengths'])
+            _save_array(tmp_dir, 'bm25_block_max_data', block_max.data)
+            _save_array(tmp_dir, 'bm25_block_max_indices', block_max.indices)
+            _save_array(tmp_dir, 'bm25_block_max_indptr', block_max.indptr)
+            _save_array(tmp_dir, 'bm25_block_starts', db['bm25_block_starts'])
+            _write_vocabulary(tmp_dir, 'bm25', db['bm25_vectorizer'].vocabulary_)
+            manifest['spaces']['bm25'] = {'shape': list(postings.shape), 'block_shape': list(block_max.shape)}
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return tmp_dir
+
+def read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    """Read a stored session's manifest (documents, engine and matrix shapes) without opening its arrays"""
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def read_index(directory: str) -> Optional[Dict[str, Any]]:
+    """Open a session version written by stage_index, memory-mapping every array"""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Formato de índice no soportado: {manifest.get('format_version')}")
+
+    counts = [doc['chunk_count'] for doc in manifest['documents']]
+    table = {
+        'document': np.repeat(np.arange(len(counts), dtype=np.int32), counts),
+        'page_number': _load_array(directory, 'chunk_page_number'),
+        'start_pos': _load_array(directory, 'chunk_start_pos'),
+        'end_pos': _load_array(directory, 'chunk_end_pos'),
+    }
+    cached = []
+    if manifest.get('shared_text'):
+        for doc in manifest['documents']:
+            document = open_document(doc['document_key'])
+            if document is None:
+                raise ValueError(f"Documento {doc['name']} ausente de la caché de documentos")
+            cached.append(document)
+        table['text'] = CachedTexts(cached)
+    else:
+        table['text'] = MappedTexts(
+            _open_bytes(os.path.join(directory, 'chunk_text.bin')),
+            _load_array(directory, 'chunk_text_offsets')
+        )
+    documents = []
+    start = 0
+    for position, doc in enumerate(manifest['documents']):
+        stop = start + doc['chunk_count']
+        documents.append({
+            'name': doc['name'],
+            'content_hash': doc['content_hash'],
+            'document_key': doc.get('document_key'),
+            'chunks': cached[position].chunks(doc['name']) if cached else MappedChunks(table, start, stop, doc['name'])
+        })
+        start = stop
+
+    db = {
+        'documents': documents,
+        'engine': manifest.get('engine', 'tfidf'),
+        'chunk_table': table,
+        'idf_pending_chunks': manifest.get('idf_pending_chunks', 0),
+        'index_version': manifest.get('index_version')
+    }
+    for space in INDEX_SPACES:
+        info = manifest['spaces'].get(space)
+        if info is None:
+            db[f'{space}_vectorizer'] = None
+            db[f'{space}_index'] = None
+            db[f'{space}_df'] = None
+            db[f'{space}_idf'] = None
+            continue
+        if info.get('hashed'):
+            vectorizer = new_vectorizer(space, info['shape'][1])
+        else:
+            vectorizer = new_vectorizer(space)
+            vectorizer.vocabulary_ = MappedVocabulary(
+                _open_bytes(os.path.join(directory, f'{space}_terms.bin')),
+                _load_array(directory, f'{space}_term_offsets'),
+                _load_array(directory, f'{space}_term_columns')
+            )
+        db[f'{space}_vectorizer'] = vectorizer
+        db[f'{space}_index'] = sp.csr_matrix(
+            (_load_array(directory, f'{space}_data'), _load_array(directory, f'{space}_indices'), _load_array(directory, f'{space}_indptr')),
+            shape=tuple(info['shape'])
+        )
+        db[f'{space}_df'] = _load_array(directory, f'{space}_df')
+        db[f'{space}_idf'] = _load_array(directory, f'{space}_idf')
+
+    for field in DENSE_FIELDS:
+        db[field] = _load_array(directory, field) if manifest.get('dense') else None
+
+    info = manifest['spaces'].get('bm25')
+    if info is None:
+        for field in BM25_FIELDS:
+            db[field] = None
+        return db
+    vectorizer = new_vectorizer('bm25')
+    vectorizer.vocabulary_ = MappedVocabulary(
+        _open_bytes(os.path.join(directory, 'bm25_terms.bin')),
+        _load_array(directory, 'bm25_term_offsets'),
+        _load_array(directory, 'bm25_term_columns')
+    )
+    db['bm25_vectorizer'] = vectorizer
+    db['bm25_postings'] = sp.csc_matrix(
+        (_load_array(directory, 'bm25_postings_tf'), _load_array(directory, 'bm25_postings_rows'), _load_array(directory, 'bm25_postings_indptr')),
+        shape=tuple(info['shape'])
+    )
+    db['bm25_impacts'] = _load_array(directory, 'bm25_impacts')
+    db['bm25_lengths'] = _load_array(directory, 'bm25_lengths')
+    db['bm25_block_max'] = sp.csr_matrix(
+        (_load_array(directory, 'bm25_block_max_data'), _load_array(directory, 'bm25_block_max_indices'), _load_array(directory, 'bm25_block_max_indptr')),
+        shape=tuple(info['block_shape'])
+    )
+    db['bm25_block_starts'] = _load_array(directory, 'bm25_block_starts')
+    return db
@@ -0,0 +1,162 @@
+import os
+import time
+import uuid
+import asyncio
+from typing import Dict, Any, List, Tuple, Optional
+from fastapi.concurrency import run_in_threadpool
+from config import INGEST_JOB_WORKERS, INGEST_JOBS_PER_TENANT, JOB_PROGRESS_INTERVAL_SECONDS
+from database import create_job, get_job, update_job, request_job_cancel, is_job_cancel_requested, list_active_jobs
+from document_processor import process_documents, log_progress
+from search_engine import build_chunk_table, build_index
+from session_manager import create_session
+from worker_pool import get_process_pool
+from metrics import timed
+
+# Etapas de un trabajo de ingesta, en orden
+JOB_STAGES = ("queued", "extracting", "chunking", "indexing", "persisting", "done")
+
+# Trabajos en ejecución en este proceso y límites de concurrencia (global y por tenant)
+_TASKS: Dict[str, asyncio.Task] = {}
+_WORKERS = asyncio.Semaphore(INGEST_JOB_WORKERS)
+_TENANT_SLOTS: Dict[str, asyncio.Semaphore] = {}
+_TENANT_WAITING: Dict[str, int] = {}
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def fail_orphaned_jobs() -> int:
+    """Mark queued/running jobs whose worker process died as failed (run at startup)"""
+    # Un trabajo con el PID de este proceso pero sin tarea viene de un proceso anterior
+    orphaned = [
+        job for job in list_active_jobs()
+        if job["id"] not in _TASKS and (job["worker_pid"] == os.getpid() or not _pid_alive(job["worker_pid"]))
+    ]
+    for job in orphaned:
+        update_job(job["id"], status="failed", error="El proceso que ejecutaba el trabajo se detuvo.")
+    if orphaned:
+        print(f"Trabajos de ingesta interrumpidos marcados como fallidos: {len(orphaned)}")
+    return len(orphaned)
+
+async def _set_stage(job_id: str, stage: str):
+    """Move a job to its next stage, stopping there if cancellation was requested"""
+    if await asyncio.to_thread(is_job_cancel_requested, job_id):
+        raise asyncio.CancelledError()
+    await asyncio.to_thread(update_job, job_id, status="running", stage=stage)
+
+async def _run_ingest_job(job_id: str, tenant: str, session_id: str, uploads: List[Tuple[str, str]], engine: Optional[str]):
+    slots = _TENANT_SLOTS.setdefault(tenant, asyncio.Semaphore(INGEST_JOBS_PER_TENANT))
+    _TENANT_WAITING[tenant] = _TENANT_WAITING.get(tenant, 0) + 1
+    persist = None
+    try:
+        async with slots, _WORKERS:
+            await _set_stage(job_id, "extracting")
+            files: Dict[str, Dict[str, int]] = {}
+            last_update = 0.0
+            # Los archivos se procesan a la vez: las escrituras se serializan y cada una
+            # guarda el estado más reciente, así que una instantánea antigua nunca queda la última
+            progress_lock = asyncio.Lock()
+
+            async def write_progress():
+                async with progress_lock:
+                    await asyncio.to_thread(update_job, job_id, progress={"files": dict(files)})
+
+            async def progress(filename: str, pages_done: int, total_pages: int):
+                nonlocal last_update
+                log_progress(filename, pages_done, total_pages)
+                files[filename] = {"pages_done": pages_done, "total_pages": total_pages}
+                # SQLite se consulta en un hilo y como mucho cada JOB_PROGRESS_INTERVAL_SECONDS
+                # (y al terminar cada archivo), para no bloquear el bucle de eventos
+                now = time.monotonic()
+                if pages_done < total_pages and now - last_update < JOB_PROGRESS_INTERVAL_SECONDS:
+                    return
+                last_update = now
+                await write_progress()
+                # La cancelación puede pedirse desde otro worker
+                if await asyncio.to_thread(is_job_cancel_requested, job_id):
+                    raise asyncio.CancelledError()
+
+            documents = [doc for doc in await process_documents(uploads, progress) if doc]
+            if not documents:
+                raise ValueError("No se pudo procesar ningún archivo.")
+            processed_files = [{"filename": doc['name'], "chunks_count": len(doc['chunks'])} for doc in documents]
+            db = {"documents": documents}
+            await write_progress()
+
+            await _set_stage(job_id, "chunking")
+            with timed("chunk_table"):
+                chunk_table = await run_in_threadpool(build_chunk_table, documents)
+
+            await _set_stage(job_id, "indexing")
+            await run_in_threadpool(build_index, db, get_process_pool(), chunk_table, engine)
+
+            # A partir de aquí no se cancela: la sesión se publica de forma atómica
+            # (y solo entonces es consultable)
+            await _set_stage(job_id, "persisting")
+            persist = asyncio.ensure_future(run_in_threadpool(create_session, session_id, db))
+            await asyncio.shield(persist)
+
+            await asyncio.to_thread(
+                update_job, job_id, status="succeeded", stage="done",
+                result={"session_id": session_id, "processed_files": processed_files}
+            )
+    except asyncio.CancelledError:
+        if persist is not None:
+            # La sesión ya se está publicando: el trabajo termina igualmente
+            try:
+                await persist
+            except Exception as e:
+                print(f"Error en el trabajo de ingesta {job_id}: {e}")
+                await asyncio.to_thread(update_job, job_id, status="failed", error=str(e))
+                return
+            await asyncio.to_thread(
+                update_job, job_id, status="succeeded", stage="done",
+                result={"session_id": session_id, "processed_files": processed_files}
+            )
+            return
+        print(f"Trabajo de ingesta {job_id} cancelado.")
+        await asyncio.to_thread(update_job, job_id, status="cancelled")
+    except Exception as e:
+        print(f"Error en el trabajo de ingesta {job_id}: {e}")
+        await asyncio.to_thread(update_job, job_id, status="failed", error=str(e))
+    finally:
+        _TENANT_WAITING[tenant] -= 1
+        if not _TENANT_WAITING[tenant]:
+            del _TENANT_WAITING[tenant]
+            _TENANT_SLOTS.pop(tenant, None)
+
+def submit_ingest_job(tenant: str, uploads: List[Tuple[str, str]], session_id: Optional[str] = None, engine: Optional[str] = None) -> Dict[str, Any]:
+    """Queue the ingestion of stored uploads, given as (content_hash, filename), into a new session searched with engine"""
+    job_id = uuid.uuid4().hex
+    session_id = session_id or uuid.uuid4().hex
+    job = create_job(job_id, "ingest", tenant, session_id, os.getpid())
+    task = asyncio.create_task(_run_ingest_job(job_id, tenant, session_id, uploads, engine))
+    _TASKS[job_id] = task
+    task.add_done_callback(lambda _: _TASKS.pop(job_id, None))
+    return job
+
+def cancel_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Request cancellation of a job; it stops at its next stage or page range boundary"""
+    job = get_job(job_id)
+    if job is None:
+        return None
+    if job["stage"] == "persisting" or not request_job_cancel(job_id):
+        return job
+    task = _TASKS.get(job_id)
+    if task is not None:
+        task.cancel()
+    return get_job(job_id)
+
+async def shutdown_jobs():
+    """Cancel the jobs running in this process"""
+    tasks = list(_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,23 +1,76 @@
 # main.py
-import uuid
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Body
+import time
+# Inicio de la importación de la app, para medir el tiempo hasta que está lista
+IMPORT_STARTED = time.perf_counter()
+
+import os
+import json
+import asyncio
+import sqlite3
+from contextlib import aclosing, asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Body, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
 
 # Importar módulos organizados
-from config import get_google_api_key, set_google_api_key
-from database import initialize_database, list_chats, create_chat, delete_chat, list_messages, add_message
-from models import AskQuestionRequest, ConfigureApiKeyRequest, AskQuestionResponse
-from document_processor import process_document
-from search_engine import build_index, search_query
-from gemini_service import configure_gemini, generate_answer
-from session_manager import create_session, get_session, list_sessions
+from config import get_google_api_key, set_google_api_key, MAX_BATCH_QUERIES, ASK_STREAM_CONCURRENCY, MAX_PAGE_SIZE, MAX_MESSAGE_BATCH, INGEST_QUEUE_LIMIT, SERVER_TIMING, SESSION_WARMUP_COUNT
+from database import initialize_database, close_pool, list_chats, create_chat, delete_chat, list_messages, add_message, add_messages, flush_messages, message_writer_stats, get_job, count_active_jobs
+from models import AskQuestionRequest, ConfigureApiKeyRequest, AskQuestionResponse, BatchSearchRequest, BatchSearchResult, MessageBatchRequest
+from document_processor import process_documents, log_progress
+from search_engine import SEARCH_ENGINES, is_indexed, search_query, search_queries, add_documents, remove_document, copy_index, query_cache_stats, preload_search
+from gemini_service import configure_gemini, generate_answer, stream_answer_events, answer_cache_stats, context_packing_stats, preload_gemini
+from session_manager import get_session, list_sessions, save_session, cache_stats, run_session_sweeper, warm_up_sessions, session_writer, SessionConflictError
+from worker_pool import get_process_pool, shutdown_process_pool
+from job_queue import submit_ingest_job, cancel_job, fail_orphaned_jobs, shutdown_jobs
+from blob_store import store_upload, blob_path, parse_byte_range
+from metrics import start_request_timings, server_timing_header, inc, observe, render_metrics
+
+# --- Inicialización ---
+# Tiempos de arranque de este worker, expuestos en /status y /metrics
+STARTUP_STATS = {"import_to_ready_seconds": None, "warmup_seconds": None, "warmed_sessions": 0}
+
+async def warm_up():
+    """Load scikit-learn, the recently used sessions and the Gemini client in the background"""
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(preload_search)
+        STARTUP_STATS["warmed_sessions"] = await asyncio.to_thread(warm_up_sessions, SESSION_WARMUP_COUNT)
+        if get_google_api_key():
+            await asyncio.to_thread(preload_gemini)
+    except Exception as e:
+        print(f"Error en el precalentamiento: {e}")
+    STARTUP_STATS["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    print(f"Precalentamiento terminado en {STARTUP_STATS['warmup_seconds']:.2f} s ({STARTUP_STATS['warmed_sessions']} sesiones)")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    initialize_database()
+    if not get_google_api_key():
+        print("⚠️  La API Key de Google no está configurada.")
+        print("💡 La aplicación puede iniciarse, pero el endpoint /ask fallará si no hay clave.")
+        print("💡 Usa el endpoint /configure_api_key para configurar tu API key")
+    fail_orphaned_jobs()
+    session_sweeper = asyncio.create_task(run_session_sweeper())
+    warm_up_task = asyncio.create_task(warm_up())
+    STARTUP_STATS["import_to_ready_seconds"] = round(time.perf_counter() - IMPORT_STARTED, 3)
+    print(f"Aplicación lista en {STARTUP_STATS['import_to_ready_seconds']:.2f} s desde la importación")
+    yield
+    session_sweeper.cancel()
+    warm_up_task.cancel()
+    await shutdown_jobs()
+    shutdown_process_pool()
+    # Los mensajes aún en la cola de escritura diferida se guardan antes de cerrar
+    flush_messages()
+    close_pool()
 
 # --- Configuración de la App FastAPI ---
 app = FastAPI(
     title="RAG System API with Gemini",
     description="API para un sistema de Retrieval-Augmented Generation con FastAPI y Gemini.",
-    version="1.1.0"
+    version="1.1.0",
+    lifespan=lifespan
 )
 
 # --- CORS Middleware ---
@@ -27,26 +80,36 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # El visor de PDF necesita leer estas cabeceras para pedir rangos de bytes; X-Next-Cursor pagina chats y mensajes
+    expose_headers=["Accept-Ranges", "Content-Range", "Content-Length", "ETag", "X-Next-Cursor", "Server-Timing"],
 )
 
-# --- Inicialización ---
-# Initialize database
-initialize_database()
-
-# Configure Gemini
-try:
-    configure_gemini()
-except ValueError as e:
-    print(f"⚠️  Error de configuración de Gemini: {e}")
-    print("💡 La aplicación puede iniciarse, pero el endpoint /ask fallará si no hay clave.")
-    print("💡 Usa el endpoint /configure_api_key para configurar tu API key")
+# --- Métricas por petición ---
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    timings = start_request_timings()
+    response = await call_next(request)
+    # Las respuestas en streaming se miden hasta el envío de las cabeceras
+    elapsed = time.perf_counter() - start
+    endpoint = request.scope.get("endpoint")
+    endpoint = endpoint.__name__ if endpoint else "unmatched"
+    inc("rag_http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    observe("rag_http_request_seconds", elapsed, endpoint=endpoint)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+    return response
 
 # --- Endpoints de la API ---
 
 # Chat endpoints
 @app.get("/chats")
-def get_chats():
-    return list_chats()
+def get_chats(response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), before: Optional[int] = Query(None)):
+    chats = list_chats(limit, before)
+    # Paginación por cursor: el cliente pide la siguiente página con ?before=<X-Next-Cursor>
+    if limit is not None and len(chats) == limit:
+        response.headers["X-Next-Cursor"] = str(chats[-1]["id"])
+    return chats
 
 @app.post("/chats")
 def post_chat(title: str = Body(...), session_id: str = Body(...)):
@@ -58,48 +121,145 @@ def delete_chat_endpoint(chat_id: int):
 
 # Message endpoints
 @app.get("/chats/{chat_id}/messages")
-def get_messages(chat_id: int):
-    return list_messages(chat_id)
+def get_messages(chat_id: int, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), before: Optional[int] = Query(None)):
+    messages = list_messages(chat_id, limit, before)
+    if limit is not None and len(messages) == limit:
+        response.headers["X-Next-Cursor"] = str(messages[0]["id"])
+    return messages
 
 @app.post("/chats/{chat_id}/messages")
 def post_message(chat_id: int, sender: str = Body(...), text: str = Body(...), payload_json: dict = Body(default=None)):
-    return add_message(chat_id, sender, text, payload_json)
+    try:
+        return add_message(chat_id, sender, text, payload_json)
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=404, detail="Chat no encontrado.")
+
+@app.post("/chats/{chat_id}/messages:batch", summary="Guarda varios mensajes de un chat en una sola transacción")
+def post_messages_batch(chat_id: int, request: MessageBatchRequest):
+    if not (1 <= len(request.messages) <= MAX_MESSAGE_BATCH):
+        raise HTTPException(status_code=400, detail=f"Envía entre 1 y {MAX_MESSAGE_BATCH} mensajes.")
+    try:
+        return add_messages(chat_id, [msg.model_dump() for msg in request.messages])
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=404, detail="Chat no encontrado.")
 
 # Document processing endpoint
-@app.post("/ingest", summary="Ingesta y procesamiento de documentos")
-async def ingest_files(files: List[UploadFile] = File(...), session_id: Optional[str] = Query(None)):
+@app.post("/ingest", status_code=202, summary="Encola la ingesta y procesamiento de documentos")
+async def ingest_files(request: Request, files: List[UploadFile] = File(...), session_id: Optional[str] = Query(None), engine: Optional[str] = Query(None)):
     if not (3 <= len(files) <= 10):
         raise HTTPException(status_code=400, detail="Por favor, sube entre 3 y 10 archivos.")
+    if engine is not None and engine not in SEARCH_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Motor de búsqueda desconocido. Usa uno de: {', '.join(SEARCH_ENGINES)}.")
     
-    if not session_id:
-        session_id = uuid.uuid4().hex
+    if await run_in_threadpool(count_active_jobs) >= INGEST_QUEUE_LIMIT:
+        raise HTTPException(status_code=429, detail="Hay demasiadas ingestas en curso. Inténtalo más tarde.")
+    
+    # Los archivos se escriben en el blob store por bloques dentro de la petición;
+    # la extracción, el chunking y la indexación se hacen en un trabajo en segundo plano
+    uploads = [((await store_upload(file))[0], file.filename) for file in files]
+    tenant = request.headers.get("X-Tenant-Id") or (request.client.host if request.client else "anonymous")
+    job = submit_ingest_job(tenant, uploads, session_id, engine)
+    
+    return {
+        "message": "Ingesta encolada.",
+        "job_id": job["id"],
+        "session_id": job["session_id"],
+        "status": job["status"]
+    }
+
+# Ingestion job endpoints
+@app.get("/jobs/{job_id}", summary="Estado y progreso de un trabajo de ingesta")
+def get_job_endpoint(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+@app.post("/jobs/{job_id}/cancel", summary="Cancela un trabajo de ingesta")
+def cancel_job_endpoint(job_id: str):
+    job = cancel_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+# Incremental document endpoints
+# Otra petición (quizá en otro worker) publicó la sesión entre la carga y el guardado
+SESSION_CONFLICT_DETAIL = "La sesión fue modificada por otra petición; inténtalo de nuevo."
+SESSION_SAVE_ERROR_DETAIL = "No se pudo guardar la sesión; los cambios no se aplicaron."
+
+@app.post("/sessions/{session_id}/documents", summary="Añade documentos a una sesión existente")
+async def add_session_documents(session_id: str, files: List[UploadFile] = File(...)):
+    if not (1 <= len(files) <= 10):
+        raise HTTPException(status_code=400, detail="Por favor, sube entre 1 y 10 archivos.")
     
-    db = {"documents": [], "index": None, "vectorizer": None}
-    processed_files = []
+    db = get_session(session_id)
+    if not db:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
     
+    existing_names = {doc["name"] for doc in db["documents"]}
     for file in files:
-        file_content_bytes = await file.read()
-        document_data = process_document(file_content_bytes, file.filename)
-        
-        if document_data:
-            db['documents'].append(document_data)
-            processed_files.append({
-                "filename": file.filename, 
-                "chunks_count": len(document_data['chunks'])
-            })
-    
-    if not db['documents']:
+        if file.filename in existing_names:
+            raise HTTPException(status_code=409, detail=f"El documento {file.filename} ya existe en la sesión.")
+        existing_names.add(file.filename)
+    
+    uploads = [((await store_upload(file))[0], file.filename) for file in files]
+    new_documents = [doc for doc in await process_documents(uploads, log_progress) if doc]
+    processed_files = [{"filename": doc['name'], "chunks_count": len(doc['chunks'])} for doc in new_documents]
+    
+    if not new_documents:
         raise HTTPException(status_code=400, detail="No se pudo procesar ningún archivo.")
     
-    build_index(db)
-    create_session(session_id, db)
+    def add_to_session():
+        # Un solo escritor por sesión: se parte de la versión vigente (pudo cambiar durante la
+        # extracción) y se indexa sobre una copia; las búsquedas siguen usando la versión
+        # publicada hasta que se publica la nueva
+        with session_writer(session_id):
+            current = get_session(session_id)
+            if not current:
+                raise HTTPException(status_code=404, detail="Sesión no encontrada")
+            duplicated = {doc["name"] for doc in current["documents"]} & {doc["name"] for doc in new_documents}
+            if duplicated:
+                raise HTTPException(status_code=409, detail=f"El documento {sorted(duplicated)[0]} ya existe en la sesión.")
+            updated = copy_index(current)
+            add_documents(updated, new_documents, get_process_pool())
+            try:
+                save_session(session_id, updated)
+            except SessionConflictError:
+                raise HTTPException(status_code=409, detail=SESSION_CONFLICT_DETAIL)
+            except Exception:
+                raise HTTPException(status_code=500, detail=SESSION_SAVE_ERROR_DETAIL)
+    
+    await run_in_threadpool(add_to_session)
     
     return {
-        "message": "Archivos procesados e indexados exitosamente.", 
+        "message": "Documentos añadidos al índice exitosamente.", 
         "processed_files": processed_files, 
         "session_id": session_id
     }
 
+@app.delete("/sessions/{session_id}/documents/{document_name}", summary="Elimina un documento de una sesión")
+def delete_session_document(session_id: str, document_name: str):
+    # Las búsquedas siguen usando la versión publicada mientras se prepara y publica la nueva
+    with session_writer(session_id):
+        db = get_session(session_id)
+        if not db:
+            raise HTTPException(status_code=404, detail="Sesión no encontrada")
+        
+        updated = copy_index(db)
+        if not remove_document(updated, document_name):
+            raise HTTPException(status_code=404, detail="Documento no encontrado")
+        try:
+            save_session(session_id, updated)
+        except SessionConflictError:
+            raise HTTPException(status_code=409, detail=SESSION_CONFLICT_DETAIL)
+        except Exception:
+            raise HTTPException(status_code=500, detail=SESSION_SAVE_ERROR_DETAIL)
+    
+    return {
+        "status": "deleted",
+        "indexed_documents": [doc["name"] for doc in updated["documents"]]
+    }
+
 # Search endpoint
 @app.get("/search", summary="Busca pasajes relevantes")
 def search_endpoint(q: str = Query(..., min_length=3), session_id: Optional[str] = Query(None)):
@@ -107,7 +267,7 @@ def search_endpoint(q: str = Query(..., min_length=3), session_id: Optional[str]
         raise HTTPException(status_code=400, detail="session_id es requerido")
     
     db = get_session(session_id)
-    if not db or db.get('word_vectorizer') is None or db.get('char_vectorizer') is None:
+    if not is_indexed(db):
         raise HTTPException(status_code=503, detail="El índice no está listo.")
     
     try:
@@ -117,6 +277,27 @@ def search_endpoint(q: str = Query(..., min_length=3), session_id: Optional[str]
         print(f"Error durante la búsqueda: {e}")
         raise HTTPException(status_code=500, detail="Ocurrió un error al procesar la búsqueda.")
 
+@app.post("/search/batch", response_model=List[BatchSearchResult], summary="Busca pasajes para varias consultas a la vez")
+def search_batch_endpoint(request: BatchSearchRequest):
+    if not (1 <= len(request.queries) <= MAX_BATCH_QUERIES):
+        raise HTTPException(status_code=400, detail=f"Envía entre 1 y {MAX_BATCH_QUERIES} consultas.")
+    
+    db = get_session(request.session_id)
+    if not is_indexed(db):
+        raise HTTPException(status_code=503, detail="El índice no está listo.")
+    
+    try:
+        results = search_queries(
+            [query.q for query in request.queries],
+            db,
+            top_k=[query.top_k for query in request.queries],
+            thresholds=[query.threshold for query in request.queries]
+        )
+        return [BatchSearchResult(q=query.q, results=fragments) for query, fragments in zip(request.queries, results)]
+    except Exception as e:
+        print(f"Error durante la búsqueda por lotes: {e}")
+        raise HTTPException(status_code=500, detail="Ocurrió un error al procesar la búsqueda.")
+
 # Question answering endpoint
 @app.post("/ask", response_model=AskQuestionResponse, summary="Responde preguntas usando Gemini")
 async def ask_question(request: AskQuestionRequest):
@@ -124,20 +305,63 @@ async def ask_question(request: AskQuestionRequest):
         raise HTTPException(status_code=400, detail="session_id es requerido")
     
     db = get_session(request.session_id)
-    if not db or db.get('word_vectorizer') is None or db.get('char_vectorizer') is None:
+    if not is_indexed(db):
         raise HTTPException(status_code=503, detail="No hay documentos cargados.")
     
     if not get_google_api_key():
         raise HTTPException(status_code=500, detail="La API Key de Google no está configurada en el servidor.")
 
     try:
-        return generate_answer(request.question, db)
+        # La llamada al modelo es bloqueante: se ejecuta fuera del event loop
+        return await run_in_threadpool(generate_answer, request.question, db)
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         print(f"Error al generar respuesta: {e}")
         raise HTTPException(status_code=500, detail="Error al generar la respuesta con el modelo de lenguaje.")
 
+# Límite de respuestas en streaming abiertas a la vez contra el modelo
+ASK_STREAM_LIMITER = asyncio.Semaphore(ASK_STREAM_CONCURRENCY)
+
+def format_sse(event: str, data) -> str:
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Streaming question answering endpoint (Server-Sent Events)
+@app.post("/ask/stream", summary="Responde preguntas usando Gemini, enviando la respuesta a medida que se genera")
+async def ask_question_stream(request: AskQuestionRequest, http_request: Request):
+    if not request.session_id:
+        raise HTTPException(status_code=400, detail="session_id es requerido")
+    
+    db = get_session(request.session_id)
+    if not is_indexed(db):
+        raise HTTPException(status_code=503, detail="No hay documentos cargados.")
+    
+    if not get_google_api_key():
+        raise HTTPException(status_code=500, detail="La API Key de Google no está configurada en el servidor.")
+
+    async def event_stream():
+        async with ASK_STREAM_LIMITER:
+            # aclosing cierra el stream del modelo si el cliente se desconecta
+            async with aclosing(stream_answer_events(request.question, db)) as events:
+                try:
+                    async for event, data in events:
+                        if await http_request.is_disconnected():
+                            print("Cliente desconectado; se cancela la generación.")
+                            break
+                        yield format_sse(event, data)
+                except ValueError as e:
+                    yield format_sse("error", {"detail": str(e)})
+                except Exception as e:
+                    print(f"Error al generar respuesta: {e}")
+                    yield format_sse("error", {"detail": "Error al generar la respuesta con el modelo de lenguaje."})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # API key configuration endpoint
 @app.post("/configure_api_key", summary="Configura la API Key de Google")
 async def configure_api_key_endpoint(request: ConfigureApiKeyRequest):
@@ -159,17 +383,57 @@ def get_status(session_id: Optional[str] = Query(None)):
         db = get_session(session_id)
         return {
             "indexed_documents": [doc["name"] for doc in db["documents"]] if db else [],
-            "is_index_ready": bool(db and db.get("word_index") is not None and db.get("char_index") is not None),
+            "is_index_ready": is_indexed(db),
             "api_key_configured": get_google_api_key() is not None
         }
     return {
         "sessions": list_sessions(),
+        "session_cache": cache_stats(),
+        "query_cache": query_cache_stats(),
+        "answer_cache": answer_cache_stats(),
+        "context_packing": context_packing_stats(),
+        "message_writer": message_writer_stats(),
+        "startup": STARTUP_STATS,
         "api_key_configured": get_google_api_key() is not None
     }
 
+@app.get("/metrics", response_class=PlainTextResponse, summary="Métricas en formato Prometheus")
+def get_metrics():
+    # Cada worker expone sus propias series (histogramas por etapa y peticiones HTTP)
+    session_cache = cache_stats()
+    query_cache = query_cache_stats()
+    answer_cache = answer_cache_stats()
+    context_packing = context_packing_stats()
+    startup = {f"rag_startup_{name}": value for name, value in STARTUP_STATS.items() if value is not None}
+    return render_metrics({
+        **startup,
+        "rag_session_cache_resident_sessions": session_cache["resident_sessions"],
+        "rag_session_cache_resident_bytes": session_cache["resident_bytes"],
+        "rag_session_cache_hits": session_cache["hits"],
+        "rag_session_cache_misses": session_cache["misses"],
+        "rag_session_cache_evictions": session_cache["evictions"],
+        "rag_session_cache_invalidations": session_cache["invalidations"],
+        "rag_query_cache_hits": query_cache["hits"],
+        "rag_query_cache_misses": query_cache["misses"],
+        "rag_answer_cache_hits": answer_cache["hits"],
+        "rag_answer_cache_misses": answer_cache["misses"],
+        "rag_answer_cache_coalesced": answer_cache["coalesced"],
+        "rag_context_requests": context_packing["requests"],
+        "rag_context_retrieved_tokens": context_packing["retrieved_tokens"],
+        "rag_context_tokens": context_packing["context_tokens"],
+        "rag_context_merge_saved_tokens": context_packing["merge_saved_tokens"],
+        "rag_context_merged_fragments": context_packing["merged_fragments"],
+        "rag_context_dropped_fragments": context_packing["dropped_fragments"],
+        "rag_context_dropped_tokens": context_packing["dropped_tokens"],
+        "rag_message_queue_pending": message_writer_stats()["pending"],
+        "rag_ingest_jobs_active": count_active_jobs()
+    })
+
 # Document retrieval endpoint
+MEDIA_TYPES = {".pdf": "application/pdf", ".txt": "text/plain; charset=utf-8"}
+
 @app.get("/get_document/{document_name}", summary="Obtiene un documento por nombre")
-def get_document(document_name: str, session_id: Optional[str] = Query(None)):
+def get_document(document_name: str, request: Request, session_id: Optional[str] = Query(None)):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id es requerido")
     
@@ -181,10 +445,35 @@ def get_document(document_name: str, session_id: Optional[str] = Query(None)):
     if not document:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    return {
-        "name": document["name"],
-        "content_hex": document["content"]
-    }
+    media_type = MEDIA_TYPES.get(os.path.splitext(document_name)[1].lower(), "application/octet-stream")
+    path = blob_path(document["content_hash"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Contenido del documento no encontrado")
+    
+    # El contenido es direccionado por hash, así que el hash sirve de ETag
+    etag = f'"{document["content_hash"]}"'
+    cache_headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=cache_headers)
+    
+    range_header = request.headers.get("range")
+    if not range_header:
+        return FileResponse(path, media_type=media_type, headers=cache_headers)
+    
+    size = os.path.getsize(path)
+    byte_range = parse_byte_range(range_header, size)
+    if byte_range is None:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range
+    with open(path, "rb") as f:
+        f.seek(start)
+        content = f.read(end - start + 1)
+    return Response(
+        content=content,
+        status_code=206,
+        media_type=media_type,
+        headers={**cache_headers, "Content-Range": f"bytes {start}-{end}/{size}"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,126 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional, Callable, Iterator
+
+# Límites de los histogramas: latencias en segundos y tamaños (chunks, bytes)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(float(10 ** exponent) for exponent in range(0, 10))
+
+HELP = {
+    'rag_stage_seconds': 'Duration of each pipeline stage',
+    'rag_http_requests_total': 'HTTP requests by endpoint and status code',
+    'rag_http_request_seconds': 'HTTP request duration until the response headers',
+    'rag_search_chunks': 'Chunks in the session index of each search',
+    'rag_session_load_bytes': 'Estimated resident size of each session loaded from disk',
+    'rag_upload_bytes_total': 'Bytes received in uploaded files',
+}
+
+# Series de este proceso: (nombre, etiquetas ordenadas) -> contador o [cuentas por bucket, suma, total]
+_COUNTERS: Dict[Tuple[str, Tuple], float] = {}
+_HISTOGRAMS: Dict[Tuple[str, Tuple], List[Any]] = {}
+_BUCKETS: Dict[str, Tuple[float, ...]] = {}
+_LOCK = threading.Lock()
+
+# Etapas medidas durante la petición HTTP en curso (para la cabecera Server-Timing)
+_REQUEST_TIMINGS: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar('request_timings', default=None)
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    """Add value to a counter"""
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+    """Record one observation in a histogram"""
+    key = _key(name, labels)
+    position = bisect.bisect_left(buckets, value)
+    with _LOCK:
+        _BUCKETS.setdefault(name, buckets)
+        series = _HISTOGRAMS.get(key)
+        if series is None:
+            series = _HISTOGRAMS[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        series[0][position] += 1
+        series[1] += value
+        series[2] += 1
+
+def record_stage(stage: str, seconds: float, **labels):
+    """Record a stage duration measured elsewhere (e.g. in a worker process)"""
+    observe('rag_stage_seconds', seconds, stage=stage, **labels)
+    timings = _REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def timed(stage: str, **labels) -> Iterator[None]:
+    """Time the enclosed block as a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, **labels)
+
+def timed_call(function: Callable, *args) -> Tuple[float, Any]:
+    """Run function(*args) and return (seconds, result); picklable, for process pool tasks"""
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def start_request_timings() -> List[Tuple[str, float]]:
+    """Collect the stages timed from now on in this request's context"""
+    timings: List[Tuple[str, float]] = []
+    _REQUEST_TIMINGS.set(timings)
+    return timings
+
+def server_timing_header(timings: List[Tuple[str, float]], total: float) -> str:
+    """Server-Timing value: total duration per stage (in ms) plus the whole request"""
+    totals: Dict[str, float] = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items()]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+def _format_labels(labels: Tuple, extra: Tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+def render_metrics(gauges: Optional[Dict[str, float]] = None) -> str:
+    """Every series of this process in the Prometheus text format, plus the given gauges"""
+    lines = []
+    with _LOCK:
+        counters = sorted(_COUNTERS.items())
+        histograms = sorted((key, [list(series[0]), series[1], series[2]]) for key, series in _HISTOGRAMS.items())
+    described = set()
+
+    def describe(name: str, kind: str):
+        if name not in described:
+            described.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        describe(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), (counts, total, count) in histograms:
+        describe(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(_BUCKETS[name] + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else f"{bound:g}"
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:.6g}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name, value in sorted((gauges or {}).items()):
+        describe(name, 'gauge')
+        lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
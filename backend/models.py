@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 class AskQuestionRequest(BaseModel):
     question: str
@@ -15,6 +15,34 @@ class DocumentFragment(BaseModel):
     page_number: int = None
     text_position: dict = None
 
+class Citation(BaseModel):
+    document_name: str
+    document_id: str
+    page_number: int = None
+    text_position: dict = None
+    snippet: str
+
 class AskQuestionResponse(BaseModel):
     answer: str
-    citations: List[Dict[str, Any]]
+    citations: List[Citation]
+
+class BatchSearchQuery(BaseModel):
+    q: str = Field(..., min_length=3)
+    top_k: Optional[int] = Field(default=None, ge=1, le=100)
+    threshold: Optional[float] = None
+
+class BatchSearchRequest(BaseModel):
+    session_id: str
+    queries: List[BatchSearchQuery]
+
+class BatchSearchResult(BaseModel):
+    q: str
+    results: List[DocumentFragment]
+
+class MessageIn(BaseModel):
+    sender: str
+    text: str
+    payload_json: Optional[dict] = None
+
+class MessageBatchRequest(BaseModel):
+    messages: List[MessageIn]
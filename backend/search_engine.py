@@ -1,92 +1,687 @@
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
-from sklearn.metrics.pairwise import cosine_similarity
+import copy
+import uuid
+import threading
 import numpy as np
-from typing import Dict, Any, List
+import scipy.sparse as sp
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Dict, Any, List, Optional, Tuple
 from models import DocumentFragment
-from config import TOP_K_RESULTS, SIMILARITY_THRESHOLD
+from document_cache import CachedTexts, DocumentChunks
+from dense_index import dense_fields, build_dense_index, extend_dense_index, drop_dense_rows, dense_candidates
+from metrics import timed, timed_call, record_stage, observe, SIZE_BUCKETS
+from config import TOP_K_RESULTS, SIMILARITY_THRESHOLD, IDF_REFRESH_RATIO, QUERY_CACHE_SIZE, DEFAULT_SEARCH_ENGINE, BM25_K1, BM25_B, BM25_BLOCK_SIZE, INDEX_FEATURES, HASHED_FEATURES, HASHED_MIN_DF, LSA_CANDIDATES
 
-def build_index(db: Dict[str, Any]):
-    """Build TF-IDF index for documents"""
-    all_chunks = [chunk['text'] for doc in db['documents'] for chunk in doc['chunks']]
-    if not all_chunks:
-        db['word_vectorizer'] = None
-        db['char_vectorizer'] = None
-        db['word_index'] = None
-        db['char_index'] = None
-        return
+# scikit-learn (más de un segundo de importación) se importa en las funciones que
+# lo usan, de modo que arrancar la app no lo carga hasta la primera sesión
+
+# Lista simple de stopwords en español (compacta para no añadir dependencias)
+SPANISH_STOPWORDS = {
+    'de','la','que','el','en','y','a','los','del','se','las','por','un','para','con','no','una','su','al','lo','como','más','pero','sus','le','ya','o','este','sí','porque','esta','entre','cuando','muy','sin','sobre','también','me','hasta','hay','donde','quien','desde','todo','nos','durante','todos','uno','les','ni','contra','otros','ese','eso','ante','ellos','e','esto','mí','antes','algunos','qué','unos','yo','otro','otras','otra','él','tanto','esa','estos','mucho','quienes','nada','muchos','cual','poco','ella','estar','estas','algunas','algo','nosotros','mi','mis','tú','te','ti','tu','tus','ellas','nosotras','vosotros','vosotras','os','mío','mía','míos','mías','tuyo','tuya','tuyos','tuyas','suyo','suya','suyos','suyas','nuestro','nuestra','nuestros','nuestras','vuestro','vuestra','vuestros','vuestras','esos','esas','estoy','estás','está','estamos','estáis','están','esté','estés','estemos','estéis','estén','estaré','estarás','estará','estaremos','estaréis','estarán','estaba','estabas','estábamos','estabais','estaban','estuve','estuviste','estuvo','estuvimos','estuvisteis','estuvieron','estuviera','estuvieras','estuviéramos','estuvierais','estuvieran','estuviese','estuvieses','estuviésemos','estuvieseis','estuviesen','estando','estado','estada','estados','estadas','estad','he','has','ha','hemos','habéis','han','haya','hayas','hayamos','hayáis','hayan','habré','habrás','habrá','habremos','habréis','habrán','había','habías','habíamos','habíais','habían','hube','hubiste','hubo','hubimos','hubisteis','hubieron','hubiera','hubieras','hubiéramos','hubierais','hubieran','hubiese','hubieses','hubiésemos','hubieseis','hubiesen','habiendo','habido','habida','habidos','habidas','soy','eres','es','somos','sois','son','sea','seas','seamos','seáis','sean','seré','serás','será','seremos','seréis','serán','era','eras','éramos','erais','eran','fui','fuiste','fue','fuimos','fuisteis','fueron','fuera','fueras','fuéramos','fuerais','fueran','fuese','fueses','fuésemos','fueseis','fuesen','siendo','sido','tengo','tienes','tiene','tenemos','tenéis','tienen','tenga','tengas','tengamos','tengáis','tengan','tendré','tendrás','tendrá','tendremos','tendréis','tendrán','tenía','tenías','teníamos','teníais','tenían','tuve','tuviste','tuvo','tuvimos','tuvisteis','tuvieron','tuviera','tuvieras','tuviéramos','tuvierais','tuvieran','tuviese','tuvieses','tuviésemos','tuvieseis','tuviesen','teniendo','tenido','tenida','tenidos','tenidas'
+}
+
+# Espacios vectoriales del índice híbrido (palabras y caracteres) y su peso en la puntuación
+INDEX_SPACES = ('word', 'char')
+SPACE_WEIGHTS = {'word': 0.7, 'char': 0.3}
+
+# Motores de recuperación seleccionables por sesión: TF-IDF híbrido (coseno
+# exhaustivo), BM25 sobre un índice invertido con poda por bloques, o LSA
+# (candidatos por vecinos aproximados en un índice IVF denso, reordenados con
+# la puntuación TF-IDF híbrida)
+SEARCH_ENGINES = ('tfidf', 'bm25', 'lsa')
+# Campos del índice BM25: postings (chunks x términos, CSC con la frecuencia de
+# cada término), longitud de cada chunk, peso BM25 de cada posting y máximo de
+# esos pesos por término y bloque de BM25_BLOCK_SIZE chunks (con el primer
+# posting de cada par término-bloque)
+BM25_FIELDS = ('bm25_vectorizer', 'bm25_postings', 'bm25_lengths', 'bm25_impacts', 'bm25_block_max', 'bm25_block_starts')
+DENSE_FIELDS = tuple(dense_fields(INDEX_SPACES))
+
+# Caché LRU de resultados de búsqueda: (versión del índice, consulta normalizada, top_k, umbral) -> fragmentos
+_QUERY_CACHE: "OrderedDict[Tuple, List[DocumentFragment]]" = OrderedDict()
+_QUERY_CACHE_STATS = {"hits": 0, "misses": 0}
+_QUERY_CACHE_LOCK = threading.Lock()
+
+# Columnas numéricas de la tabla plana de chunks (alineada con las filas del índice)
+CHUNK_COLUMNS = ('document', 'page_number', 'start_pos', 'end_pos')
+
+def _space_options(space: str) -> Dict[str, Any]:
+    """Preprocessing of a TF-IDF space, shared by its vocabulary and hashed vectorizers"""
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    if space == 'word':
+        # Palabras con lematización simple por acentos y n-gramas 1-2
+        return {
+            'stop_words': list(SPANISH_STOPWORDS.union(ENGLISH_STOP_WORDS)),
+            'ngram_range': (1, 2),
+            'strip_accents': 'unicode',
+            'lowercase': True
+        }
+    # Caracteres para captar variaciones morfológicas y errores (char_wb)
+    return {'analyzer': 'char_wb', 'ngram_range': (3, 5), 'strip_accents': 'unicode', 'lowercase': True}
+
+def new_vectorizer(space: str, n_features: Optional[int] = None):
+    """Create an unfitted vectorizer for an index space.
+
+    With n_features the space is hashed: terms map to a fixed number of
+    columns, so there is no vocabulary to build, store or load.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer, HashingVectorizer, ENGLISH_STOP_WORDS
+    if n_features:
+        return HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None, dtype=np.float32, **_space_options(space))
+    if space == 'bm25':
+        # BM25 cuenta términos sueltos; los pesos se calculan en _bm25_weights
+        return CountVectorizer(
+            stop_words=list(SPANISH_STOPWORDS.union(ENGLISH_STOP_WORDS)),
+            strip_accents='unicode',
+            lowercase=True,
+            dtype=np.float32
+        )
+    return TfidfVectorizer(**_space_options(space))
+
+def _bump_version(db: Dict[str, Any]):
+    """Give the index a new version so cached results for the old one stop matching"""
+    db['index_version'] = uuid.uuid4().hex
+
+def preload_search():
+    """Import scikit-learn ahead of the first index build or session load"""
+    import sklearn.feature_extraction.text  # noqa: F401
+    import sklearn.preprocessing  # noqa: F401
+
+def normalize_query(q: str) -> str:
+    """Normalize a query the same way the vectorizers preprocess text"""
+    from sklearn.feature_extraction.text import strip_accents_unicode
+    return " ".join(strip_accents_unicode(q.lower()).split())
+
+def query_cache_stats() -> Dict[str, int]:
+    """Query result cache counters"""
+    with _QUERY_CACHE_LOCK:
+        return {**_QUERY_CACHE_STATS, "entries": len(_QUERY_CACHE), "max_entries": QUERY_CACHE_SIZE}
+
+def session_engine(db: Dict[str, Any]) -> str:
+    """Retrieval engine of a session (sessions indexed before engines existed use TF-IDF)"""
+    return db.get('engine') or 'tfidf'
+
+def is_indexed(db: Optional[Dict[str, Any]]) -> bool:
+    """Whether a session has an index its engine can search"""
+    if not db:
+        return False
+    if session_engine(db) == 'bm25':
+        return db.get('bm25_postings') is not None
+    if session_engine(db) == 'lsa' and db.get('lsa_vectors') is None:
+        return False
+    return db.get('word_vectorizer') is not None and db.get('char_vectorizer') is not None
+
+def _clear_index(db: Dict[str, Any]):
+    """Reset every index field of a session"""
+    for space in INDEX_SPACES:
+        db[f'{space}_vectorizer'] = None
+        db[f'{space}_index'] = None
+        db[f'{space}_df'] = None
+        db[f'{space}_idf'] = None
+    for field in BM25_FIELDS + DENSE_FIELDS:
+        db[field] = None
+    db['chunk_table'] = None
+    db['idf_pending_chunks'] = 0
+    _bump_version(db)
+
+def _compute_idf(df: np.ndarray, n_chunks: int) -> np.ndarray:
+    """Smoothed IDF, same formula as TfidfTransformer(smooth_idf=True)"""
+    return np.log((1 + n_chunks) / (1 + df)) + 1.0
+
+def is_hashed(vectorizer) -> bool:
+    from sklearn.feature_extraction.text import HashingVectorizer
+    return isinstance(vectorizer, HashingVectorizer)
 
-    # Lista simple de stopwords en español (compacta para no añadir dependencias)
-    spanish_stopwords = {
-        'de','la','que','el','en','y','a','los','del','se','las','por','un','para','con','no','una','su','al','lo','como','más','pero','sus','le','ya','o','este','sí','porque','esta','entre','cuando','muy','sin','sobre','también','me','hasta','hay','donde','quien','desde','todo','nos','durante','todos','uno','les','ni','contra','otros','ese','eso','ante','ellos','e','esto','mí','antes','algunos','qué','unos','yo','otro','otras','otra','él','tanto','esa','estos','mucho','quienes','nada','muchos','cual','poco','ella','estar','estas','algunas','algo','nosotros','mi','mis','tú','te','ti','tu','tus','ellas','nosotras','vosotros','vosotras','os','mío','mía','míos','mías','tuyo','tuya','tuyos','tuyas','suyo','suya','suyos','suyas','nuestro','nuestra','nuestros','nuestras','vuestro','vuestra','vuestros','vuestras','esos','esas','estoy','estás','está','estamos','estáis','están','esté','estés','estemos','estéis','estén','estaré','estarás','estará','estaremos','estaréis','estarán','estaba','estabas','estábamos','estabais','estaban','estuve','estuviste','estuvo','estuvimos','estuvisteis','estuvieron','estuviera','estuvieras','estuviéramos','estuvierais','estuvieran','estuviese','estuvieses','estuviésemos','estuvieseis','estuviesen','estando','estado','estada','estados','estadas','estad','he','has','ha','hemos','habéis','han','haya','hayas','hayamos','hayáis','hayan','habré','habrás','habrá','habremos','habréis','habrán','había','habías','habíamos','habíais','habían','hube','hubiste','hubo','hubimos','hubisteis','hubieron','hubiera','hubieras','hubiéramos','hubierais','hubieran','hubiese','hubieses','hubiésemos','hubieseis','hubiesen','habiendo','habido','habida','habidos','habidas','soy','eres','es','somos','sois','son','sea','seas','seamos','seáis','sean','seré','serás','será','seremos','seréis','serán','era','eras','éramos','erais','eran','fui','fuiste','fue','fuimos','fuisteis','fueron','fuera','fueras','fuéramos','fuerais','fueran','fuese','fueses','fuésemos','fueseis','fuesen','siendo','sido','tengo','tienes','tiene','tenemos','tenéis','tienen','tenga','tengas','tengamos','tengáis','tengan','tendré','tendrás','tendrá','tendremos','tendréis','tendrán','tenía','tenías','teníamos','teníais','tenían','tuve','tuviste','tuvo','tuvimos','tuvisteis','tuvieron','tuviera','tuvieras','tuviéramos','tuvierais','tuvieran','tuviese','tuvieses','tuviésemos','tuvieseis','tuviesen','teniendo','tenido','tenida','tenidos','tenidas'
+def _count_matrix(texts: List[str], vectorizer, grow: bool = False) -> sp.csr_matrix:
+    """Term counts for texts using the vectorizer's analyzer and vocabulary.
+
+    With grow=True unseen terms are appended to the vocabulary (new columns).
+    Hashed vectorizers have a fixed set of columns and never grow.
+    """
+    if is_hashed(vectorizer):
+        matrix = vectorizer.transform(texts)
+        matrix.sort_indices()
+        return matrix
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    if grow and not isinstance(vocabulary, dict):
+        # Vocabulario mapeado desde disco (solo lectura): se materializa para crecer
+        vocabulary = vectorizer.vocabulary_ = dict(vocabulary.items())
+    indices, values, indptr = [], [], [0]
+    for text in texts:
+        counts: Dict[int, int] = {}
+        for term in analyzer(text):
+            col = vocabulary.get(term)
+            if col is None:
+                if not grow:
+                    continue
+                col = vocabulary[term] = len(vocabulary)
+            counts[col] = counts.get(col, 0) + 1
+        indices.extend(counts.keys())
+        values.extend(counts.values())
+        indptr.append(len(indices))
+    matrix = sp.csr_matrix(
+        (np.asarray(values, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(texts), len(vocabulary))
+    )
+    matrix.sort_indices()
+    return matrix
+
+def _weight(counts: sp.csr_matrix, idf: np.ndarray) -> sp.csr_matrix:
+    """Apply IDF weights and L2-normalize rows in place (pruned features have IDF 0 and are dropped)"""
+    counts.data *= idf[counts.indices]
+    from sklearn.preprocessing import normalize
+    counts.eliminate_zeros()
+    return normalize(counts, norm='l2', copy=False)
+
+def _prune(idf: np.ndarray, df: np.ndarray, vectorizer) -> np.ndarray:
+    """Zero the IDF of hashed features found in fewer than HASHED_MIN_DF chunks"""
+    if is_hashed(vectorizer) and HASHED_MIN_DF > 1:
+        idf = idf.copy()
+        idf[df < HASHED_MIN_DF] = 0
+    return idf
+
+def _transform(texts: List[str], db: Dict[str, Any], space: str) -> sp.csr_matrix:
+    """Vectorize texts (queries or new chunks) against the current vocabulary and IDF"""
+    return _weight(_count_matrix(texts, db[f'{space}_vectorizer']), db[f'{space}_idf'])
+
+def _weighted_rows(db: Dict[str, Any], start: int = 0) -> Dict[str, sp.csr_matrix]:
+    """Index rows from start on, scaled so that dot products give the hybrid score"""
+    return {space: db[f'{space}_index'][start:] * np.sqrt(SPACE_WEIGHTS[space]) for space in INDEX_SPACES}
+
+def _pad_columns(matrix: sp.spmatrix, n_cols: int) -> sp.spmatrix:
+    """Widen a CSR (or CSC) matrix to n_cols"""
+    if matrix.shape[1] == n_cols:
+        return matrix
+    if sp.isspmatrix_csc(matrix):
+        # En CSC cada columna nueva es un puntero más (postings vacíos)
+        indptr = np.concatenate([matrix.indptr, np.full(n_cols - matrix.shape[1], matrix.indptr[-1], dtype=matrix.indptr.dtype)])
+        return sp.csc_matrix((matrix.data, matrix.indices, indptr), shape=(matrix.shape[0], n_cols))
+    return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], n_cols))
+
+def build_chunk_table(documents: List[Dict[str, Any]], first_document: int = 0) -> Dict[str, Any]:
+    """Flatten the documents' chunks into columnar arrays aligned with the index rows.
+
+    Documents from the document cache only contribute their offset arrays;
+    their text stays in the cache and is sliced out when a row is read.
+    """
+    if documents and all(isinstance(doc['chunks'], DocumentChunks) for doc in documents):
+        return {
+            'document': np.repeat(np.arange(first_document, first_document + len(documents), dtype=np.int32), [len(doc['chunks']) for doc in documents]),
+            'page_number': np.concatenate([doc['chunks'].page_numbers() for doc in documents]).astype(np.int32),
+            'start_pos': np.concatenate([doc['chunks'].document.chunk_start for doc in documents]).astype(np.int32),
+            'end_pos': np.concatenate([doc['chunks'].document.chunk_end for doc in documents]).astype(np.int32),
+            'text': CachedTexts([doc['chunks'].document for doc in documents])
+        }
+    rows = [(position, chunk) for position, doc in enumerate(documents, first_document) for chunk in doc['chunks']]
+    table = {
+        column: np.fromiter(
+            (position if column == 'document' else (chunk[column] or 0) for position, chunk in rows),
+            dtype=np.int32, count=len(rows)
+        )
+        for column in CHUNK_COLUMNS
     }
-    combined_stopwords = list(spanish_stopwords.union(ENGLISH_STOP_WORDS))
-
-    # Vectorizador de palabras con lematización simple por acentos y n-gramas 1-2
-    word_vectorizer = TfidfVectorizer(
-        stop_words=combined_stopwords,
-        ngram_range=(1, 2),
-        strip_accents='unicode',
-        lowercase=True
+    table['text'] = [chunk['text'] for _, chunk in rows]
+    return table
+
+def _extend_chunk_table(table: Dict[str, Any], extra: Dict[str, Any]):
+    for column in CHUNK_COLUMNS:
+        table[column] = np.concatenate([table[column], extra[column]])
+    if isinstance(table['text'], CachedTexts) and isinstance(extra['text'], CachedTexts):
+        table['text'] = table['text'] + extra['text']
+    else:
+        # Los textos mapeados desde disco son de solo lectura: se pasan a lista al mutar
+        table['text'] = list(table['text']) + list(extra['text'])
+
+def _drop_chunk_rows(table: Dict[str, Any], start: int, stop: int, document_position: int):
+    for column in CHUNK_COLUMNS:
+        table[column] = np.concatenate([table[column][:start], table[column][stop:]])
+    table['document'][table['document'] > document_position] -= 1
+    if isinstance(table['text'], CachedTexts):
+        table['text'] = table['text'].without(document_position)
+        return
+    text = list(table['text'])
+    del text[start:stop]
+    table['text'] = text
+
+def upgrade_index(db: Dict[str, Any]):
+    """Derive DF/IDF arrays and the chunk table for sessions indexed before they existed"""
+    if db.get('chunk_table') is None:
+        db['chunk_table'] = build_chunk_table(db['documents'])
+    if db.get('index_version') is None:
+        _bump_version(db)
+    for space in INDEX_SPACES:
+        index = db.get(f'{space}_index')
+        if index is None or db.get(f'{space}_idf') is not None:
+            continue
+        db[f'{space}_df'] = np.bincount(index.indices, minlength=index.shape[1])
+        db[f'{space}_idf'] = db[f'{space}_vectorizer'].idf_.copy()
+
+def _chunk_count(db: Dict[str, Any]) -> int:
+    if db.get('chunk_table') is not None:
+        return len(db['chunk_table']['document'])
+    return sum(len(doc['chunks']) for doc in db['documents'])
+
+def _fit_space(space: str, texts: List[str]) -> Tuple[Any, sp.csr_matrix, np.ndarray, np.ndarray]:
+    """Fit one index space, returning its vectorizer, weighted rows, DF and IDF (runs in a worker process when parallel)"""
+    if INDEX_FEATURES == 'hashed':
+        vectorizer = new_vectorizer(space, HASHED_FEATURES[space])
+        counts = _count_matrix(texts, vectorizer)
+        df = np.bincount(counts.indices, minlength=counts.shape[1]).astype(np.int32)
+        idf = _prune(_compute_idf(df, counts.shape[0]).astype(np.float32), df, vectorizer)
+        return vectorizer, _weight(counts, idf), df, idf
+    vectorizer = new_vectorizer(space)
+    index = vectorizer.fit_transform(texts)
+    return vectorizer, index, np.bincount(index.indices, minlength=index.shape[1]), vectorizer.idf_.copy()
+
+def _fit_bm25(texts: List[str]) -> Tuple[Any, sp.csc_matrix]:
+    """Count the terms of every chunk (runs in a worker process when parallel)"""
+    vectorizer = new_vectorizer('bm25')
+    return vectorizer, vectorizer.fit_transform(texts).tocsc()
+
+def _bm25_weights(db: Dict[str, Any]):
+    """Compute the BM25 weight of every posting and the per-block maxima.
+
+    Works on the stored term frequencies only, so it is cheap enough to rerun
+    after every change: BM25 weights depend on the chunk count, the document
+    frequencies and the average chunk length, which all move together.
+    """
+    postings = db['bm25_postings']
+    lengths = db['bm25_lengths']
+    n_chunks, n_terms = postings.shape
+    df = np.diff(postings.indptr)
+    idf = np.log1p((n_chunks - df + 0.5) / (df + 0.5)).astype(np.float32)
+    length_norm = (BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(float(lengths.mean()), 1.0))).astype(np.float32)
+    terms = np.repeat(np.arange(n_terms, dtype=np.int32), df)
+    tf = postings.data
+    impacts = idf[terms] * tf * (BM25_K1 + 1) / (tf + length_norm[postings.indices])
+    db['bm25_impacts'] = impacts.astype(np.float32)
+
+    # Máximo por (término, bloque) y posición del primer posting de cada par: los
+    # postings de cada término están ordenados por chunk, así que las claves
+    # término*n_bloques+bloque no decrecen
+    n_blocks = -(-n_chunks // BM25_BLOCK_SIZE)
+    keys = terms.astype(np.int64) * n_blocks + postings.indices // BM25_BLOCK_SIZE
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+    block_max = np.maximum.reduceat(impacts, starts) if len(starts) else np.zeros(0, dtype=np.float32)
+    db['bm25_block_max'] = sp.csr_matrix(
+        (block_max.astype(np.float32), (keys[starts] % n_blocks).astype(np.int32), np.searchsorted(keys[starts] // n_blocks, np.arange(n_terms + 1))),
+        shape=(n_terms, n_blocks)
     )
-    word_index = word_vectorizer.fit_transform(all_chunks)
-
-    # Vectorizador de caracteres para captar variaciones morfológicas y errores (char_wb)
-    char_vectorizer = TfidfVectorizer(
-        analyzer='char_wb',
-        ngram_range=(3, 5),
-        strip_accents='unicode',
-        lowercase=True
+    db['bm25_block_starts'] = starts.astype(np.int64)
+
+def _set_bm25_postings(db: Dict[str, Any], postings: sp.csc_matrix):
+    postings.sort_indices()
+    db['bm25_postings'] = postings
+    db['bm25_lengths'] = np.asarray(postings.sum(axis=1)).ravel().astype(np.int32)
+    _bm25_weights(db)
+
+def build_index(db: Dict[str, Any], executor: Optional[Executor] = None, chunk_table: Optional[Dict[str, Any]] = None, engine: Optional[str] = None):
+    """Build the session's index with its engine (TF-IDF spaces or BM25 postings), fitting on the executor if given"""
+    _clear_index(db)
+    db['engine'] = engine or db.get('engine') or DEFAULT_SEARCH_ENGINE
+    if chunk_table is None:
+        chunk_table = build_chunk_table(db['documents'])
+    all_chunks = chunk_table['text']
+    if not all_chunks:
+        return
+    db['chunk_table'] = chunk_table
+
+    if db['engine'] == 'bm25':
+        seconds, (vectorizer, postings) = executor.submit(timed_call, _fit_bm25, all_chunks).result() if executor is not None else timed_call(_fit_bm25, all_chunks)
+        record_stage('fit', seconds, space='bm25')
+        db['bm25_vectorizer'] = vectorizer
+        _set_bm25_postings(db, postings)
+        print("Índice invertido BM25 construido exitosamente.")
+        return
+
+    mapper = executor.map if executor is not None else map
+    # El ajuste se mide dentro del worker; la duración vuelve con el resultado
+    fitted = mapper(timed_call, [_fit_space] * len(INDEX_SPACES), INDEX_SPACES, [all_chunks] * len(INDEX_SPACES))
+    for space, (seconds, (vectorizer, index, df, idf)) in zip(INDEX_SPACES, fitted):
+        record_stage('fit', seconds, space=space)
+        db[f'{space}_vectorizer'] = vectorizer
+        db[f'{space}_index'] = index
+        # Frecuencias de documento para poder actualizar el IDF de forma incremental
+        db[f'{space}_df'] = df
+        db[f'{space}_idf'] = idf
+    print(f"Índice TF-IDF (palabras+caracteres{', hashed' if INDEX_FEATURES == 'hashed' else ''}) construido exitosamente.")
+    if db['engine'] == 'lsa':
+        with timed('fit', space='lsa'):
+            build_dense_index(db, _weighted_rows(db))
+        print(f"Índice denso LSA construido ({len(db['lsa_centroids'])} listas IVF).")
+
+def refresh_idf(db: Dict[str, Any]):
+    """Recompute IDF from the document frequencies and reweight the existing rows.
+
+    Works on the stored matrices only (no re-tokenization): each row is scaled
+    by idf_new / idf_old per term and re-normalized, since the L2 norm absorbs
+    the row's old scale.
+    """
+    from sklearn.preprocessing import normalize
+    n_chunks = _chunk_count(db)
+    for space in INDEX_SPACES:
+        index = db.get(f'{space}_index')
+        if index is None:
+            continue
+        old_idf = db[f'{space}_idf']
+        new_idf = _prune(_compute_idf(db[f'{space}_df'], n_chunks).astype(old_idf.dtype), db[f'{space}_df'], db[f'{space}_vectorizer'])
+        # Se reescala una copia: la matriz actual puede estar mapeada desde disco o en uso por otras búsquedas
+        index = index.copy()
+        # Los rasgos ya podados no tienen entradas en la matriz: siguen podados hasta reconstruir el índice
+        new_idf[old_idf == 0] = 0
+        ratio = np.divide(new_idf, old_idf, out=np.zeros_like(new_idf), where=old_idf > 0)
+        index.data *= ratio[index.indices]
+        index.eliminate_zeros()
+        db[f'{space}_index'] = normalize(index, norm='l2', copy=False)
+        db[f'{space}_idf'] = new_idf
+    db['idf_pending_chunks'] = 0
+    _bump_version(db)
+
+def copy_index(db: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a session so add_documents/remove_document can change it while readers use the original.
+
+    Arrays and matrices are shared: the updates replace them instead of
+    writing into them. Only what is changed in place is copied: the document
+    list, the chunk table and the vocabularies, which grow with new terms.
+    """
+    updated = dict(db)
+    updated['documents'] = list(db['documents'])
+    if db.get('chunk_table') is not None:
+        updated['chunk_table'] = dict(db['chunk_table'])
+    for field in [f'{space}_vectorizer' for space in INDEX_SPACES] + ['bm25_vectorizer']:
+        vectorizer = db.get(field)
+        if vectorizer is not None and not is_hashed(vectorizer):
+            vectorizer = updated[field] = copy.copy(vectorizer)
+            if isinstance(vectorizer.vocabulary_, dict):
+                vectorizer.vocabulary_ = dict(vectorizer.vocabulary_)
+    return updated
+
+def _maybe_refresh_idf(db: Dict[str, Any]):
+    """Refresh IDF once enough chunks changed since the last refresh"""
+    if db.get('idf_pending_chunks', 0) > IDF_REFRESH_RATIO * max(_chunk_count(db), 1):
+        refresh_idf(db)
+
+def add_documents(db: Dict[str, Any], documents: List[Dict[str, Any]], executor: Optional[Executor] = None):
+    """Append documents to an existing index vectorizing only their chunks"""
+    if not documents:
+        return
+    if not is_indexed(db):
+        db['documents'].extend(documents)
+        build_index(db, executor)
+        return
+
+    upgrade_index(db)
+    first_row = _chunk_count(db)
+    with timed('chunk_table'):
+        new_table = build_chunk_table(documents, first_document=len(db['documents']))
+    new_chunks = new_table['text']
+    db['documents'].extend(documents)
+    _extend_chunk_table(db['chunk_table'], new_table)
+    with timed('index_update', engine=session_engine(db)):
+        if session_engine(db) == 'bm25':
+            counts = _count_matrix(new_chunks, db['bm25_vectorizer'], grow=True)
+            _set_bm25_postings(db, sp.vstack(
+                [_pad_columns(db['bm25_postings'], counts.shape[1]), counts.astype(np.float32)], format='csc'
+            ))
+            _bump_version(db)
+            print(f"Índice actualizado: {len(new_chunks)} chunks nuevos.")
+            return
+        n_chunks = _chunk_count(db)
+        for space in INDEX_SPACES:
+            counts = _count_matrix(new_chunks, db[f'{space}_vectorizer'], grow=True)
+            n_terms = counts.shape[1]
+            df = db[f'{space}_df']
+            n_new_terms = n_terms - len(df)
+            df = np.concatenate([df, np.zeros(n_new_terms, dtype=df.dtype)])
+            df += np.bincount(counts.indices, minlength=n_terms).astype(df.dtype)
+            # Los términos nuevos reciben su IDF actual; los existentes conservan el
+            # vigente hasta el próximo refresco para que todas las filas sean coherentes
+            idf = np.concatenate([db[f'{space}_idf'], _compute_idf(df[len(df) - n_new_terms:], n_chunks).astype(db[f'{space}_idf'].dtype)])
+            db[f'{space}_df'] = df
+            db[f'{space}_idf'] = idf
+            db[f'{space}_index'] = sp.vstack(
+                [_pad_columns(db[f'{space}_index'], n_terms), _weight(counts, idf)], format='csr'
+            )
+        if session_engine(db) == 'lsa':
+            # Las filas nuevas se proyectan con la base LSA actual (se reajusta al reconstruir)
+            extend_dense_index(db, _weighted_rows(db, first_row), first_row)
+    db['idf_pending_chunks'] = db.get('idf_pending_chunks', 0) + len(new_chunks)
+    _bump_version(db)
+    _maybe_refresh_idf(db)
+    print(f"Índice actualizado: {len(new_chunks)} chunks nuevos.")
+
+def remove_document(db: Dict[str, Any], document_name: str) -> bool:
+    """Drop a document and its rows from the index without re-vectorizing"""
+    position = next((i for i, doc in enumerate(db['documents']) if doc['name'] == document_name), None)
+    if position is None:
+        return False
+    start = sum(len(doc['chunks']) for doc in db['documents'][:position])
+    stop = start + len(db['documents'][position]['chunks'])
+    indexed = is_indexed(db)
+    if indexed:
+        upgrade_index(db)
+    del db['documents'][position]
+
+    if not db['documents']:
+        _clear_index(db)
+        return True
+    if not indexed:
+        return True
+
+    _drop_chunk_rows(db['chunk_table'], start, stop, position)
+    if session_engine(db) == 'bm25':
+        postings = db['bm25_postings']
+        _set_bm25_postings(db, sp.vstack([postings[:start], postings[stop:]], format='csc'))
+        _bump_version(db)
+        print(f"Documento {document_name} eliminado del índice ({stop - start} chunks).")
+        return True
+    for space in INDEX_SPACES:
+        index = db[f'{space}_index']
+        removed = index[start:stop]
+        db[f'{space}_df'] = db[f'{space}_df'] - np.bincount(removed.indices, minlength=index.shape[1]).astype(db[f'{space}_df'].dtype)
+        db[f'{space}_index'] = sp.vstack([index[:start], index[stop:]], format='csr')
+    if session_engine(db) == 'lsa':
+        drop_dense_rows(db, start, stop)
+    db['idf_pending_chunks'] = db.get('idf_pending_chunks', 0) + (stop - start)
+    _bump_version(db)
+    _maybe_refresh_idf(db)
+    print(f"Documento {document_name} eliminado del índice ({stop - start} chunks).")
+    return True
+
+def _score(queries: List[str], db: Dict[str, Any]) -> np.ndarray:
+    """Hybrid scores of every chunk for a batch of queries, shape (n_chunks, n_queries).
+
+    Index rows and query vectors are already L2-normalized, so the plain dot
+    product is the cosine. The space weights are folded into the query
+    vectors and each space costs a single sparse product for the whole batch,
+    accumulated into the same score buffer.
+    """
+    scores = np.zeros((_chunk_count(db), len(queries)))
+    for space in INDEX_SPACES:
+        with timed('query_transform', engine='tfidf'):
+            query_matrix = _transform(queries, db, space)
+        query_matrix.data *= SPACE_WEIGHTS[space]
+        index = db[f'{space}_index']
+        with timed('scoring', engine='tfidf'):
+            if len(queries) == 1:
+                # Una sola consulta: producto matriz-vector denso, sin matriz dispersa intermedia
+                query_vector = np.zeros(index.shape[1], dtype=index.dtype)
+                query_vector[query_matrix.indices] = query_matrix.data
+                scores[:, 0] += index @ query_vector
+            else:
+                scores += (index @ query_matrix.T).toarray()
+    return scores
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k best scores in descending order, without a full sort"""
+    if len(scores) > k:
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+def _block_postings(db: Dict[str, Any], term: int, selected: np.ndarray) -> np.ndarray:
+    """Positions of a term's postings that fall in the selected blocks"""
+    block_max = db['bm25_block_max']
+    first, last = block_max.indptr[term], block_max.indptr[term + 1]
+    starts = db['bm25_block_starts'][first:last]
+    ends = np.r_[starts[1:], db['bm25_postings'].indptr[term + 1]]
+    keep = selected[block_max.indices[first:last]]
+    starts, lengths = starts[keep], (ends - starts)[keep]
+    if not len(starts):
+        return starts
+    # Concatenación vectorizada de los rangos [start, start+length)
+    return np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+
+def _bm25_search(query: str, db: Dict[str, Any], k: int, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact BM25 top-k over the inverted index with block-max pruning.
+
+    The chunks are split into blocks of BM25_BLOCK_SIZE rows. A block's upper
+    bound is the sum of its per-term maxima, so blocks are scored best bound
+    first, in rounds of doubling size, and only while their bound can still
+    beat the current k-th score. The work is proportional to the postings of
+    the visited blocks, not to the number of chunks.
+    """
+    with timed('query_transform', engine='bm25'):
+        counts = _count_matrix([query], db['bm25_vectorizer'])
+    terms, weights = counts.indices, counts.data.astype(np.float32)
+    rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    if not len(terms):
+        return rows, scores
+    with timed('scoring', engine='bm25'):
+        return _bm25_blocks(db, terms, weights, k, threshold)
+
+def _bm25_blocks(db: Dict[str, Any], terms: np.ndarray, weights: np.ndarray, k: int, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Score the query terms' blocks best bound first (see _bm25_search)"""
+    rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    postings = db['bm25_postings']
+    impacts = db['bm25_impacts']
+    bounds = np.asarray(db['bm25_block_max'][terms].T @ weights).ravel()
+    pending = np.argsort(-bounds, kind='stable')
+    floor = threshold
+    batch = 1
+    while len(pending) and bounds[pending[0]] > floor:
+        visit, pending = pending[:batch], pending[batch:]
+        visit = visit[bounds[visit] > floor]
+        selected = np.zeros(len(bounds), dtype=bool)
+        selected[visit] = True
+        positions = [_block_postings(db, term, selected) for term in terms]
+        block_rows = np.concatenate([postings.indices[p] for p in positions])
+        block_scores = np.concatenate([weight * impacts[p] for p, weight in zip(positions, weights)])
+        # Suma por chunk de las contribuciones de cada término
+        block_rows, inverse = np.unique(block_rows, return_inverse=True)
+        block_scores = np.bincount(inverse, weights=block_scores, minlength=len(block_rows))
+        hits = block_scores > floor
+        rows = np.concatenate([rows, block_rows[hits]])
+        scores = np.concatenate([scores, block_scores[hits].astype(np.float32)])
+        if len(rows) > k:
+            best = _top_k(scores, k)
+            rows, scores = rows[best], scores[best]
+        if len(rows) == k:
+            floor = max(threshold, float(scores.min()))
+        batch *= 2
+    order = _top_k(scores, len(scores))
+    return rows[order], scores[order]
+
+def _lsa_search(query: str, db: Dict[str, Any], k: int, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Hybrid TF-IDF top-k among the LSA_CANDIDATES nearest chunks in the dense index.
+
+    The ANN stage replaces the exhaustive scan; candidates are re-ranked with
+    the exact lexical score, so results match search_queries on the TF-IDF
+    engine whenever its top-k is among the candidates.
+    """
+    with timed('query_transform', engine='lsa'):
+        query_matrices = {space: _transform([query], db, space) for space in INDEX_SPACES}
+    with timed('scoring', engine='lsa'):
+        rows = np.unique(dense_candidates(
+            db, {space: matrix * np.sqrt(SPACE_WEIGHTS[space]) for space, matrix in query_matrices.items()}, max(LSA_CANDIDATES, k)
+        ))
+        scores = np.zeros(len(rows))
+        for space, matrix in query_matrices.items():
+            scores += SPACE_WEIGHTS[space] * (db[f'{space}_index'][rows] @ matrix.T).toarray().ravel()
+    best = _top_k(scores, k)
+    best = best[scores[best] > threshold]
+    return rows[best], scores[best]
+
+def measure_dense_recall(queries: List[str], db: Dict[str, Any], k: int = TOP_K_RESULTS) -> float:
+    """Mean recall@k of the LSA engine against the exhaustive TF-IDF scan"""
+    exact = _score(queries, db)
+    recalls = []
+    for column, query in enumerate(queries):
+        expected = {int(row) for row in _top_k(exact[:, column], k) if exact[row, column] > 0}
+        if expected:
+            found = {int(row) for row in _lsa_search(query, db, k, 0.0)[0]}
+            recalls.append(len(expected & found) / len(expected))
+    return float(np.mean(recalls)) if recalls else 1.0
+
+def _fragment(db: Dict[str, Any], row: int, score: float) -> DocumentFragment:
+    """Build the result for an index row from the flat chunk table"""
+    table = db['chunk_table']
+    return DocumentFragment(
+        text=table['text'][row],
+        document_name=db['documents'][table['document'][row]]['name'],
+        score=round(float(score), 4),
+        page_number=int(table['page_number'][row]),
+        text_position={
+            'start_pos': int(table['start_pos'][row]),
+            'end_pos': int(table['end_pos'][row])
+        }
     )
-    char_index = char_vectorizer.fit_transform(all_chunks)
 
-    db['word_vectorizer'] = word_vectorizer
-    db['char_vectorizer'] = char_vectorizer
-    db['word_index'] = word_index
-    db['char_index'] = char_index
-    print("Índice TF-IDF (palabras+caracteres) construido exitosamente.")
+def search_queries(queries: List[str], db: Dict[str, Any], top_k: Optional[List[Optional[int]]] = None, thresholds: Optional[List[Optional[float]]] = None) -> List[List[DocumentFragment]]:
+    """Search several queries at once, with optional per-query top_k and threshold.
+
+    Results are cached per index version and normalized query; only the
+    queries that miss the cache are vectorized and scored.
+    """
+    if not queries or not is_indexed(db):
+        return [[] for _ in queries]
+    
+    upgrade_index(db)
+    top_k = [k or TOP_K_RESULTS for k in (top_k or [None] * len(queries))]
+    thresholds = [SIMILARITY_THRESHOLD if t is None else t for t in (thresholds or [None] * len(queries))]
+    keys = [(db['index_version'], normalize_query(q), k, t) for q, k, t in zip(queries, top_k, thresholds)]
+    
+    results: List[Optional[List[DocumentFragment]]] = [None] * len(queries)
+    with _QUERY_CACHE_LOCK:
+        for position, key in enumerate(keys):
+            if key in _QUERY_CACHE:
+                _QUERY_CACHE.move_to_end(key)
+                results[position] = list(_QUERY_CACHE[key])
+                _QUERY_CACHE_STATS["hits"] += 1
+            else:
+                _QUERY_CACHE_STATS["misses"] += 1
+    
+    missing = [position for position, result in enumerate(results) if result is None]
+    if missing:
+        engine = session_engine(db)
+        observe('rag_search_chunks', _chunk_count(db), SIZE_BUCKETS, engine=engine)
+        if engine in ('bm25', 'lsa'):
+            # Poda por consulta: cada una visita solo los bloques o listas que pueden entrar en su top-k
+            search = _bm25_search if engine == 'bm25' else _lsa_search
+            for position in missing:
+                rows, scores = search(queries[position], db, top_k[position], thresholds[position])
+                with timed('top_k', engine=engine):
+                    results[position] = [_fragment(db, row, score) for row, score in zip(rows, scores)]
+        else:
+            similarities = _score([queries[position] for position in missing], db)
+            with timed('top_k', engine=engine):
+                for column, position in enumerate(missing):
+                    query_scores = similarities[:, column]
+                    top_indices = _top_k(query_scores, top_k[position])
+                    results[position] = [_fragment(db, i, query_scores[i]) for i in top_indices if query_scores[i] > thresholds[position]]
+        with _QUERY_CACHE_LOCK:
+            for position in missing:
+                _QUERY_CACHE[keys[position]] = list(results[position])
+                _QUERY_CACHE.move_to_end(keys[position])
+            while len(_QUERY_CACHE) > QUERY_CACHE_SIZE:
+                _QUERY_CACHE.popitem(last=False)
+    return results
 
 def search_query(q: str, db: Dict[str, Any]) -> List[DocumentFragment]:
     """Search for relevant document fragments"""
-    if not db or db.get('word_vectorizer') is None or db.get('char_vectorizer') is None:
-        return []
-    
     try:
-        # Consulta en ambos espacios (palabras y caracteres)
-        word_q = db['word_vectorizer'].transform([q])
-        char_q = db['char_vectorizer'].transform([q])
-
-        word_sim = cosine_similarity(word_q, db['word_index']).flatten()
-        char_sim = cosine_similarity(char_q, db['char_index']).flatten()
-
-        # Combinar con un promedio ponderado (más peso a palabras)
-        similarities = 0.7 * word_sim + 0.3 * char_sim
-        
-        # Verificar si hay alguna similitud significativa
-        max_similarity = np.max(similarities)
-        if max_similarity < SIMILARITY_THRESHOLD:
-            return []
-        
-        top_indices = similarities.argsort()[-TOP_K_RESULTS:][::-1]
-        results = []
-        all_chunks = [chunk for doc in db['documents'] for chunk in doc['chunks']]
-        
-        for i in top_indices:
-            if similarities[i] > SIMILARITY_THRESHOLD:
-                chunk = all_chunks[i]
-                results.append(
-                    DocumentFragment(
-                        text=chunk['text'],
-                        document_name=chunk['document_name'],
-                        score=round(float(similarities[i]), 4),
-                        page_number=chunk.get('page_number'),
-                        text_position={
-                            'start_pos': chunk.get('start_pos'),
-                            'end_pos': chunk.get('end_pos')
-                        }
-                    )
-                )
-        return results
+        return search_queries([q], db)[0]
     except Exception as e:
         print(f"Error durante la búsqueda: {e}")
         return []
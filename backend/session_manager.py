@@ -1,44 +1,246 @@
 import os
+import glob
+import time
+import shutil
 import pickle
+import asyncio
+import threading
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
 from typing import Dict, Any, Optional
+from config import SESSION_DIR, SESSION_CACHE_BYTES, SESSION_TTL_SECONDS, SESSION_SWEEP_INTERVAL_SECONDS
+from index_store import stage_index, read_index, read_manifest
+from database import get_session_version, publish_session_version, delete_session_version, recent_session_ids
+from metrics import timed, observe, SIZE_BUCKETS
+from blob_store import store_bytes, sweep_unreferenced_blobs
+from search_engine import upgrade_index
+from document_cache import retain_documents, release_documents, sweep_unreferenced_documents
 
-# Almacenamiento por sesión
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+# Caché de sesiones residentes en memoria, en orden LRU (la más reciente al final)
+SESSIONS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_SESSION_BYTES: Dict[str, int] = {}
+_LAST_ACCESS: Dict[str, float] = {}
+_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_CACHE_LOCK = threading.RLock()
+# Un solo escritor por sesión en este proceso (entre workers decide el registro de versiones)
+_WRITER_LOCKS: Dict[str, threading.Lock] = {}
+
+# Coste aproximado de cada entrada de un dict de Python (vocabularios y chunks)
+_DICT_ENTRY_BYTES = 100
+# Las lecturas solo actualizan la fecha en disco de la sesión cada tanto
+_TOUCH_INTERVAL_SECONDS = 60
+
+class SessionConflictError(Exception):
+    """The session was republished (e.g. by another worker) since it was loaded"""
 
 def session_path(session_id: str) -> str:
-    """Get the file path for a session"""
+    """Get the directory holding a session's published versions"""
+    if not session_id or os.path.basename(session_id) != session_id or session_id.startswith('.'):
+        raise ValueError(f"session_id inválido: {session_id!r}")
+    return os.path.join(SESSION_DIR, session_id)
+
+def version_path(session_id: str, version: int) -> str:
+    """Get the directory of one published version (0: sessions written before versioning)"""
+    root = session_path(session_id)
+    return os.path.join(root, f"v{version}") if version else root
+
+def legacy_session_path(session_id: str) -> str:
+    """Get the path of a session pickled by earlier versions"""
     return os.path.join(os.path.dirname(__file__), f"document_store_{session_id}.pkl")
 
-def save_session(session_id: str):
-    """Save session data to file"""
-    db = SESSIONS.get(session_id)
+def estimate_session_bytes(db: Dict[str, Any]) -> int:
+    """Estimate a session's memory cost from its matrices, vocabularies and chunk text"""
+    total = 0
+    for value in db.values():
+        if sp.issparse(value):
+            total += value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif hasattr(value, 'vocabulary_'):
+            vocabulary = value.vocabulary_
+            total += getattr(vocabulary, 'nbytes', len(vocabulary) * _DICT_ENTRY_BYTES)
+    for doc in db['documents']:
+        chunks = doc['chunks']
+        if hasattr(chunks, 'nbytes'):
+            total += chunks.nbytes
+        else:
+            total += sum(len(chunk['text']) + _DICT_ENTRY_BYTES for chunk in chunks)
+    return total
+
+def session_writer(session_id: str) -> threading.Lock:
+    """Lock held while a session is modified and republished"""
+    with _CACHE_LOCK:
+        return _WRITER_LOCKS.setdefault(session_id, threading.Lock())
+
+def _touch(session_id: str):
+    """Record an access, refreshing the on-disk timestamp used by the TTL sweeper"""
+    now = time.time()
+    previous = _LAST_ACCESS.get(session_id, 0)
+    _LAST_ACCESS[session_id] = now
+    if now - previous < _TOUCH_INTERVAL_SECONDS:
+        return
+    try:
+        os.utime(session_path(session_id))
+    except OSError:
+        pass
+
+def _evict(keep: str):
+    """Drop least recently used sessions until the cache fits its budget"""
+    while len(SESSIONS) > 1 and sum(_SESSION_BYTES.values()) > SESSION_CACHE_BYTES:
+        session_id = next(iter(SESSIONS))
+        if session_id == keep:
+            SESSIONS.move_to_end(session_id)
+            session_id = next(iter(SESSIONS))
+        # Las sesiones se guardan tras cada cambio, así que basta con soltarlas
+        del SESSIONS[session_id]
+        _SESSION_BYTES.pop(session_id, None)
+        _CACHE_STATS["evictions"] += 1
+        print(f"Sesión {session_id} expulsada de la caché.")
+
+def _cache_put(session_id: str, db: Dict[str, Any]):
+    with _CACHE_LOCK:
+        SESSIONS[session_id] = db
+        SESSIONS.move_to_end(session_id)
+        _SESSION_BYTES[session_id] = estimate_session_bytes(db)
+        _evict(keep=session_id)
+
+def clear_session_cache():
+    """Drop every resident session (the next access reloads it from disk)"""
+    with _CACHE_LOCK:
+        SESSIONS.clear()
+        _SESSION_BYTES.clear()
+
+def cache_stats() -> Dict[str, Any]:
+    """Session cache counters for /status"""
+    with _CACHE_LOCK:
+        return {
+            **_CACHE_STATS,
+            "resident_sessions": len(SESSIONS),
+            "resident_bytes": sum(_SESSION_BYTES.values()),
+            "budget_bytes": SESSION_CACHE_BYTES
+        }
+
+def _remove_old_versions(session_id: str, version: int):
+    """Delete versions older than the previous one, which readers may still be opening"""
+    root = session_path(session_id)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith('v') and name[1:].isdigit() and int(name[1:]) < version - 1:
+            shutil.rmtree(path, ignore_errors=True)
+        elif version > 1 and os.path.isfile(path):
+            # Archivos de una sesión escrita antes del versionado (versión 0)
+            os.remove(path)
+
+def save_session(session_id: str, db: Optional[Dict[str, Any]] = None):
+    """Publish session data as a new version visible to every worker.
+
+    The index is written to a temp directory and renamed to its version
+    directory while the registry row is locked. A session loaded from disk is
+    only republished if nobody published another version since it was
+    loaded; otherwise SessionConflictError is raised. Any other failure
+    propagates too, so callers never report an unpublished session as saved.
+    """
+    if db is None:
+        db = SESSIONS.get(session_id)
     if not db:
         return
+    tmp_dir = None
     try:
-        with open(session_path(session_id), 'wb') as f:
-            pickle.dump(db, f)
+        root = session_path(session_id)
+        with timed('session_save'):
+            tmp_dir = stage_index(root, db)
+
+        def install(version: int):
+            target = version_path(session_id, version)
+            # Restos de una publicación anterior que no llegó a registrarse
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(tmp_dir, target)
+
+        version = publish_session_version(session_id, db.get('session_version'), install)
+        if version is None:
+            # La copia en caché tiene cambios sin publicar: se descarta
+            with _CACHE_LOCK:
+                SESSIONS.pop(session_id, None)
+                _SESSION_BYTES.pop(session_id, None)
+            raise SessionConflictError(f"La sesión {session_id} fue modificada por otra petición.")
+        tmp_dir = None
+        retain_documents(session_id, db['documents'])
+        _remove_old_versions(session_id, version)
+        # Se sirve la versión publicada, mapeada desde disco: la memoria se comparte con los demás workers
+        published = read_index(version_path(session_id, version))
+        published['session_version'] = version
+        _cache_put(session_id, published)
     except Exception as e:
         print(f"Error guardando sesión {session_id}: {e}")
+        raise
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-def load_session(session_id: str) -> Optional[Dict[str, Any]]:
-    """Load session data from file"""
-    if session_id in SESSIONS:
-        return SESSIONS[session_id]
-    path = session_path(session_id)
-    if os.path.exists(path):
+def _migrate_legacy_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Convert a pickled session to the on-disk index format"""
+    path = legacy_session_path(session_id)
+    with open(path, 'rb') as f:
+        db = pickle.load(f)
+    for doc in db['documents']:
+        if 'content' in doc:
+            doc['content_hash'] = store_bytes(bytes.fromhex(doc.pop('content')))
+    upgrade_index(db)
+    save_session(session_id, db)
+    if os.path.exists(session_path(session_id)):
+        os.remove(path)
+    return SESSIONS.get(session_id, db)
+
+def _read_published(session_id: str) -> Optional[Dict[str, Any]]:
+    """Open the currently published version of a session"""
+    for _ in range(2):
+        version = get_session_version(session_id) or 0
         try:
-            with open(path, 'rb') as f:
-                SESSIONS[session_id] = pickle.load(f)
-                return SESSIONS[session_id]
-        except Exception as e:
-            print(f"Error cargando sesión {session_id}: {e}")
-            return None
+            db = read_index(version_path(session_id, version))
+        except FileNotFoundError:
+            # Otra publicación retiró la versión mientras se abría: se reintenta con la nueva
+            continue
+        if db is not None:
+            db['session_version'] = version
+        return db
     return None
 
+def load_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Load session data from the cache or from disk, memory-mapping its index.
+
+    The cached copy is used only while it is still the version published in
+    the shared registry; a version published by another worker replaces it.
+    """
+    version = get_session_version(session_id) or 0
+    with _CACHE_LOCK:
+        if session_id in SESSIONS:
+            if SESSIONS[session_id].get('session_version', 0) == version:
+                SESSIONS.move_to_end(session_id)
+                _CACHE_STATS["hits"] += 1
+                _touch(session_id)
+                return SESSIONS[session_id]
+            del SESSIONS[session_id]
+            _SESSION_BYTES.pop(session_id, None)
+            _CACHE_STATS["invalidations"] += 1
+        _CACHE_STATS["misses"] += 1
+    try:
+        with timed('session_load'):
+            db = _read_published(session_id)
+            if db is None and os.path.exists(legacy_session_path(session_id)):
+                db = _migrate_legacy_session(session_id)
+    except Exception as e:
+        print(f"Error cargando sesión {session_id}: {e}")
+        return None
+    if db is not None:
+        _cache_put(session_id, db)
+        _touch(session_id)
+        observe('rag_session_load_bytes', _SESSION_BYTES.get(session_id, 0), SIZE_BUCKETS)
+    return db
+
 def create_session(session_id: str, db: Dict[str, Any]):
     """Create a new session"""
-    SESSIONS[session_id] = db
-    save_session(session_id)
+    save_session(session_id, db)
 
 def get_session(session_id: str) -> Optional[Dict[str, Any]]:
     """Get session data"""
@@ -46,16 +248,89 @@ def get_session(session_id: str) -> Optional[Dict[str, Any]]:
 
 def delete_session(session_id: str):
     """Delete a session"""
-    if session_id in SESSIONS:
-        del SESSIONS[session_id]
-    
+    with _CACHE_LOCK:
+        SESSIONS.pop(session_id, None)
+        _SESSION_BYTES.pop(session_id, None)
+        _LAST_ACCESS.pop(session_id, None)
+        _WRITER_LOCKS.pop(session_id, None)
+
+    delete_session_version(session_id)
     path = session_path(session_id)
     if os.path.exists(path):
         try:
-            os.remove(path)
+            shutil.rmtree(path)
         except Exception as e:
-            print(f"Error eliminando archivo de sesión {session_id}: {e}")
+            print(f"Error eliminando archivos de sesión {session_id}: {e}")
+    legacy_path = legacy_session_path(session_id)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    release_documents(session_id)
+
+def warm_up_sessions(limit: int) -> int:
+    """Load the sessions of the most recently active chats into the cache, returning how many were found"""
+    warmed = 0
+    for session_id in recent_session_ids(limit) if limit > 0 else []:
+        if load_session(session_id) is not None:
+            warmed += 1
+    return warmed
 
 def list_sessions() -> list:
     """List all active sessions"""
     return list(SESSIONS.keys())
+
+def sweep_expired_sessions() -> int:
+    """Delete sessions (and leftover legacy pickles) idle for longer than SESSION_TTL_SECONDS"""
+    if SESSION_TTL_SECONDS <= 0:
+        return 0
+    now = time.time()
+    removed = 0
+    entries = [(name, os.path.join(SESSION_DIR, name)) for name in os.listdir(SESSION_DIR)] if os.path.isdir(SESSION_DIR) else []
+    for name, path in entries:
+        try:
+            last_access = max(os.path.getmtime(path), _LAST_ACCESS.get(name, 0))
+        except OSError:
+            continue
+        if now - last_access < SESSION_TTL_SECONDS:
+            continue
+        if name.startswith('.'):
+            # Restos de escrituras interrumpidas
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        delete_session(name)
+        removed += 1
+    for path in glob.glob(legacy_session_path('*')):
+        if now - os.path.getmtime(path) >= SESSION_TTL_SECONDS:
+            os.remove(path)
+            removed += 1
+    if removed:
+        print(f"Sesiones caducadas eliminadas: {removed}")
+    return removed
+
+def referenced_content_hashes() -> set:
+    """Content hashes of the uploaded files used by any stored session version"""
+    referenced = set()
+    manifests = glob.glob(os.path.join(SESSION_DIR, '*', 'manifest.json')) + glob.glob(os.path.join(SESSION_DIR, '*', '*', 'manifest.json'))
+    for path in manifests:
+        try:
+            manifest = read_manifest(os.path.dirname(path))
+        except (OSError, ValueError):
+            # Versión retirada mientras se leía
+            continue
+        if manifest:
+            referenced.update(doc['content_hash'] for doc in manifest['documents'])
+    return referenced
+
+def sweep_unused_blobs() -> int:
+    """Delete uploaded files that no stored session uses"""
+    return sweep_unreferenced_blobs(referenced_content_hashes())
+
+async def run_session_sweeper():
+    """Periodically delete expired sessions, unreferenced cached documents and unreferenced blobs in a worker thread"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(sweep_expired_sessions)
+            await asyncio.to_thread(sweep_unreferenced_documents)
+            await asyncio.to_thread(sweep_unused_blobs)
+        except Exception as e:
+            print(f"Error limpiando sesiones caducadas: {e}")
@@ -0,0 +1,34 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from config import INGEST_WORKERS
+
+# Pool de procesos compartido para la extracción, el chunking y el ajuste de vectorizadores
+_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+
+# Los workers nacen de un proceso "forkserver" y no de un fork de la app: con las
+# importaciones perezosas otro hilo puede estar importando un módulo justo al
+# crear un worker, y el fork heredaría su bloqueo de importación para siempre.
+# El forkserver carga estos módulos una sola vez para todos los workers
+_POOL_PRELOAD = ['search_engine', 'document_processor', 'sklearn.feature_extraction.text', 'pypdf']
+
+def _pool_context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(_POOL_PRELOAD)
+    return context
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Get the shared ingestion process pool, creating it on first use"""
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=_pool_context())
+    return _PROCESS_POOL
+
+def shutdown_process_pool():
+    """Stop the ingestion process pool"""
+    global _PROCESS_POOL
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown(wait=True, cancel_futures=True)
+        _PROCESS_POOL = None
@@ -1,13 +1,15 @@
 'use client';
 
 import { useState, useEffect, useRef, useCallback } from 'react';
-import { Message, SearchResult, QAResponse, Citation, Chat, ChatMessage } from '@/lib/types';
+import { Message, SearchResult, Citation, Chat, ChatMessage } from '@/lib/types';
 import { PdfViewer } from './PdfViewer';
 import { useRouter } from 'next/navigation';
 
 
 type ChatMode = 'search' | 'qa';
 
+const MESSAGES_PAGE_SIZE = 100;
+
 export function ChatInterface() {
   const [messages, setMessages] = useState<Message[]>([]);
   const [input, setInput] = useState('');
@@ -15,11 +17,13 @@ export function ChatInterface() {
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
   const [indexedFiles, setIndexedFiles] = useState<string[]>([]);
-  const [activePdf, setActivePdf] = useState<{fileHex: string, pageNumber?: number, textPosition?: {start_pos: number, end_pos: number}} | null>(null);
+  const [activePdf, setActivePdf] = useState<{fileHex?: string, fileUrl?: string, pageNumber?: number, textPosition?: {start_pos: number, end_pos: number}} | null>(null);
   const [showFilesPopup, setShowFilesPopup] = useState(false);
   const [chats, setChats] = useState<Chat[]>([]);
   const [activeChatId, setActiveChatId] = useState<number | null>(null);
   const [showRightPane, setShowRightPane] = useState<boolean>(false);
+  // Cursor de la página anterior del historial (null si ya está completo)
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
 
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const router = useRouter();
@@ -41,23 +45,39 @@ export function ChatInterface() {
     }
   }, [activeChatId]);
 
+  const toUiMessage = (m: ChatMessage): Message => {
+    const payload = m.payload_json || {};
+    if (payload.results || payload.qaResponse) {
+      return { sender: m.sender, text: m.text, ...(payload.results ? { results: payload.results } : {}), ...(payload.qaResponse ? { qaResponse: payload.qaResponse } : {}) } as Message;
+    }
+    return { sender: m.sender, text: m.text } as Message;
+  };
+
+  // Solo se cargan los mensajes más recientes; los anteriores se piden bajo demanda
   const loadMessages = async (chatId: number) => {
     try {
-      const res = await fetch(`http://127.0.0.1:8000/chats/${chatId}/messages`);
+      const res = await fetch(`http://127.0.0.1:8000/chats/${chatId}/messages?limit=${MESSAGES_PAGE_SIZE}`);
       const data: ChatMessage[] = await res.json();
-      const uiMsgs: Message[] = data.map(m => {
-        const payload = m.payload_json || {};
-        if (payload.results || payload.qaResponse) {
-          return { sender: m.sender, text: m.text, ...(payload.results ? { results: payload.results } : {}), ...(payload.qaResponse ? { qaResponse: payload.qaResponse } : {}) } as Message;
-        }
-        return { sender: m.sender, text: m.text } as Message;
-      });
+      const uiMsgs: Message[] = data.map(toUiMessage);
+      setOlderCursor(res.headers.get('X-Next-Cursor'));
       setMessages(uiMsgs.length ? uiMsgs : [{ sender: 'bot', text: '¡Hola! Puedes empezar a preguntar.' }]);
     } catch (e) {
       console.error('Error cargando mensajes', e);
     }
   };
 
+  const loadOlderMessages = async () => {
+    if (activeChatId == null || !olderCursor) return;
+    try {
+      const res = await fetch(`http://127.0.0.1:8000/chats/${activeChatId}/messages?limit=${MESSAGES_PAGE_SIZE}&before=${olderCursor}`);
+      const data: ChatMessage[] = await res.json();
+      setOlderCursor(res.headers.get('X-Next-Cursor'));
+      setMessages(prev => [...data.map(toUiMessage), ...prev]);
+    } catch (e) {
+      console.error('Error cargando mensajes anteriores', e);
+    }
+  };
+
   useEffect(() => {
     const files = localStorage.getItem('indexedFiles');
     if (files) setIndexedFiles(JSON.parse(files));
@@ -117,19 +137,77 @@ export function ChatInterface() {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
 
-  const appendMessage = async (msg: Message) => {
-    setMessages(prev => [...prev, msg]);
+  // La pregunta y su respuesta se guardan juntas con una sola petición
+  const persistMessages = async (msgs: Message[]) => {
     if (activeChatId == null) return;
     try {
-      const payload = (msg.results || msg.qaResponse) ? { results: msg.results, qaResponse: msg.qaResponse } : null;
-      await fetch(`http://127.0.0.1:8000/chats/${activeChatId}/messages`, {
+      await fetch(`http://127.0.0.1:8000/chats/${activeChatId}/messages:batch`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ sender: msg.sender, text: msg.text, payload_json: payload })
+        body: JSON.stringify({
+          messages: msgs.map(msg => ({
+            sender: msg.sender,
+            text: msg.text,
+            payload_json: (msg.results || msg.qaResponse) ? { results: msg.results, qaResponse: msg.qaResponse } : null
+          }))
+        })
       });
     } catch (e) {
-      console.error('No se pudo persistir el mensaje', e);
+      console.error('No se pudieron persistir los mensajes', e);
+    }
+  };
+
+  const appendMessage = (msg: Message) => {
+    setMessages(prev => [...prev, msg]);
+  };
+
+  // Reemplaza el último mensaje (la respuesta que se está recibiendo en streaming)
+  const updateLastMessage = (msg: Message) => {
+    setMessages(prev => [...prev.slice(0, -1), msg]);
+  };
+
+  // Lee la respuesta de /ask/stream (Server-Sent Events) y la va mostrando a medida que llega
+  const streamAnswer = async (question: string): Promise<Message> => {
+    const response = await fetch('http://127.0.0.1:8000/ask/stream', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+      body: JSON.stringify({ question, session_id: currentSessionId }),
+    });
+    if (!response.ok || !response.body) throw new Error('Error al obtener la respuesta.');
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let botMsg: Message | null = null;
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n\n');
+      buffer = events.pop() ?? '';
+      for (const raw of events) {
+        const event = raw.match(/^event: (.*)$/m)?.[1];
+        const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] ?? 'null');
+        if (event === 'citations') {
+          // Las fuentes se muestran en cuanto termina la recuperación
+          const first: Message = { sender: 'bot', text: '', qaResponse: { answer: '', citations: data } };
+          botMsg = first;
+          setMessages(prev => [...prev, first]);
+          setIsLoading(false);
+        } else if (event === 'token' && botMsg) {
+          const text: string = botMsg.text + data.text;
+          botMsg = { ...botMsg, text, qaResponse: { ...botMsg.qaResponse!, answer: text } };
+          updateLastMessage(botMsg);
+        } else if (event === 'done' && botMsg) {
+          botMsg = { ...botMsg, text: data.answer, qaResponse: { ...botMsg.qaResponse!, answer: data.answer } };
+          updateLastMessage(botMsg);
+        } else if (event === 'error') {
+          throw new Error(data.detail);
+        }
+      }
     }
+    if (!botMsg) throw new Error('La respuesta se interrumpió.');
+    return botMsg;
   };
 
   const handleSubmit = async (e: React.FormEvent) => {
@@ -141,7 +219,7 @@ export function ChatInterface() {
     }
 
     const userMessage: Message = { sender: 'user', text: input };
-    await appendMessage(userMessage);
+    appendMessage(userMessage);
     setInput('');
     setIsLoading(true);
     setError(null);
@@ -154,31 +232,32 @@ export function ChatInterface() {
         if (!response.ok) throw new Error('Error en la búsqueda.');
         const data: SearchResult[] = await response.json();
         const botMsg: Message = { sender: 'bot', text: `Resultados de búsqueda para "${input}":`, results: data };
-        await appendMessage(botMsg);
+        appendMessage(botMsg);
+        await persistMessages([userMessage, botMsg]);
       } else {
-        response = await fetch('http://127.0.0.1:8000/ask', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ question: input, session_id: currentSessionId }),
-        });
-        if (!response.ok) throw new Error('Error al obtener la respuesta.');
-        const data: QAResponse = await response.json();
-        const botMsg: Message = { sender: 'bot', text: data.answer, qaResponse: data };
-        await appendMessage(botMsg);
+        const botMsg = await streamAnswer(input);
+        await persistMessages([userMessage, botMsg]);
       }
     } catch (err: unknown) {
       const errorMessage = err instanceof Error ? err.message : 'Error desconocido';
       setError(errorMessage);
       const botErr: Message = { sender: 'bot', text: `Lo siento, ocurrió un error: ${errorMessage}` };
-      await appendMessage(botErr);
+      appendMessage(botErr);
+      await persistMessages([userMessage, botErr]);
     } finally {
       setIsLoading(false);
     }
   };
 
   const handleCitationClick = (citation: Citation) => {
+    if (!citation.content_hex && !hasSession) {
+      setError('No hay sesión de documentos para abrir el PDF. Crea un nuevo chat desde Inicio.');
+      return;
+    }
     setActivePdf({
-      fileHex: citation.content_hex,
+      ...(citation.content_hex
+        ? { fileHex: citation.content_hex }
+        : { fileUrl: `http://127.0.0.1:8000/get_document/${encodeURIComponent(citation.document_name)}?session_id=${encodeURIComponent(currentSessionId!)}` }),
       pageNumber: citation.page_number,
       textPosition: citation.text_position
     });
@@ -190,21 +269,13 @@ export function ChatInterface() {
       setError('No hay sesión de documentos para abrir el PDF. Crea un nuevo chat desde Inicio.');
       return;
     }
-    const url = `http://127.0.0.1:8000/get_document/${encodeURIComponent(result.document_name)}?session_id=${encodeURIComponent(currentSessionId!)}`;
-    fetch(url)
-      .then(response => response.json())
-      .then(data => {
-        setActivePdf({
-          fileHex: data.content_hex,
-          pageNumber: result.page_number,
-          textPosition: result.text_position
-        });
-        setShowRightPane(true);
-      })
-      .catch(error => {
-        console.error('Error obteniendo documento:', error);
-        setError('No se pudo abrir el documento para este resultado.');
-      });
+    // El visor descarga el documento directamente (con peticiones de rango)
+    setActivePdf({
+      fileUrl: `http://127.0.0.1:8000/get_document/${encodeURIComponent(result.document_name)}?session_id=${encodeURIComponent(currentSessionId!)}`,
+      pageNumber: result.page_number,
+      textPosition: result.text_position
+    });
+    setShowRightPane(true);
   };
 
   // Función para derivar título del chat (no utilizada actualmente)
@@ -279,6 +350,13 @@ export function ChatInterface() {
         {/* Mensajes */}
         <div className="flex-grow p-4 md:p-6 overflow-y-auto">
           <div className="space-y-4 md:space-y-6">
+            {olderCursor && (
+              <div className="flex justify-center">
+                <button onClick={loadOlderMessages} className="chip text-xs hover:border-[--color-primary]">
+                  Cargar mensajes anteriores
+                </button>
+              </div>
+            )}
             {messages.map((msg, index) => (
               <div key={index} className={`flex ${msg.sender === 'user' ? 'justify-end' : 'justify-start'}`}>
                 <div className={`max-w-lg p-4 rounded-xl ${msg.sender === 'user' ? 'bg-[--color-primary] text-[--color-primary-foreground]' : 'bg-[--color-muted] border border-[--color-border]'}`}>
@@ -308,6 +386,7 @@ export function ChatInterface() {
                               <button
                                 key={i}
                                 onClick={() => handleCitationClick(cit)}
+                                title={cit.snippet}
                                 className="chip text-xs hover:border-[--color-primary]"
                               >
                                  {cit.document_name}
@@ -357,7 +436,7 @@ export function ChatInterface() {
         <div className="card overflow-hidden">
           <div className="relative h-full">
             <button className="absolute top-2 right-2 chip text-xs" onClick={()=>{ setActivePdf(null); setShowRightPane(false); }}>Cerrar</button>
-            <PdfViewer fileHex={activePdf.fileHex} pageNumber={activePdf.pageNumber} textPosition={activePdf.textPosition} onClose={() => { setActivePdf(null); setShowRightPane(false); }} />
+            <PdfViewer fileHex={activePdf.fileHex} fileUrl={activePdf.fileUrl} pageNumber={activePdf.pageNumber} textPosition={activePdf.textPosition} onClose={() => { setActivePdf(null); setShowRightPane(false); }} />
           </div>
         </div>
       )}
@@ -4,10 +4,40 @@ import { useRouter } from 'next/navigation';
 import { useCallback, useState } from 'react';
 import { useDropzone, FileRejection } from 'react-dropzone';
 
+const JOB_POLL_INTERVAL_MS = 1000;
+
+const STAGE_LABELS: Record<string, string> = {
+  queued: 'En cola',
+  extracting: 'Extrayendo texto',
+  chunking: 'Dividiendo en fragmentos',
+  indexing: 'Indexando',
+  persisting: 'Guardando sesión',
+  done: 'Completado',
+};
+
+interface IngestJob {
+  id: string;
+  status: 'queued' | 'running' | 'succeeded' | 'failed' | 'cancelled';
+  stage: string;
+  progress: { files?: Record<string, { pages_done: number; total_pages: number }> } | null;
+  result: { session_id: string } | null;
+  error: string | null;
+}
+
+function describeJob(job: IngestJob): string {
+  const label = STAGE_LABELS[job.stage] || job.stage;
+  const files = Object.values(job.progress?.files || {});
+  if (job.stage !== 'extracting' || files.length === 0) return `${label}...`;
+  const done = files.reduce((sum, f) => sum + f.pages_done, 0);
+  const total = files.reduce((sum, f) => sum + f.total_pages, 0);
+  return `${label}: ${done}/${total} páginas`;
+}
+
 export function FileUploader() {
   const [files, setFiles] = useState<File[]>([]);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
+  const [jobStatus, setJobStatus] = useState<string | null>(null);
   const router = useRouter();
 
   const onDrop = useCallback((acceptedFiles: File[], fileRejections: FileRejection[]) => {
@@ -49,8 +79,21 @@ export function FileUploader() {
         throw new Error(errData.detail || 'Error al procesar los archivos.');
       }
 
-      const result = await response.json();
-      const sessionId = result.session_id;
+      // La ingesta se ejecuta en segundo plano: se consulta el trabajo hasta que termine
+      const { job_id: jobId } = await response.json();
+      let job: IngestJob;
+      while (true) {
+        const jobRes = await fetch(`http://127.0.0.1:8000/jobs/${jobId}`);
+        if (!jobRes.ok) throw new Error('No se pudo consultar el estado de la ingesta.');
+        job = await jobRes.json();
+        setJobStatus(describeJob(job));
+        if (job.status !== 'queued' && job.status !== 'running') break;
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+      }
+      if (job.status !== 'succeeded' || !job.result) {
+        throw new Error(job.status === 'cancelled' ? 'La ingesta fue cancelada.' : job.error || 'Error al procesar los archivos.');
+      }
+      const sessionId = job.result.session_id;
 
       // Obtener el número de chats existentes para generar título secuencial
       const chatsResponse = await fetch('http://127.0.0.1:8000/chats');
@@ -79,6 +122,7 @@ export function FileUploader() {
       setError(errorMessage);
     } finally {
       setIsLoading(false);
+      setJobStatus(null);
     }
   };
 
@@ -123,6 +167,7 @@ export function FileUploader() {
         </div>
       )}
       
+      {jobStatus && <p className="mt-4 text-center text-sm text-gray-600 dark:text-gray-300">{jobStatus}</p>}
       {error && <p className="mt-4 text-center text-red-500">{error}</p>}
 
       <div className="mt-8 text-center">
@@ -12,7 +12,8 @@ import 'react-pdf/dist/Page/AnnotationLayer.css';
 import 'react-pdf/dist/Page/TextLayer.css';
 
 interface PdfViewerProps {
-  fileHex: string;
+  fileHex?: string;
+  fileUrl?: string;
   pageNumber?: number;
   textPosition?: {
     start_pos: number;
@@ -26,7 +27,7 @@ const hexToArrayBuffer = (hex: string) => {
   return typedArray.buffer;
 };
 
-export function PdfViewer({ fileHex, pageNumber, textPosition, onClose }: PdfViewerProps) {
+export function PdfViewer({ fileHex, fileUrl, pageNumber, textPosition, onClose }: PdfViewerProps) {
   const [numPages, setNumPages] = useState<number | null>(null);
   const [currentPage, setCurrentPage] = useState<number>(1);
   const [isClient, setIsClient] = useState(false);
@@ -41,9 +42,10 @@ export function PdfViewer({ fileHex, pageNumber, textPosition, onClose }: PdfVie
   }, []);
 
   // *** CORRECCIÓN 1: Memoizar el objeto 'file' para evitar re-renders innecesarios ***
-  const fileData = useMemo(() => ({
-    data: hexToArrayBuffer(fileHex),
-  }), [fileHex]);
+  // Con URL, pdf.js pide rangos de bytes y carga las páginas bajo demanda
+  const fileData = useMemo(() => (
+    fileUrl ? { url: fileUrl } : { data: hexToArrayBuffer(fileHex ?? '') }
+  ), [fileHex, fileUrl]);
 
   // Efecto para hacer scroll a la página correcta cuando se proporciona pageNumber
   useEffect(() => {
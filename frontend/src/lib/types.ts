@@ -11,7 +11,10 @@ export interface SearchResult {
 
 export interface Citation {
   document_name: string;
-  content_hex: string;
+  document_id: string;
+  snippet: string;
+  // Solo presente en mensajes guardados antes de que las citas fueran referencias
+  content_hex?: string;
   page_number?: number;
   text_position?: {
     start_pos: number;